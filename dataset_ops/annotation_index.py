@@ -0,0 +1,222 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import *
+import xml.etree.ElementTree as ET
+import numpy as np
+import os, sys, time
+
+
+FILE_COLUMNS = ("path", "filename", "width", "height", "depth", "mtime")
+BOX_COLUMNS = ("file", "name", "xmin", "ymin", "xmax", "ymax")
+
+
+def _int(text, default=-1):
+    try:
+        return int(float(text))
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_xml(xml_path: str):
+    try:
+        root = ET.parse(xml_path).getroot()
+    except (ET.ParseError, OSError) as e:
+        print(f"{xml_path}: parse error {e}")
+        return None
+
+    size = root.find("size")
+    width = _int(size.findtext("width")) if size is not None else -1
+    height = _int(size.findtext("height")) if size is not None else -1
+    depth = _int(size.findtext("depth"), 3) if size is not None else 3
+
+    objects = []
+    for obj in root.iter("object"):
+        box = obj.find("bndbox")
+        if box is None:
+            continue
+        objects.append((obj.findtext("name"),
+                        _int(box.findtext("xmin")), _int(box.findtext("ymin")),
+                        _int(box.findtext("xmax")), _int(box.findtext("ymax"))))
+    return root.findtext("filename"), width, height, depth, objects
+
+
+def scan_xmls(root: Path) -> Dict[str, float]:
+    found = {}
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        with os.scandir(d) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if not e.name.startswith('.'):
+                        stack.append(e.path)
+                elif e.name.endswith(".xml"):
+                    found[os.path.relpath(e.path, root)] = e.stat().st_mtime
+    return found
+
+
+class AnnotationIndex:
+    FILENAME = ".annotation_index.npz"
+
+    def __init__(self, root: Path, index_path: Path = None):
+        self.root = Path(root)
+        self.index_path = Path(index_path) if index_path else self.root / self.FILENAME
+        self.names: List[str] = []
+        self.files = {c: np.array([]) for c in FILE_COLUMNS}
+        self.boxes = {c: np.array([], dtype=np.int64) for c in BOX_COLUMNS}
+        self.box_start = np.zeros(1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.files["path"])
+
+    @property
+    def num_boxes(self):
+        return len(self.boxes["file"])
+
+    @classmethod
+    def load(cls, root: Path, index_path: Path = None) -> 'AnnotationIndex':
+        index = cls(root, index_path)
+        if index.index_path.exists():
+            with np.load(index.index_path, allow_pickle=False) as data:
+                index.names = list(data["names"])
+                index.files = {c: data[f"file_{c}"] for c in FILE_COLUMNS}
+                index.boxes = {c: data[f"box_{c}"] for c in BOX_COLUMNS}
+                index.box_start = data["box_start"]
+        return index
+
+    @classmethod
+    def build(cls, root: Path, index_path: Path = None, max_workers=None, save=True) -> 'AnnotationIndex':
+        index = cls.load(root, index_path)
+        index.update(max_workers)
+        if save:
+            index.save()
+        return index
+
+    def update(self, max_workers=None):
+        # files whose mtime did not change keep their parsed rows, everything else is parsed in parallel
+        start = time.time()
+        found = scan_xmls(self.root)
+        known = {p: i for i, p in enumerate(self.files["path"])}
+
+        keep = [known[p] for p, m in found.items() if p in known and self.files["mtime"][known[p]] == m]
+        changed = [p for p, m in found.items() if p not in known or self.files["mtime"][known[p]] != m]
+
+        parsed = []
+        if changed:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                parsed = list(executor.map(parse_xml, [str(self.root / p) for p in changed], chunksize=256))
+
+        files = {c: [] for c in FILE_COLUMNS}
+        boxes = {c: [] for c in BOX_COLUMNS}
+        name_ids = {n: i for i, n in enumerate(self.names)}
+        names = list(self.names)
+
+        def _add_file(path, filename, width, height, depth, mtime):
+            for c, v in zip(FILE_COLUMNS, (path, filename, width, height, depth, mtime)):
+                files[c].append(v)
+            return len(files["path"]) - 1
+
+        for i in keep:
+            f = _add_file(*(self.files[c][i] for c in FILE_COLUMNS))
+            lo, hi = self.box_start[i], self.box_start[i + 1]
+            boxes["file"].append(np.full(hi - lo, f, dtype=np.int64))
+            for c in BOX_COLUMNS[1:]:
+                boxes[c].append(self.boxes[c][lo:hi])
+
+        for path, result in zip(changed, parsed):
+            if result is None:
+                continue
+            filename, width, height, depth, objects = result
+            f = _add_file(path, filename or "", width, height, depth, found[path])
+            rows = []
+            for name, xmin, ymin, xmax, ymax in objects:
+                if name not in name_ids:
+                    name_ids[name] = len(names)
+                    names.append(name)
+                rows.append((f, name_ids[name], xmin, ymin, xmax, ymax))
+            rows = np.array(rows, dtype=np.int64).reshape(-1, len(BOX_COLUMNS))
+            for j, c in enumerate(BOX_COLUMNS):
+                boxes[c].append(rows[:, j])
+
+        self.names = names
+        self.files = dict(path=np.array(files["path"], dtype=str),
+                          filename=np.array(files["filename"], dtype=str),
+                          width=np.array(files["width"], dtype=np.int32),
+                          height=np.array(files["height"], dtype=np.int32),
+                          depth=np.array(files["depth"], dtype=np.int8),
+                          mtime=np.array(files["mtime"], dtype=np.float64))
+        self.boxes = {c: np.concatenate(boxes[c]) if boxes[c] else np.array([], dtype=np.int64) for c in BOX_COLUMNS}
+        for c in BOX_COLUMNS[2:]:
+            self.boxes[c] = self.boxes[c].astype(np.int32)
+        self.box_start = np.searchsorted(self.boxes["file"], np.arange(len(self) + 1))
+        print(f"{self.root}: indexed {len(self)} files / {self.num_boxes} boxes, "
+              f"{len(changed)} parsed, {len(keep)} reused in {time.time() - start:.1f}s")
+
+    def save(self):
+        tmp = self.index_path.with_name(self.index_path.name + ".tmp.npz")
+        np.savez(tmp,
+                 names=np.array(self.names, dtype=str),
+                 box_start=self.box_start,
+                 **{f"file_{c}": v for c, v in self.files.items()},
+                 **{f"box_{c}": v for c, v in self.boxes.items()})
+        os.replace(tmp, self.index_path)
+
+    def xml_path(self, i: int) -> Path:
+        return self.root / self.files["path"][i]
+
+    def image_path(self, i: int) -> Path:
+        return self.xml_path(i).parent / self.files["filename"][i]
+
+    def uuid(self, i: int) -> str:
+        return Path(self.files["path"][i]).stem
+
+    def super_concept(self, i: int) -> str:
+        return Path(self.files["path"][i]).parts[0]
+
+    def dir_concept(self, i: int) -> str:
+        return Path(self.files["path"][i]).parent.name.replace('_', " ") # DEPENDS ON FILE LAYOUT
+
+    def box_range(self, i: int) -> slice:
+        return slice(self.box_start[i], self.box_start[i + 1])
+
+    def file_boxes(self, i: int) -> List[Tuple[str, int, int, int, int]]:
+        s = self.box_range(i)
+        return [(self.names[n], *map(int, b)) for n, *b in zip(self.boxes["name"][s], self.boxes["xmin"][s], self.boxes["ymin"][s],
+                                                               self.boxes["xmax"][s], self.boxes["ymax"][s])]
+
+    def concept_boxes(self, i: int) -> List[Tuple[int, int, int, int]]:
+        # boxes whose label matches the concept directory the file lives in, as cutout and the stats expect
+        concept = self.dir_concept(i)
+        return [b for name, *b in self.file_boxes(i) if name == concept]
+
+    def box_columns(self, concept_only=True) -> Dict[str, np.ndarray]:
+        file = self.boxes["file"]
+        paths = [Path(p) for p in self.files["path"]]
+        columns = dict(
+            uuid=np.array([p.stem for p in paths], dtype=str)[file],
+            super_concept=np.array([p.parts[0] for p in paths], dtype=str)[file],
+            specific_concept=np.array([p.parent.name.replace('_', " ") for p in paths], dtype=str)[file],
+            label=np.array(self.names, dtype=str)[self.boxes["name"]] if self.names else np.array([], dtype=str),
+            img_w=self.files["width"][file],
+            img_h=self.files["height"][file],
+            ann_x=self.boxes["xmin"],
+            ann_y=self.boxes["ymin"],
+            ann_w=self.boxes["xmax"] - self.boxes["xmin"],
+            ann_h=self.boxes["ymax"] - self.boxes["ymin"],
+        )
+        if concept_only:
+            mask = columns["label"] == columns["specific_concept"]
+            columns = {c: v[mask] for c, v in columns.items()}
+            # position of each box among the matching boxes of its file, the crop index used by cutout
+            file = file[mask]
+            starts = np.r_[0, np.flatnonzero(np.diff(file)) + 1] if len(file) else np.array([], dtype=np.int64)
+            columns["index"] = np.arange(len(file)) - np.repeat(starts, np.diff(np.r_[starts, len(file)]))
+        return columns
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Syntax: {sys.argv[0]} <xml_dir>")
+        sys.exit(1)
+
+    AnnotationIndex.build(Path(sys.argv[1]))
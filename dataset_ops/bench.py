@@ -0,0 +1,189 @@
+from fake_fathomnet import FakeFathomNet, Taxonomy
+
+from pathlib import Path
+from typing import *
+import json, multiprocessing, os, queue, resource, shutil, sys, tempfile, time, traceback
+
+
+def _trees(meta_dir: Path):
+    from tree_metadata import LazyTree, tree_files
+    return {name: LazyTree(path).tree for name, path in tree_files(meta_dir).items()}
+
+
+def stage_tree(workdir: Path, cfg: dict):
+    from download_threaded import build_concepts_tree
+    from tree_metadata import save_tree
+
+    meta_dir = workdir / "threaded" / ".metadata"
+    meta_dir.mkdir(parents=True, exist_ok=True)
+    nodes = 0
+    for clsname, concepts in cfg["classes"].items():
+        tree = build_concepts_tree(concepts, 0, clsname, True)
+        save_tree(tree, clsname.replace(' ', '_'), meta_dir)
+        nodes += len(tree)
+    return dict(items=nodes, unit="nodes")
+
+
+def stage_threaded(workdir: Path, cfg: dict):
+    from download_threaded import DownloadQueue, download_tree
+    from download_manifest import DownloadManifest
+    from blob_store import BlobStore
+
+    output_dir = workdir / "threaded"
+    with DownloadManifest(output_dir) as manifest:
+        queue = DownloadQueue()
+        blob_store = BlobStore(output_dir)
+        for name, tree in _trees(output_dir / ".metadata").items():
+            download_tree(tree, 0, output_dir / name, manifest=manifest, queue=queue, blob_store=blob_store)
+        queue.join()
+        progress = manifest.progress()
+    return dict(items=progress["images"], unit="images", bytes=progress["bytes"])
+
+
+def stage_async(workdir: Path, cfg: dict):
+    import asyncio
+    from download_async import download_tree, make_session
+    from download_manifest import DownloadManifest
+    from voc_writer import AnnotationWriter
+
+    output_dir = workdir / "async"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    trees = _trees(workdir / "threaded" / ".metadata")
+
+    async def _run(manifest):
+        writer = AnnotationWriter()
+        async with make_session() as session:
+            await asyncio.gather(*[download_tree(session, tree, 0, output_dir / name, manifest, writer=writer) for name, tree in trees.items()])
+        await asyncio.to_thread(writer.close)
+
+    with DownloadManifest(output_dir) as manifest:
+        asyncio.run(_run(manifest))
+        progress = manifest.progress()
+    return dict(items=progress["images"], unit="images", bytes=progress["bytes"])
+
+
+def stage_cutout(workdir: Path, cfg: dict):
+    from cutout import cropOutTree
+    return dict(items=cropOutTree(workdir / "threaded", workdir / "crops"), unit="crops")
+
+
+def stage_stats(workdir: Path, cfg: dict):
+    from compile_crop_stats import create_df_from_xmls
+    return dict(items=len(create_df_from_xmls(workdir / "threaded")), unit="rows")
+
+
+def stage_coco(workdir: Path, cfg: dict):
+    from to_coco import export_coco
+    counts = export_coco(workdir / "threaded", workdir / "coco.json", 0.1)
+    return dict(items=sum(c.get("annotations", 0) for c in counts.values()), unit="annotations")
+
+
+STAGES = dict(tree=stage_tree, threaded=stage_threaded, async_=stage_async, cutout=stage_cutout, stats=stage_stats, coco=stage_coco)
+
+
+def _stage_main(name: str, workdir: str, cfg: dict, env: Dict[str, str], results):
+    # a fresh process per stage, so peak rss is the stage's own and nothing is warm from the stage before
+    os.environ.update(env)
+    try:
+        start = time.perf_counter()
+        result = STAGES[name](Path(workdir), cfg)
+        result["seconds"] = time.perf_counter() - start
+    except Exception as e:
+        traceback.print_exc()
+        result = dict(error=repr(e))
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result["peak_rss_mib"] = rss / 1024
+    from metrics import METRICS
+    result["metrics"] = METRICS.snapshot()
+    results.put(result)
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_stage(name: str, workdir: Path, cfg: dict, fake: FakeFathomNet) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    fake.reset_log()
+    # every stage gets an empty cache so its requests really reach the server
+    env = fake.env(workdir / f"cache-{name}.sqlite")
+    process = ctx.Process(target=_stage_main, args=(name, str(workdir), cfg, env, results))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                result = dict(error=f"stage process exited with {process.exitcode}")
+    process.join()
+
+    log = fake.reset_log()
+    latencies = [d * 1000 for _, status, d in log]
+    result.update(requests=len(log),
+                  errors=sum(1 for _, status, _ in log if status >= 400),
+                  p50_ms=percentile(latencies, 50),
+                  p90_ms=percentile(latencies, 90),
+                  p99_ms=percentile(latencies, 99))
+    if "seconds" in result:
+        result["per_second"] = result["items"] / result["seconds"] if result["seconds"] else None
+        if "bytes" in result:
+            result["mib_per_second"] = result["bytes"] / 2**20 / result["seconds"] if result["seconds"] else None
+    return result
+
+
+def report(results: Dict[str, dict]):
+    def _fmt(v, spec):
+        return format(v, spec) if v is not None else "-"
+
+    print(f"{'stage':<10}{'seconds':>9}{'items':>16}{'per s':>10}{'MiB/s':>8}{'requests':>10}{'errors':>8}"
+          f"{'p50 ms':>8}{'p90 ms':>8}{'p99 ms':>8}{'rss MiB':>9}")
+    for name, r in results.items():
+        if "error" in r:
+            print(f"{name:<10} failed: {r['error']}")
+            continue
+        print(f"{name.rstrip('_'):<10}{r['seconds']:>9.2f}{str(r['items']) + ' ' + r['unit']:>16}{_fmt(r['per_second'], '.1f'):>10}"
+              f"{_fmt(r.get('mib_per_second'), '.1f'):>8}{r['requests']:>10}{r['errors']:>8}{_fmt(r['p50_ms'], '.1f'):>8}"
+              f"{_fmt(r['p90_ms'], '.1f'):>8}{_fmt(r['p99_ms'], '.1f'):>8}{r['peak_rss_mib']:>9.0f}")
+
+
+def benchmark(workdir: Path, taxonomy: Taxonomy, latency=0.01, error_rate=0.0, stages: Iterable[str] = STAGES):
+    workdir = Path(workdir)
+    if workdir.exists() and any(workdir.iterdir()):
+        # only a previous benchmark run is wiped, never a directory that happens to be passed by mistake
+        if not (workdir / "bench.json").exists():
+            raise FileExistsError(f"{workdir} is not empty and holds no bench.json, refusing to delete it")
+        shutil.rmtree(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    results = {}
+    with FakeFathomNet(taxonomy, latency=latency, jitter=latency, error_rate=error_rate) as fake:
+        cfg = dict(classes=taxonomy.class_concepts())
+        print(f"{len(taxonomy.nodes)} concepts, {len(taxonomy.images)} images at {fake.url}, "
+              f"latency {latency * 1000:.0f}ms, error rate {error_rate}")
+        for name in stages:
+            print(f"== {name.rstrip('_')}")
+            results[name] = run_stage(name, workdir, cfg, fake)
+
+    report(results)
+    with open(workdir / "bench.json", "w") as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    workdir = Path(args[0]) if args else Path(tempfile.gettempdir()) / "fathomnet-bench"
+    depth = int(args[1]) if len(args) > 1 else 3
+    fanout = int(args[2]) if len(args) > 2 else 3
+    latency = float(args[3]) / 1000 if len(args) > 3 else 0.01
+    error_rate = float(args[4]) if len(args) > 4 else 0.0
+    try:
+        benchmark(workdir, Taxonomy(depth=depth, fanout=fanout), latency, error_rate)
+    except FileExistsError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,97 @@
+from cache_index import link_or_copy
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import *
+import os, sys, threading
+
+
+class BlobStore:
+    DIRNAME = ".blobs"
+
+    def __init__(self, root: Path, mode="hardlink"):
+        if mode not in ("hardlink", "symlink"):
+            raise ValueError(f"unknown materialise mode {mode}")
+
+        self.root = Path(root) / self.DIRNAME
+        self.mode = mode
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._guard = threading.Lock()
+        # uuid -> [lock, users], dropped with the checksum once the last user is done
+        self._locks: Dict[str, list] = {}
+        self._checksums: Dict[str, Tuple[int, Optional[str]]] = {}
+        self.fetched = 0
+        self.reused = 0
+
+    def blob_path(self, uuid: str, ext: str) -> Path:
+        return self.root / uuid[:2] / f"{uuid}{ext}"
+
+    @contextmanager
+    def pinned(self, uuid: str):
+        # keeps the lock and checksum of a uuid alive, a job materialising several directories pins it for all of them
+        with self._guard:
+            entry = self._locks.get(uuid)
+            if entry is None:
+                entry = self._locks[uuid] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[uuid]
+                    self._checksums.pop(uuid, None)
+
+    def get_or_fetch(self, uuid: str, ext: str, fetch: Callable[[Path], Optional[Tuple[int, Optional[str]]]]) -> Optional[Tuple[Path, int, Optional[str]]]:
+        # concurrent requests for the same uuid wait for the first one instead of downloading again
+        path = self.blob_path(uuid, ext)
+        with self.pinned(uuid) as lock, lock:
+            if uuid in self._checksums or path.exists():
+                if uuid not in self._checksums:
+                    # blobs from an earlier run are not rehashed, their checksum is left for later
+                    self._checksums[uuid] = (path.stat().st_size, None)
+                self.reused += 1
+                size, checksum = self._checksums[uuid]
+                return path, size, checksum
+
+            path.parent.mkdir(exist_ok=True)
+            fetched = fetch(path)
+            if not fetched:
+                return None
+            self._checksums[uuid] = fetched
+            self.fetched += 1
+            return (path, *fetched)
+
+    def materialise(self, blob: Path, target: Path) -> str:
+        if target.exists() or target.is_symlink():
+            if target.exists() and os.path.samefile(blob, target):
+                return "exists"
+            target.unlink()
+
+        if self.mode == "symlink":
+            target.symlink_to(os.path.relpath(blob, target.parent))
+            return "symlink"
+        return link_or_copy(blob, target)
+
+    def stats(self):
+        return dict(fetched=self.fetched, reused=self.reused)
+
+
+def disk_usage(root: Path):
+    blobs = 0
+    blob_bytes = 0
+    for dirpath, _, files in os.walk(Path(root) / BlobStore.DIRNAME):
+        for f in files:
+            blobs += 1
+            blob_bytes += os.stat(os.path.join(dirpath, f)).st_size
+    return blobs, blob_bytes
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Syntax: {sys.argv[0]} <output_dir>")
+        sys.exit(1)
+
+    blobs, blob_bytes = disk_usage(Path(sys.argv[1]))
+    print(f"{blobs} unique images, {blob_bytes / 1e6:.1f} MB")
@@ -0,0 +1,136 @@
+from pathlib import Path
+from typing import *
+import json, os, shutil, sys, time
+
+try:
+    import fcntl
+    FICLONE = 0x40049409
+except ImportError:
+    fcntl = None
+
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+
+def reflink(src: Path, dst: Path):
+    if fcntl is None:
+        raise OSError("reflinks not supported on this platform")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dst)
+            raise
+
+
+def link_or_copy(src: Path, dst: Path) -> str:
+    # hardlink if on the same filesystem, reflink on CoW filesystems, plain copy otherwise
+    try:
+        os.link(src, dst)
+        return "link"
+    except FileExistsError:
+        os.unlink(dst)
+        return link_or_copy(src, dst)
+    except OSError:
+        pass
+
+    try:
+        reflink(src, dst)
+        return "reflink"
+    except OSError:
+        shutil.copy(str(src), str(dst))
+        return "copy"
+
+
+class CacheIndex:
+    FILENAME = ".uuid_index.json"
+
+    def __init__(self, cached_dir: Path, index_path: Path = None):
+        self.root = Path(cached_dir)
+        self.index_path = Path(index_path) if index_path else self.root / self.FILENAME
+        # relative dir -> {mtime, subdirs, images}, images only count when their xml sits next to them
+        self.dirs: Dict[str, dict] = {}
+        self.images: Dict[str, str] = {}
+        self._load()
+
+    def _load(self):
+        if not self.index_path.exists():
+            return
+        try:
+            with open(self.index_path) as f:
+                self.dirs = json.load(f)['dirs']
+        except (json.JSONDecodeError, KeyError):
+            print(f"Ignoring corrupt cache index {self.index_path}")
+            self.dirs = {}
+        self._rebuild_images()
+
+    def _rebuild_images(self):
+        self.images = {}
+        for rel, entry in self.dirs.items():
+            for name in entry['images']:
+                self.images[Path(name).stem] = f"{rel}/{name}" if rel else name
+
+    def _scan_dir(self, path: Path, rel: str):
+        subdirs = []
+        names = set()
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if not e.name.startswith('.'):
+                        subdirs.append(e.name)
+                else:
+                    names.add(e.name)
+
+        images = [n for n in names
+                  if os.path.splitext(n)[1].lower() in IMAGE_SUFFIXES and f"{os.path.splitext(n)[0]}.xml" in names]
+        return dict(mtime=os.stat(path).st_mtime, subdirs=sorted(subdirs), images=sorted(images))
+
+    def refresh(self) -> int:
+        # directories whose mtime is unchanged keep their recorded listing, only changed ones are rescanned
+        start = time.time()
+        rescanned = 0
+        seen = {}
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            path = self.root / rel if rel else self.root
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+
+            entry = self.dirs.get(rel)
+            if entry is None or entry['mtime'] != mtime:
+                entry = self._scan_dir(path, rel)
+                rescanned += 1
+            seen[rel] = entry
+            stack.extend(f"{rel}/{d}" if rel else d for d in entry['subdirs'])
+
+        self.dirs = seen
+        self._rebuild_images()
+        print(f"{self.root}: indexed {len(self.images)} cached images, {rescanned}/{len(seen)} dirs rescanned in {time.time() - start:.1f}s")
+        return rescanned
+
+    def save(self):
+        tmp = self.index_path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(dict(root=str(self.root), dirs=self.dirs), f)
+        os.replace(tmp, self.index_path)
+
+    def lookup(self, uuid: str) -> Optional[Path]:
+        rel = self.images.get(uuid)
+        return self.root / rel if rel else None
+
+    def __len__(self):
+        return len(self.images)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Syntax: {sys.argv[0]} <cached_dir>")
+        sys.exit(1)
+
+    index = CacheIndex(Path(sys.argv[1]))
+    index.refresh()
+    index.save()
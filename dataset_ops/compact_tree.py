@@ -0,0 +1,97 @@
+from array import array
+from treelib import Tree
+
+from typing import *
+
+
+def parse_tag(tag: str):
+    # tags look like "(rank.)name", roots just carry the class name
+    if tag.startswith('(') and '.)' in tag:
+        rank, name = tag[1:].split('.)', 1)
+        return rank, name.strip()
+    return '', tag
+
+
+class CompactTree:
+    __slots__ = ('parent', 'rank', 'name', 'count', 'accumulated', 'names', 'ranks', '_name_ids', '_rank_ids')
+
+    def __init__(self):
+        # nodes are stored in pre-order, so a parent always comes before its children
+        self.parent = array('l')
+        self.rank = array('l')
+        self.name = array('l')
+        self.count = array('q')
+        self.accumulated = array('q')
+        self.names: List[str] = []
+        self.ranks: List[str] = []
+        self._name_ids: Dict[str, int] = {}
+        self._rank_ids: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    @staticmethod
+    def _intern(value: str, values: List[str], ids: Dict[str, int]):
+        i = ids.get(value)
+        if i is None:
+            i = ids[value] = len(values)
+            values.append(value)
+        return i
+
+    def add(self, name: str, rank: str = '', parent: int = -1, count: int = 0) -> int:
+        if parent >= len(self):
+            raise ValueError(f"parent {parent} has to be added before its children")
+
+        self.parent.append(parent)
+        self.rank.append(self._intern(rank, self.ranks, self._rank_ids))
+        self.name.append(self._intern(name, self.names, self._name_ids))
+        self.count.append(count)
+        self.accumulated.append(0)
+        return len(self) - 1
+
+    def node_name(self, i: int) -> str:
+        return self.names[self.name[i]]
+
+    def node_rank(self, i: int) -> str:
+        return self.ranks[self.rank[i]]
+
+    def accumulate(self):
+        # reverse pre-order visits every child before its parent
+        acc = array('q', self.count)
+        parent = self.parent
+        for i in range(len(self) - 1, 0, -1):
+            acc[parent[i]] += acc[i]
+        self.accumulated = acc
+        return acc[0] if len(self) else 0
+
+    @classmethod
+    def from_tree(cls, tree: Tree, rootID, count: Callable = lambda n: n.data.count) -> Tuple['CompactTree', list]:
+        compact = cls()
+        ids = []
+        stack = [(rootID, -1)]
+        while stack:
+            nid, p = stack.pop()
+            node = tree.get_node(nid)
+            rank, name = parse_tag(node.tag)
+            i = compact.add(name, rank, p, count(node) or 0)
+            ids.append(nid)
+            for cid in reversed(tree.is_branch(nid)):
+                stack.append((cid, i))
+        return compact, ids
+
+    def to_tree(self, tree: Tree, rootID=0, data: Callable = lambda count, accumulated: (count, accumulated),
+                tag: Callable = lambda rank, name: f"({rank}.){name}") -> Tree:
+        ids = []
+        for i in range(len(self)):
+            name = self.node_name(i)
+            node_data = data(self.count[i], self.accumulated[i])
+            if i == 0:
+                ids.append(rootID)
+                tree.create_node(name, rootID, data=node_data)
+                continue
+
+            parent = ids[self.parent[i]]
+            nid = f"{parent}_{name.replace(' ', '_')}"
+            ids.append(nid)
+            tree.create_node(tag(self.node_rank(i), name), nid, parent, node_data)
+        return tree
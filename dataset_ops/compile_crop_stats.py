@@ -1,61 +1,109 @@
 from pathlib import Path
-import sys
+from typing import *
+import json, sys
 
+import numpy as np
 import pandas as pd
-from pascal import PascalVOC
-from tqdm import tqdm
+from annotation_index import AnnotationIndex
+from lineage_index import load_lineage
+from metrics import METRICS, cli, stage
+
+COLUMNS = ["uuid", "super_concept", "specific_concept", "index", "img_w", "img_h", "ann_x", "ann_y", "ann_w", "ann_h"]
+DERIVED_COLUMNS = ["img_dim", "ann_dim", "ratio", "size_bin", "rank"]
+
+# annotation/image size ratio thresholds of BIN 1-4 in analyse_img_sizes.ipynb
+RATIO_THRESHOLDS = [2**-4, 2**-3, 2**-2]
+BIN_NAMES = ["BIN 1 (<1/16)", "BIN 2 (1/16-1/8)", "BIN 3 (1/8-1/4)", "BIN 4 (>1/4)"]
+NBINS = 100
+LOG_BINS = np.logspace(base=2, start=-8, stop=0, num=NBINS)
+
+
+def derive_columns(columns: Dict[str, np.ndarray], lineage=None):
+    valid = (columns["ann_w"] > 0) & (columns["ann_h"] > 0)
+    img_dim = np.sqrt(columns["img_w"].astype(np.float64) * columns["img_h"])
+    ann_dim = np.sqrt(columns["ann_w"].astype(np.float64) * columns["ann_h"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.clip(ann_dim / img_dim, 0, 1)
+    valid &= np.isfinite(ratio)
+
+    columns["img_dim"] = img_dim
+    columns["ann_dim"] = ann_dim
+    columns["ratio"] = np.where(valid, ratio, np.nan)
+    # -1 marks empty boxes or missing image sizes, they are left out of the summary
+    columns["size_bin"] = np.where(valid, np.digitize(ratio, RATIO_THRESHOLDS), -1)
+
+    labels, inverse = np.unique(columns["label"], return_inverse=True)
+    ranks = np.array([(lineage.rank(l) if lineage else None) or "" for l in labels], dtype=str)
+    columns["rank"] = ranks[inverse] if len(labels) else np.array([], dtype=str)
+    return columns
+
+
+def summarise(columns: Dict[str, np.ndarray]) -> dict:
+    valid = columns["size_bin"] >= 0
+    ratio = columns["ratio"][valid]
+    size_bin = columns["size_bin"][valid]
+    concepts, group = np.unique(columns["super_concept"][valid], return_inverse=True)
+
+    bin_counts = np.zeros((len(concepts), len(BIN_NAMES)), dtype=np.int64)
+    np.add.at(bin_counts, (group, size_bin), 1)
+
+    hist_bin = np.clip(np.searchsorted(LOG_BINS, ratio, side="right") - 1, 0, NBINS - 2)
+    in_range = ratio >= LOG_BINS[0]
+    histograms = np.zeros((len(concepts), NBINS - 1), dtype=np.int64)
+    np.add.at(histograms, (group[in_range], hist_bin[in_range]), 1)
+
+    def _entry(bins, hist):
+        return dict(count=int(bins.sum()),
+                    bins=dict(zip(BIN_NAMES, map(int, bins))),
+                    histogram=hist.tolist(),
+                    mode_ratio=float(LOG_BINS[np.argmax(hist)]) if hist.any() else None)
+
+    return dict(thresholds=RATIO_THRESHOLDS,
+                log_bins=LOG_BINS.tolist(),
+                skipped=int((~valid).sum()),
+                total=_entry(bin_counts.sum(axis=0), histograms.sum(axis=0)),
+                super_concepts={c: _entry(b, h) for c, b, h in zip(concepts, bin_counts, histograms)})
+
 
 def create_df_from_xmls(xml_dir: Path):
-    # df = pd.DataFrame(columns=[
-    #     "uuid", "index", "img_w", "img_h", "bbox_x", "bbox_y", "bbox_width", "bbox_height"
-    # ])
-
-    rows = {}
-    rows['uuid'] = []
-    rows['super_concept'] = []
-    rows['specific_concept'] = [] 
-    rows['index'] = [] 
-    rows['img_w'] = [] 
-    rows['img_h'] = [] 
-    rows['ann_x'] = [] 
-    rows['ann_y'] = [] 
-    rows['ann_w'] = [] 
-    rows['ann_h'] = [] 
-
-    for f in tqdm(xml_dir.glob("**/*.xml")):
-        try:
-            ann = PascalVOC.from_xml(f)
-        except Exception as e:
-            print(f"{f}: PascalVOC error {e}")
-            continue
-        
-        super_concept = str(f.parent.parts[1])
-        specific_concept = str(f.parent.parts[-1]).replace('_', " ") # DEPENDS ON FILE LAYOUT
-        uuid = f.stem
-        img_w = ann.size.width
-        img_h = ann.size.height        
-        index = 0
-        for obj in ann.objects:
-            if obj.name == specific_concept:
-                rows['uuid'].append(uuid)
-                rows['super_concept'].append(super_concept)
-                rows['specific_concept'].append(specific_concept)
-                rows['index'].append(index)
-                rows['img_w'].append(img_w)
-                rows['img_h'].append(img_h)
-                rows['ann_x'].append(obj.bndbox.xmin)
-                rows['ann_y'].append(obj.bndbox.ymin)
-                rows['ann_w'].append(obj.bndbox.xmax - obj.bndbox.xmin)
-                rows['ann_h'].append(obj.bndbox.ymax - obj.bndbox.ymin)
-                index += 1
-    
-    return pd.DataFrame.from_dict(rows)
-
-    
+    index = AnnotationIndex.build(xml_dir)
+    return create_df_from_index(index)
+
+
+def create_df_from_index(index: AnnotationIndex):
+    columns = derive_columns(index.box_columns(concept_only=True), load_lineage(index.root))
+    return pd.DataFrame({c: columns[c] for c in COLUMNS + DERIVED_COLUMNS})
+
+
+def compile_stats(xml_dir: Path, csv_path: Path, summary_path: Path):
+    with stage("stats_index"):
+        index = AnnotationIndex.build(xml_dir)
+    with stage("stats_derive"):
+        columns = derive_columns(index.box_columns(concept_only=True), load_lineage(xml_dir))
+    METRICS.inc("stats_rows_total", len(columns["uuid"]))
+    with stage("stats_csv"):
+        pd.DataFrame({c: columns[c] for c in COLUMNS + DERIVED_COLUMNS}).to_csv(csv_path)
+
+    with stage("stats_summary"):
+        summary = summarise(columns)
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=1)
+
+    for name, count in summary["total"]["bins"].items():
+        print(f"{name}: {count}")
+    for concept, entry in summary["super_concepts"].items():
+        # no mode when every box of the concept is below the smallest histogram bin
+        mode_ratio = f"{entry['mode_ratio']:.4f}" if entry['mode_ratio'] is not None else "n/a"
+        print(f"{concept}: {entry['count']} boxes, {list(entry['bins'].values())}, mode ratio {mode_ratio}")
+    return summary
+
+
 if __name__ == "__main__":
+    sys.argv = cli(sys.argv)
     if len(sys.argv) < 3:
-        print(f"Syntax: {sys.argv[0]} <xml_dir> <csv file>")
+        print(f"Syntax: {sys.argv[0]} <xml_dir> <csv file> [summary json]")
         sys.exit(1)
-    
-    df = create_df_from_xmls(Path(sys.argv[1]))
-    df.to_csv(Path(sys.argv[2]))
\ No newline at end of file
+
+    csv_path = Path(sys.argv[2])
+    summary_path = Path(sys.argv[3]) if len(sys.argv) > 3 else csv_path.with_suffix(".summary.json")
+    compile_stats(Path(sys.argv[1]), csv_path, summary_path)
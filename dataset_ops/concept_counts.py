@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fathomnet_cache import CacheMiss, count_by_concept
+from metrics import METRICS
+
+from rate_control import backoff_delay
+from tqdm import tqdm
+from typing import *
+import time
+
+
+MAX_WORKERS = 16
+RETRIES = 3
+BACKOFF = 0.5
+
+
+def node_concept(node):
+    return node.tag.split(')')[-1].strip()
+
+
+def fetch_count(concept: str, retries=RETRIES, backoff=BACKOFF):
+    for attempt in range(retries + 1):
+        try:
+            return count_by_concept(concept)
+        except CacheMiss:
+            raise
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = backoff_delay(attempt, backoff)
+            METRICS.inc("retries_total", call="count_by_concept")
+            print(f"Count {concept} failed ({e}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+
+def fetch_counts(concepts: Iterable[str], max_workers=MAX_WORKERS, retries=RETRIES, backoff=BACKOFF) -> Dict[str, int]:
+    # the same concept can appear under several parents, only ask for it once
+    unique = list(dict.fromkeys(concepts))
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_count, c, retries, backoff): c for c in unique}
+        progress = tqdm(as_completed(futures), total=len(futures))
+        for f in progress:
+            concept = futures[f]
+            counts[concept] = f.result()
+            progress.set_postfix_str(concept)
+
+    return counts
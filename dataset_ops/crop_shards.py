@@ -0,0 +1,155 @@
+from pathlib import Path
+from typing import *
+import io, json, os, re, sys, tarfile, time
+
+
+MAX_COUNT = 10_000
+MAX_BYTES = 1 << 30
+
+
+def read_index(shard_dir: Path) -> List[dict]:
+    # one line per closed shard with its keys, a line cut short by a crash is ignored
+    shards = []
+    path = Path(shard_dir) / ShardWriter.INDEX
+    if not path.exists():
+        return shards
+    with open(path) as f:
+        for line in f:
+            try:
+                shards.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"{path}: skipping a truncated entry")
+    return shards
+
+
+class ShardWriter:
+    # WebDataset layout, every sample is <key>.<ext> image plus <key>.json metadata in the same tar
+    INDEX = "shards.jsonl"
+
+    def __init__(self, output_dir: Path, prefix="crops", max_count=MAX_COUNT, max_bytes=MAX_BYTES):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        self.prefix = prefix
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.shards: List[dict] = []
+        self.keys: Set[str] = set()
+        self.tar = None
+        self.current = None
+
+        # shards that were closed are kept, a shard that was still being written is lost and rewritten
+        for s in read_index(self.output_dir):
+            if (self.output_dir / s["name"]).exists():
+                self.keys.update(s.pop("keys"))
+                self.shards.append(s)
+
+        index_path = self.output_dir / self.INDEX
+        if index_path.exists() and index_path.stat().st_size:
+            with open(index_path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # end a truncated entry, so the next one starts on its own line
+                    f.write(b"\n")
+
+    def __contains__(self, key: str):
+        return key in self.keys
+
+    def _next_number(self):
+        # past every shard in the index and every tar on disk, a shard dropped from the index is never overwritten
+        pattern = re.compile(rf"{re.escape(self.prefix)}-(\d+)\.tar$")
+        numbers = [int(m.group(1)) for m in (pattern.match(p.name) for p in self.output_dir.iterdir()) if m]
+        numbers += [int(pattern.match(s["name"]).group(1)) for s in self.shards]
+        return max(numbers, default=-1) + 1
+
+    def _open(self):
+        name = f"{self.prefix}-{self._next_number():06d}.tar"
+        self.current = dict(name=name, count=0, bytes=0, keys=[])
+        self.tar = tarfile.open(self.output_dir / (name + ".part"), "w")
+
+    def _close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        os.replace(self.output_dir / (self.current["name"] + ".part"), self.output_dir / self.current["name"])
+        self._append_index(self.current)
+        del self.current["keys"]
+        self.shards.append(self.current)
+        self.tar = None
+        self.current = None
+
+    def _append_index(self, shard: dict):
+        # append only, closing a shard writes its own keys once instead of rewriting every shard before it
+        with open(self.output_dir / self.INDEX, "a") as f:
+            f.write(json.dumps(shard) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _add_member(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def write(self, key: str, image: bytes, ext: str, meta: dict):
+        if key in self.keys:
+            return
+        if self.tar is None:
+            self._open()
+
+        self._add_member(f"{key}.{ext.lstrip('.')}", image)
+        self._add_member(f"{key}.json", json.dumps(meta).encode())
+        self.current["count"] += 1
+        self.current["bytes"] += len(image)
+        self.current["keys"].append(key)
+        self.keys.add(key)
+
+        if self.current["count"] >= self.max_count or self.current["bytes"] >= self.max_bytes:
+            self._close_shard()
+
+    def close(self):
+        self._close_shard()
+        (self.output_dir / self.INDEX).touch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def shard_paths(shard_dir: Path) -> List[Path]:
+    shard_dir = Path(shard_dir)
+    return [shard_dir / s["name"] for s in read_index(shard_dir) if (shard_dir / s["name"]).exists()]
+
+
+def iter_samples(shards: Union[Path, Iterable[Path]]) -> Iterator[dict]:
+    # streams the tars sequentially, members of one sample are always next to each other
+    if isinstance(shards, (str, Path)):
+        shards = shard_paths(shards)
+
+    for shard in shards:
+        sample = None
+        with tarfile.open(shard, "r|") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, ext = member.name.rsplit(".", 1)
+                if sample is None or sample["key"] != key:
+                    if sample is not None:
+                        yield sample
+                    sample = dict(key=key)
+                data = tar.extractfile(member).read()
+                sample[ext] = json.loads(data) if ext == "json" else data
+        if sample is not None:
+            yield sample
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Syntax: {sys.argv[0]} <shard_dir>")
+        sys.exit(1)
+
+    shards = read_index(Path(sys.argv[1]))
+    for s in shards:
+        print(f"{s['name']}: {s['count']} samples, {s['bytes'] / 2**20:.1f}MiB")
+    print(f"total {sum(s['count'] for s in shards)} samples in {len(shards)} shards")
@@ -1,12 +1,119 @@
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 from pathlib import Path
+import os, sys
 
 import cv2
 from pascal import PascalVOC
+from annotation_index import AnnotationIndex
+from crop_shards import ShardWriter
+from lineage_index import load_lineage
+from streaming import part_path
+from metrics import METRICS, cli, profile_worker, stage
+
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+PENDING = 64
+
+
+def crop_path(output_dir: Path, image_path: Path, index: int):
+    return output_dir / f"{(image_path.stem)}-{index}{image_path.suffix}"
+
+
+def reduction_factor(boxes, max_size):
+    # largest power of two we can decode at without any crop dropping below max_size
+    if not max_size or not boxes:
+        return 1
+    smallest = min(max(xmax - xmin, ymax - ymin) for xmin, ymin, xmax, ymax in boxes)
+    for factor in (8, 4, 2):
+        if smallest / factor >= max_size:
+            return factor
+    return 1
+
+
+def extract_crops(image_path: Path, todo, max_size=None):
+    factor = reduction_factor([b for _, b in todo], max_size)
+    with METRICS.timer("crop_decode_seconds", factor=factor):
+        img = cv2.imread(image_path.as_posix(), REDUCED_FLAGS[factor])
+    if img is None:
+        METRICS.inc("crop_decode_errors_total")
+        print(f"{image_path}: failed to decode")
+        return
+
+    h, w = img.shape[:2]
+    for i, (xmin, ymin, xmax, ymax) in todo:
+        x0, y0 = max(0, xmin // factor), max(0, ymin // factor)
+        x1, y1 = min(w, xmax // factor), min(h, ymax // factor)
+        if x1 <= x0 or y1 <= y0:
+            print(f"Empty boundingbox {image_path.name}-{i}")
+            continue
+
+        cropped = img[y0: y1, x0: x1]
+        if max_size and max(cropped.shape[:2]) > max_size:
+            scale = max_size / max(cropped.shape[:2])
+            cropped = cv2.resize(cropped, (max(1, round(cropped.shape[1] * scale)), max(1, round(cropped.shape[0] * scale))),
+                                 interpolation=cv2.INTER_AREA)
+        yield i, cropped
+
+
+def write_crop(path: Path, cropped) -> bool:
+    # written to a .part file and renamed, a killed worker must not leave a truncated crop that resume would skip
+    ok, data = cv2.imencode(path.suffix, cropped)
+    if not ok:
+        METRICS.inc("crop_encode_errors_total")
+        print(f"{path}: failed to encode")
+        return False
+    tmp = part_path(path)
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data.tobytes())
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return True
+
+
+def crop_image(image_path, boxes, output_dir, max_size=None):
+    image_path = Path(image_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
 
+    # resume per crop, an image is only decoded if one of its crops is missing
+    todo = [(i, b) for i, b in enumerate(boxes) if not crop_path(output_dir, image_path, i).exists()]
+    if not todo:
+        return 0, len(boxes)
 
-def cropout(xml_path, output_dir):
+    written = 0
+    for i, cropped in extract_crops(image_path, todo, max_size):
+        with METRICS.timer("crop_write_seconds"):
+            if not write_crop(crop_path(output_dir, image_path, i), cropped):
+                continue
+        written += 1
+    METRICS.inc("crops_total", written, result="written")
+    METRICS.inc("crops_total", len(boxes) - len(todo), result="existing")
+    return written, len(boxes) - len(todo)
+
+
+def encode_crops(image_path, boxes, skip, max_size=None):
+    # shard mode, crops go back to the parent encoded so a single writer owns the tar
+    image_path = Path(image_path)
+    todo = [(i, b) for i, b in enumerate(boxes) if i not in skip]
+    if not todo:
+        return []
+    encoded = []
+    for i, cropped in extract_crops(image_path, todo, max_size):
+        with METRICS.timer("crop_encode_seconds"):
+            ok, data = cv2.imencode(image_path.suffix, cropped)
+        if not ok:
+            METRICS.inc("crop_encode_errors_total")
+            print(f"{image_path.name}-{i}: failed to encode")
+            continue
+        encoded.append((i, data.tobytes()))
+    return encoded
+
+
+def cropout(xml_path, output_dir, max_size=None):
     xml_path = Path(xml_path)
     try:
         ann = PascalVOC.from_xml(xml_path)
@@ -14,57 +121,120 @@ def cropout(xml_path, output_dir):
         print(f"{xml_path}: PascalVOC error {e}")
         return 0
 
-    output_dir = Path(output_dir)
-    output_dir.mkdir(exist_ok=True, parents=True)
     concept = str(xml_path.parent.parts[-1]).replace('_', " ") # DEPENDS ON FILE LAYOUT
     image_path = xml_path.parent / ann.filename
+    boxes = [(obj.bndbox.xmin, obj.bndbox.ymin, obj.bndbox.xmax, obj.bndbox.ymax) for obj in ann.objects if obj.name == concept]
+    written, _ = crop_image(image_path, boxes, output_dir, max_size)
+    return written
 
-    img = cv2.imread(image_path.as_posix())
-    index = 0
-    for obj in ann.objects:
-        if obj.name == concept:
-            output_path = output_dir / f"{(image_path.stem)}-{index}{image_path.suffix}"
-            index += 1
-
-            if output_path.exists():
-                return 1
-
-            try:
-                cropped = img[obj.bndbox.ymin: obj.bndbox.ymax, obj.bndbox.xmin: obj.bndbox.xmax]
-            except Exception as e:
-                print(e)
-                return 0
-            
-            h, w, c = cropped.shape
-            if h == 0 or w == 0 or c==0:
-                print(f"Empty boundingbox")
-                continue
-            cv2.imwrite(output_path.as_posix(), cropped)
-    
-    return index
 
-
-def cropoutDir(xml_dir, output_dir):
+def cropoutDir(xml_dir, output_dir, max_size=None):
     for xml_file in glob(f"{xml_dir}/*.xml"):
-        cropout(xml_file, output_dir)
+        cropout(xml_file, output_dir, max_size)
+
 
+def _init_worker():
+    # one decoder thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+    profile_worker("cutout")
 
-def cropOutTree(input_dir, output_dir_root):
+
+def _crop_job(job):
+    return crop_image(*job), METRICS.drain()
+
+
+def _encode_job(job):
+    return job, encode_crops(*job[:4]), METRICS.drain()
+
+
+def bounded_map(executor, func, jobs, pending=PENDING):
+    # executor.map would queue every job up front, crop bytes from shards must not all sit in memory
+    futures = deque()
+    for job in jobs:
+        futures.append(executor.submit(func, job))
+        if len(futures) >= pending:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def shard_key(rel_dir: Path, uuid: str, index: int):
+    return f"{rel_dir.as_posix()}/{uuid}-{index}"
+
+
+def cropOutTree(input_dir, output_dir_root, max_size=None, max_workers=None, shards=False):
     input_dir = Path(input_dir)
     output_dir_root = Path(output_dir_root)
+    index = AnnotationIndex.build(input_dir)
+    if shards:
+        return cropOutTreeShards(index, output_dir_root, max_size, max_workers)
 
-    def _crop(xml_file):
-        output_dir = output_dir_root.joinpath(*xml_file.parent.parts[len(input_dir.parts):])
-        return cropout(xml_file, output_dir)
+    def _jobs():
+        for i in range(len(index)):
+            boxes = index.concept_boxes(i)
+            if boxes:
+                output_dir = output_dir_root.joinpath(*index.xml_path(i).parent.parts[len(input_dir.parts):])
+                yield index.image_path(i), boxes, output_dir, max_size
 
-    
     total = 0
-    with ThreadPoolExecutor(max_workers=100) as executor:
-        for x in executor.map(_crop, input_dir.glob("**/*.xml")):
+    existing = 0
+    with stage("cutout"), ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_worker) as executor:
+        for (x, skipped), worker_metrics in executor.map(_crop_job, _jobs(), chunksize=16):
+            METRICS.merge(worker_metrics)
             total += x
+            existing += skipped
             if (total - x)//500 < total//500:
                 print(f"{input_dir}: {total} cropped")
+    print(f"{input_dir}: {total} cropped, {existing} already existed")
+    return total
 
 
-
-cropOutTree("./downloads", "./cropped/")
\ No newline at end of file
+def cropOutTreeShards(index: AnnotationIndex, output_dir, max_size=None, max_workers=None):
+    total = 0
+    existing = 0
+    lineage = load_lineage(index.root)
+    with ShardWriter(output_dir) as writer:
+        def _jobs():
+            nonlocal existing
+            for i in range(len(index)):
+                boxes = index.concept_boxes(i)
+                if not boxes:
+                    continue
+                rel_dir = Path(index.files["path"][i]).parent
+                skip = {j for j in range(len(boxes)) if shard_key(rel_dir, index.uuid(i), j) in writer}
+                existing += len(skip)
+                yield index.image_path(i), boxes, skip, max_size, i
+
+        with stage("cutout"), ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_worker) as executor:
+            for (image_path, boxes, _, _, i), crops, worker_metrics in bounded_map(executor, _encode_job, _jobs()):
+                METRICS.merge(worker_metrics)
+                rel_dir = Path(index.files["path"][i]).parent
+                for j, data in crops:
+                    xmin, ymin, xmax, ymax = boxes[j]
+                    concept = index.dir_concept(i)
+                    writer.write(shard_key(rel_dir, index.uuid(i), j), data, image_path.suffix,
+                                 dict(uuid=index.uuid(i), index=j,
+                                      concept=concept,
+                                      super_concept=index.super_concept(i),
+                                      rank=lineage.rank(concept) if lineage else None,
+                                      ancestors=lineage.ancestors(concept) if lineage else [],
+                                      bbox=[xmin, ymin, xmax, ymax],
+                                      image_width=int(index.files["width"][i]),
+                                      image_height=int(index.files["height"][i]),
+                                      source=index.files["path"][i]))
+                    total += 1
+                    METRICS.inc("crops_total", result="written")
+                    if total % 500 == 0:
+                        print(f"{index.root}: {total} cropped")
+    METRICS.inc("crops_total", existing, result="existing")
+    print(f"{index.root}: {total} cropped into {len(writer.shards)} shards, {existing} already existed")
+    return total
+
+
+if __name__ == "__main__":
+    sys.argv = cli(sys.argv)
+    args = [a for a in sys.argv[1:] if a != "--shards"]
+    input_dir = args[0] if len(args) > 0 else "./downloads"
+    output_dir = args[1] if len(args) > 1 else "./cropped/"
+    max_size = int(args[2]) if len(args) > 2 else None
+    cropOutTree(input_dir, output_dir, max_size, shards="--shards" in sys.argv)
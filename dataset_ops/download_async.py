@@ -1,18 +1,30 @@
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
 from typing_extensions import override
 from fathomnet.api import boundingboxes, images, taxa
 from fathomnet.models import *
-from pascal_voc_writer import Writer
+from voc_writer import AnnotationWriter, write_voc
+from fathomnet_cache import CacheMiss, find_by_concept, phylogeny_down
+from compact_tree import CompactTree
+from tree_metadata import save_tree
+from download_manifest import DownloadManifest
+from streaming import AsyncByteBudget, astream_to_file
+from rate_control import AsyncAIMDController, RETRIES, backoff_delay, retry_after_seconds, retry_call
+from concept_counts import fetch_counts, node_concept, MAX_WORKERS
+from taxa_explorer import explore_taxa
+from metrics import METRICS, cli, stage
 import treelib
 from treelib import Tree
 
 import asyncio, aiohttp
 
-from tqdm import tqdm
 from pathlib import Path
 from typing import *
+from urllib.parse import urlparse
 from urllib.request import urlretrieve
-import json, pickle, random, sys, time, urllib3
+from queue import Full
+import json, random, sys, time
 
 
 def buildTree(concept: Taxa, provider='fathomnet', trimEmpty = True):
@@ -50,40 +62,16 @@ def buildTree(concept: Taxa, provider='fathomnet', trimEmpty = True):
     return tree
 
 
-def buildTreeBetter(_taxa: Taxa, provider='fathomnet'):
-    searchSpace = []
-    leaves = set()
-    
-    def exploreSearchSpace(t: Taxa, parent):
-        searchSpace.append((t, parent))
-        new_parent = f"{parent}__{t.name.replace(' ', '_')}"
-        children = taxa.find_children(provider, t.name)
-
-        if len(children) == 0:
-            leaves.add(f"{t.rank}-{t.name}")
-
-
-        for c in children:
-            exploreSearchSpace(c, new_parent)
-
-   
-    exploreSearchSpace(_taxa, "0")
-    print(f"Search space size: {len(searchSpace)} / {len(leaves)} leaves")
+def buildTreeBetter(_taxa: Taxa, provider='fathomnet', max_workers=MAX_WORKERS):
+    nodes, leaves, counts = explore_taxa(_taxa, provider, max_workers)
 
     tree = Tree()
-    tree.create_node("ROOT", "0", data = 0) 
-
-    for t, parent in tqdm(searchSpace):
-        children_image_count = boundingboxes.count_by_concept(t.name).count
-
-        if children_image_count == 0 and (f"{t.rank}-{t.name}" in leaves):
+    tree.create_node("ROOT", "0", data = Count(0))
+    for t, parent, nid in nodes:
+        if counts[t.name] == 0 and nid in leaves:
             continue
+        tree.create_node(f"{t.rank} - {t.name}", nid, parent, Count(counts[t.name]))
 
-        try:
-            tree.create_node(f"{t.rank} - {t.name}", f"{parent}__{t.name.replace(' ', '_')}", parent, children_image_count)
-        except treelib.exceptions.DuplicatedNodeIdError:
-            print(f"skip duplicate: {parent}__{t.name}")
-    
     cleanupTree(tree, "0")
 
     return tree
@@ -106,27 +94,25 @@ class Count:
 
 
 def cleanupTree(tree: Tree, nid):
-    total = tree.get_node(nid).data.count
-    for cid in [c.identifier for c in tree.children(nid)]:
-        total += cleanupTree(tree, cid)
-    
-    children = [c.identifier for c in tree.children(nid)]
-    if len(children) == 0 and not total:
+    compact, ids = CompactTree.from_tree(tree, nid)
+    total = compact.accumulate()
+    if not total:
         tree.remove_node(nid)
         return 0
-    else:
-        tree.get_node(nid).data = Count(total)
-        return total
+
+    for i, identifier in enumerate(ids):
+        if compact.accumulated[i]:
+            tree.get_node(identifier).data = Count(compact.accumulated[i])
+        elif compact.accumulated[compact.parent[i]]:
+            tree.remove_node(identifier)
+    return total
 
 
 def buildPhylogeny(conceptName: str, tree: Tree = None, rootID = 0, rootTag = 'ROOT'):
-    http = urllib3.PoolManager()
-    req = http.request('GET', f"https://fathomnet.org/dsg/phylogeny/down/{conceptName}")
-    if req.status >= 300:
+    dsg_data = phylogeny_down(conceptName)
+    if dsg_data is None:
         print("Failed to connect to fathomnet phylogeny")
         return None
-    
-    dsg_data = json.loads(req.data)
 
     if not tree:
         tree = MyTree()
@@ -148,20 +134,11 @@ def buildPhylogeny(conceptName: str, tree: Tree = None, rootID = 0, rootTag = 'R
     return tree
 
 
-def addImageCountTree(phylenogy: Tree):
-    progress = tqdm(enumerate(list(phylenogy.all_nodes())))
-    for _, n in progress:
-        if n.identifier == 0:
-            continue
-
-        concept = n.tag.split(')')[-1].strip()
-        if len(concept) == 0:
-            continue
-    
-        progress.set_postfix_str(concept)
-
-        count = boundingboxes.count_by_concept(concept).count
-        phylenogy.get_node(n.identifier).data = Count(count)
+def addImageCountTree(phylenogy: Tree, max_workers=MAX_WORKERS):
+    nodes = [n for n in phylenogy.all_nodes() if n.identifier != 0 and len(node_concept(n)) > 0]
+    counts = fetch_counts([node_concept(n) for n in nodes], max_workers=max_workers)
+    for n in nodes:
+        n.data = Count(counts[node_concept(n)])
 
 
 def buildConceptTree(concept: str):
@@ -187,7 +164,7 @@ def buildConceptsTree(concepts: List[str], rootID: str, rootTag: Any, includeImg
 
 
 def download_images_data(concept):
-    return images.find_by_concept(concept, 'fathomnet')
+    return retry_call(find_by_concept, concept, 'fathomnet', giveup=(CacheMiss,))
 
 
 def download_image(image_data: AImageDTO, output_dir: Path):
@@ -200,102 +177,255 @@ def download_image(image_data: AImageDTO, output_dir: Path):
 
 
 def write_annotation(image_data: AImageDTO, image_path: Path, output_dir: Path):
-    writer = Writer(image_path, 
-                    image_data.width,
-                    image_data.height,
-                    database='FathomNet')
-    
-    for box in image_data.boundingBoxes:
-        concept = box.concept
-        writer.addObject(concept,
-                         box.x,
-                         box.y,
-                         box.x + box.width,
-                         box.y + box.height)
-        
     xml_path = output_dir / f"{image_data.uuid}.xml"
-    writer.save(xml_path)
+    write_voc(image_data, image_path, xml_path)
 
 
 def write_tree_metadata(tree: MyTree, name: str, output: Path):
     tree_file = output / f"{name}.tree"
-    pickle_file = output / f"{name}.pickle"
     tree.showToFile(tree_file, lambda n: f"{n.tag} ({n.data.count})")
-    with open(pickle_file, "wb") as f:
-        pickle.dump(tree, f)
+    # cleanupTree stores the subtree total in Count.count
+    save_tree(tree, name, output, accumulated=True)
+
 
+MAX_CONNECTIONS = 100
+MAX_PER_HOST = 32
+METADATA_WORKERS = 8
+HEADERS = {
+    "Accept-Encoding": "gzip, deflate, br",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:106.0) Gecko/20100101 Firefox/106.0"
+}
 
-async def download_tree(tree: MyTree, rootID, root_dir: Path):
-    async def _download_node(node, parent_dir):
+
+@dataclass
+class Throughput:
+    images: int = 0
+    bytes: int = 0
+    skipped: int = 0
+    errors: int = 0
+    start: float = field(default_factory=time.time)
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        return (f"{self.images} images, {self.bytes / 1e6:.1f} MB in {elapsed:.1f}s "
+                f"({self.images / elapsed:.1f} images/s, {self.bytes / 1e6 / elapsed:.2f} MB/s), "
+                f"{self.skipped} skipped, {self.errors} errors")
+
+
+class HostLimiter:
+    def __init__(self, limit=MAX_PER_HOST):
+        self.limit = limit
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def __call__(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.limit)
+        return self.semaphores[host]
+
+
+def make_session(timeout=60, max_connections=MAX_CONNECTIONS, max_per_host=MAX_PER_HOST):
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_per_host)
+    return aiohttp.ClientSession(connector=connector,
+                                 timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=timeout),
+                                 headers=HEADERS)
+
+
+def tree_download_dirs(tree: MyTree, rootID, root_dir: Path):
+    dirs = []
+    stack = [(c, root_dir) for c in reversed(tree.children(rootID))]
+    while stack:
+        node, parent_dir = stack.pop()
         concept = node.tag.split(')')[-1]
         if len(concept) == 0:
-            return
-        
+            continue
+
         new_dir = parent_dir / concept.replace(' ', '_')
-        new_dir.mkdir(parents=True, exist_ok=True)
-        images_data = download_images_data(concept)
-        
+        dirs.append((concept, new_dir))
+        stack.extend((c, new_dir) for c in reversed(tree.children(node.identifier)))
+    return dirs
+
+
+async def download_tree(session, tree: MyTree, rootID, root_dir: Path, manifest: DownloadManifest = None,
+                        limiter: HostLimiter = None, executor: ThreadPoolExecutor = None, stats: Throughput = None,
+                        budget: AsyncByteBudget = None, controller: AsyncAIMDController = None, writer: AnnotationWriter = None,
+                        workers=MAX_CONNECTIONS):
+    loop = asyncio.get_running_loop()
+    limiter = limiter or HostLimiter()
+    stats = stats or Throughput()
+    budget = budget or AsyncByteBudget()
+    controller = controller or AsyncAIMDController(maximum=MAX_CONNECTIONS)
+
+    # a fixed set of workers pulls images off a bounded queue instead of one coroutine per image of the class
+    queue = asyncio.Queue(maxsize=2 * workers)
+
+    async def _list_node(concept, new_dir):
+        # fathomnet-py is synchronous, keep its calls off the event loop
+        try:
+            await loop.run_in_executor(executor, partial(new_dir.mkdir, parents=True, exist_ok=True))
+            images_data = await loop.run_in_executor(executor, download_images_data, concept)
+        except Exception as e:
+            # one concept failing must not cancel the rest of the class
+            print(f"{concept}: image metadata failed {e}")
+            METRICS.inc("node_errors_total", downloader="async")
+            return new_dir, []
         print(f"{new_dir} ({len(images_data)})")
-        
-        timeout = aiohttp.ClientTimeout(total=15)
-        async with aiohttp.ClientSession(timeout=timeout, 
-                                         read_bufsize=5_000_000, 
-                                         headers={
-                                            "Accept-Encoding": "gzip, deflate, br",
-                                            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9",
-                                            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:106.0) Gecko/20100101 Firefox/106.0"
-                                         }) as session:
-            tasks = [download_and_annotate(session, data, new_dir) for data in images_data]
-            await asyncio.gather(*tasks)
-        
-        for c in tree.children(node.identifier):
-            await _download_node(c, new_dir)
-
-    for c in tree.children(rootID):
-       await _download_node(c, root_dir)
+        return new_dir, images_data
+
+    async def _worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            data, new_dir = item
+            try:
+                await download_and_annotate(session, data, new_dir, manifest, limiter, stats, budget, controller, writer)
+            except Exception as e:
+                stats.errors += 1
+                METRICS.inc("downloads_total", downloader="async", result="failed")
+                print(f"Download failed {data.url}: {e}")
+
+    tasks = [asyncio.create_task(_worker()) for _ in range(workers)]
+    try:
+        for listed in asyncio.as_completed([_list_node(concept, new_dir) for concept, new_dir in tree_download_dirs(tree, rootID, root_dir)]):
+            new_dir, images_data = await listed
+            for data in images_data:
+                await queue.put((data, new_dir))
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return stats
 
 
 async def random_sleep(min, max):
     wait = random.randint(min, max)/1000.0
-    time.sleep(wait)
+    await asyncio.sleep(wait)
     return wait
 
 
-async def download_and_annotate(session, image_data: AImageDTO, output_dir: Path):
+def save_annotation(image_data: AImageDTO, image_path: Path, output_dir: Path, size: int, checksum: str,
+                    manifest: DownloadManifest = None, writer: AnnotationWriter = None, block=True):
+    def _record():
+        if manifest is not None:
+            manifest.record(image_data.uuid, image_data.url, image_path, size, checksum)
+
+    if writer is None:
+        write_annotation(image_data, image_path, output_dir)
+        _record()
+    else:
+        # the manifest entry is only written once the xml is on disk
+        writer.submit(image_data, image_path, output_dir / f"{image_data.uuid}.xml", _record, block)
+
+
+async def download_and_annotate(session, image_data: AImageDTO, output_dir: Path, manifest: DownloadManifest = None,
+                                limiter: HostLimiter = None, stats: Throughput = None, budget: AsyncByteBudget = None,
+                                controller: AsyncAIMDController = None, writer: AnnotationWriter = None):
     url = image_data.url
     ext = Path(url).suffix
     uuid = image_data.uuid
     image_path = (output_dir / f"{uuid}{ext}")
-
-    for _ in range(2): # try for a few times
-        try:
-            resp = await session.get(url)
-
-            if resp.status == 200:
-                image_data = await resp.read()
-                with open(image_path, "wb") as f:
-                    f.write(image_data)
-                write_annotation(image_data, image_path, output_dir)
+    limiter = limiter or HostLimiter()
+    stats = stats or Throughput()
+    controller = controller or AsyncAIMDController()
+
+    if manifest is not None and manifest.is_complete(image_path):
+        stats.skipped += 1
+        METRICS.inc("downloads_total", downloader="async", result="skipped")
+        return
+
+    for attempt in range(RETRIES + 1): # try for a few times
+        fetched = None
+        async with controller.slot() as slot:
+            try:
+                async with limiter(url):
+                    start = time.monotonic()
+                    async with session.get(url) as resp:
+                        latency = time.monotonic() - start
+                        METRICS.observe("http_request_seconds", latency, endpoint="image", status=resp.status)
+                        if resp.status == 200:
+                            fetched = await astream_to_file(resp.content, image_path, budget, expected=resp.content_length)
+                            METRICS.observe("image_transfer_seconds", time.monotonic() - start - latency, downloader="async")
+                            slot.observe(resp.status, latency)
+                        else:
+                            slot.observe(resp.status, latency, retry_after_seconds(resp.headers.get("Retry-After")))
+                            if resp.status != 429 and resp.status < 500:
+                                print(f"Error getting {url}")
+                                stats.errors += 1
+                                METRICS.inc("downloads_total", downloader="async", result="failed")
+                                return
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                METRICS.inc("http_errors_total", endpoint="image", error=type(e).__name__)
+
+        if fetched:
+            size, checksum = fetched
+            if writer is None:
+                await asyncio.to_thread(save_annotation, image_data, image_path, output_dir, size, checksum, manifest)
             else:
-                print(f"Error getting {url}")
-            
+                try:
+                    save_annotation(image_data, image_path, output_dir, size, checksum, manifest, writer, block=False)
+                except Full:
+                    # the writer is behind, wait for queue space off the event loop
+                    METRICS.inc("annotation_queue_full_total", downloader="async")
+                    await asyncio.to_thread(save_annotation, image_data, image_path, output_dir, size, checksum, manifest, writer)
+            stats.images += 1
+            stats.bytes += size
+            METRICS.inc("downloads_total", downloader="async", result="downloaded")
+            METRICS.inc("download_bytes_total", size, downloader="async")
             return # early termination if reponse received
-        except asyncio.exceptions.TimeoutError:
-            continue
+        if attempt < RETRIES:
+            await asyncio.sleep(backoff_delay(attempt))
     
+    stats.errors += 1
+    METRICS.inc("downloads_total", downloader="async", result="failed")
     print(f"Time out getting {url}")
 
 
-
 async def main(class_concept_lkup):
-    for clsname, concepts in class_concept_lkup.items():
-        class_dir = output_dir / clsname
-        tree = buildConceptsTree(concepts, 0, clsname, True)
-        write_tree_metadata(tree, clsname, metadata_dir)
-        await download_tree(tree, 0, class_dir)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=METADATA_WORKERS)
+    limiter = HostLimiter()
+    budget = AsyncByteBudget()
+    controller = AsyncAIMDController(maximum=MAX_CONNECTIONS)
+
+    trees = {}
+    with stage("tree"):
+        for clsname, concepts in class_concept_lkup.items():
+            tree = await loop.run_in_executor(executor, buildConceptsTree, concepts, 0, clsname, True)
+            if not tree:
+                print(f"{clsname}: no images")
+                continue
+            write_tree_metadata(tree, clsname, metadata_dir)
+            trees[clsname] = tree
+
+    with DownloadManifest(output_dir) as manifest:
+        print(f"Resuming from manifest: {manifest.progress()}")
+        stats = Throughput()
+        writer = AnnotationWriter()
+
+        def _gauges(metrics):
+            metrics.set("rate_limit", controller.limit, downloader="async")
+            metrics.set("rate_inflight", controller.inflight, downloader="async")
+            metrics.set("annotation_queue_depth", writer.queue.qsize(), downloader="async")
+            metrics.set("metadata_queue_depth", executor._work_queue.qsize(), downloader="async")
+        METRICS.add_collector(_gauges)
+
+        with stage("download"):
+            async with make_session() as session:
+                await asyncio.gather(*[download_tree(session, tree, 0, output_dir / clsname, manifest, limiter, executor, stats, budget, controller, writer)
+                                       for clsname, tree in trees.items()])
+            await asyncio.to_thread(writer.close)
+        print(f"Done: {manifest.progress()}")
+        print(stats.summary())
+        print(f"Rate control: {controller.stats()}")
+    executor.shutdown()
 
 
 if __name__ == "__main__":
+    sys.argv = cli(sys.argv)
     input_file = sys.argv[1]
     output_dir = sys.argv[2]
     output_dir = Path(output_dir)
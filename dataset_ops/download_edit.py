@@ -1,18 +1,22 @@
 from dataclasses import dataclass
 from typing_extensions import override
-from fathomnet.api import boundingboxes, images, taxa
+from fathomnet.api import boundingboxes, taxa
 from fathomnet.models import *
-from pascal_voc_writer import Writer
+from voc_writer import write_voc
+from fathomnet_cache import CacheMiss, find_by_concept, phylogeny_down
+from rate_control import retry_call
+from metrics import cli, stage
+from compact_tree import CompactTree
+from tree_metadata import save_tree
+from concept_counts import fetch_counts, node_concept, MAX_WORKERS
+from taxa_explorer import explore_taxa
 import treelib
 from treelib import Tree
 
-import asyncio, aiohttp
-
-from tqdm import tqdm
 from pathlib import Path
 from typing import *
 from urllib.request import urlretrieve
-import json, pickle, random, sys, time, urllib3
+import json, sys
 
 
 def buildTree(concept: Taxa, provider='fathomnet', trimEmpty = True):
@@ -50,40 +54,16 @@ def buildTree(concept: Taxa, provider='fathomnet', trimEmpty = True):
     return tree
 
 
-def buildTreeBetter(_taxa: Taxa, provider='fathomnet'):
-    searchSpace = []
-    leaves = set()
-    
-    def exploreSearchSpace(t: Taxa, parent):
-        searchSpace.append((t, parent))
-        new_parent = f"{parent}__{t.name.replace(' ', '_')}"
-        children = taxa.find_children(provider, t.name)
-
-        if len(children) == 0:
-            leaves.add(f"{t.rank}-{t.name}")
-
-
-        for c in children:
-            exploreSearchSpace(c, new_parent)
-
-   
-    exploreSearchSpace(_taxa, "0")
-    print(f"Search space size: {len(searchSpace)} / {len(leaves)} leaves")
+def buildTreeBetter(_taxa: Taxa, provider='fathomnet', max_workers=MAX_WORKERS):
+    nodes, leaves, counts = explore_taxa(_taxa, provider, max_workers)
 
     tree = Tree()
-    tree.create_node("ROOT", "0", data = 0) 
-
-    for t, parent in tqdm(searchSpace):
-        children_image_count = boundingboxes.count_by_concept(t.name).count
-
-        if children_image_count == 0 and (f"{t.rank}-{t.name}" in leaves):
+    tree.create_node("ROOT", "0", data = Count(0, 0))
+    for t, parent, nid in nodes:
+        if counts[t.name] == 0 and nid in leaves:
             continue
+        tree.create_node(f"{t.rank} - {t.name}", nid, parent, Count(counts[t.name], 0))
 
-        try:
-            tree.create_node(f"{t.rank} - {t.name}", f"{parent}__{t.name.replace(' ', '_')}", parent, children_image_count)
-        except treelib.exceptions.DuplicatedNodeIdError:
-            print(f"skip duplicate: {parent}__{t.name}")
-    
     cleanupTree(tree, "0")
 
     return tree
@@ -107,27 +87,25 @@ class Count:
 
 
 def cleanupTree(tree: Tree, nid):
-    total = tree.get_node(nid).data.count
-    for cid in [c.identifier for c in tree.children(nid)]:
-        total += cleanupTree(tree, cid)
-    
-    children = [c.identifier for c in tree.children(nid)]
-    if len(children) == 0 and not total:
+    compact, ids = CompactTree.from_tree(tree, nid)
+    total = compact.accumulate()
+    if not total:
         tree.remove_node(nid)
         return 0
-    else:
-        tree.get_node(nid).data.accumulated_count = total
-        return total
+
+    for i, identifier in enumerate(ids):
+        if compact.accumulated[i]:
+            tree.get_node(identifier).data.accumulated_count = compact.accumulated[i]
+        elif compact.accumulated[compact.parent[i]]:
+            tree.remove_node(identifier)
+    return total
 
 
 def build_phylogeny(conceptName: str, tree: Tree = None, rootID = 0, rootTag = 'ROOT'):
-    http = urllib3.PoolManager()
-    req = http.request('GET', f"https://fathomnet.org/dsg/phylogeny/down/{conceptName}")
-    if req.status >= 300:
+    dsg_data = phylogeny_down(conceptName)
+    if dsg_data is None:
         print("Failed to connect to fathomnet phylogeny")
         return None
-    
-    dsg_data = json.loads(req.data)
 
     if not tree:
         tree = MyTree()
@@ -149,20 +127,11 @@ def build_phylogeny(conceptName: str, tree: Tree = None, rootID = 0, rootTag = '
     return tree
 
 
-def add_counts_to_tree(phylenogy: Tree):
-    progress = tqdm(enumerate(list(phylenogy.all_nodes())))
-    for _, n in progress:
-        if n.identifier == 0:
-            continue
-
-        concept = n.tag.split(')')[-1].strip()
-        if len(concept) == 0:
-            continue
-    
-        progress.set_postfix_str(concept)
-
-        count = boundingboxes.count_by_concept(concept).count
-        phylenogy.get_node(n.identifier).data.count = count
+def add_counts_to_tree(phylenogy: Tree, max_workers=MAX_WORKERS):
+    nodes = [n for n in phylenogy.all_nodes() if n.identifier != 0 and len(node_concept(n)) > 0]
+    counts = fetch_counts([node_concept(n) for n in nodes], max_workers=max_workers)
+    for n in nodes:
+        n.data.count = counts[node_concept(n)]
 
 
 def build_concepts_tree(concepts: List[str], rootID: str, rootTag: Any, includeImgCount=False):
@@ -183,7 +152,7 @@ def build_concepts_tree(concepts: List[str], rootID: str, rootTag: Any, includeI
 
 
 def download_images_data(concept):
-    return images.find_by_concept(concept, 'fathomnet')
+    return retry_call(find_by_concept, concept, 'fathomnet', giveup=(CacheMiss,))
 
 
 def download_image(image_data: AImageDTO, output_dir: Path):
@@ -196,32 +165,18 @@ def download_image(image_data: AImageDTO, output_dir: Path):
 
 
 def write_annotation(image_data: AImageDTO, image_path: Path, output_dir: Path):
-    writer = Writer(image_path, 
-                    image_data.width,
-                    image_data.height,
-                    database='FathomNet')
-    
-    for box in image_data.boundingBoxes:
-        concept = box.concept
-        writer.addObject(concept,
-                         box.x,
-                         box.y,
-                         box.x + box.width,
-                         box.y + box.height)
-        
     xml_path = output_dir / f"{image_data.uuid}.xml"
-    writer.save(xml_path)
+    write_voc(image_data, image_path, xml_path)
 
 
 def write_tree_metadata(tree: MyTree, name: str, output: Path):
     tree_file = output / f"{name}.tree"
-    pickle_file = output / f"{name}.pickle"
     tree.showToFile(tree_file, lambda n: f"{n.tag} ({n.data.count})")
-    with open(pickle_file, "wb") as f:
-        pickle.dump(tree, f)
+    save_tree(tree, name, output)
 
 
 if __name__ == "__main__":
+    sys.argv = cli(sys.argv)
     input_file = sys.argv[1]
 
     with open(input_file, "r") as f:
@@ -229,12 +184,12 @@ if __name__ == "__main__":
 
     for clsname, concepts in class_concept_lkup.items():
         print(clsname)
-        t = build_concepts_tree(concepts, 0, clsname, True)
+        with stage("tree"):
+            t = build_concepts_tree(concepts, 0, clsname, True)
         if not t:
             continue
 
         t.showToFile(f"{clsname}.tree", lambda n: f"{n.tag} ({n.data.count}/{n.data.accumulated_count})")
-        with open(f"{clsname}.pickle", "wb") as f:
-            pickle.dump(t, f)
+        save_tree(t, clsname, Path("."))
         
 
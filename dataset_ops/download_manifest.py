@@ -0,0 +1,129 @@
+from pathlib import Path
+from typing import *
+import hashlib, json, os, sys, threading, time
+
+
+def file_sha256(path: Path, chunk_size=1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DownloadManifest:
+    FILENAME = ".manifest.jsonl"
+
+    def __init__(self, root: Path, sync_every=256, sync_interval=5.0):
+        self.root = Path(root)
+        self.path = self.root / self.FILENAME
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_sync = time.time()
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._load()
+        self._file = open(self.path, "a")
+        if self._file.tell() > 0 and not self._ends_with_newline():
+            self._file.write("\n")
+
+    def _ends_with_newline(self):
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _load(self):
+        if not self.path.exists():
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the tail of the journal may be cut short by a crash
+                    continue
+                self.entries[entry['path']] = entry
+
+    def key(self, image_path: Path) -> str:
+        return Path(image_path).relative_to(self.root).as_posix()
+
+    def get(self, image_path: Path) -> Optional[dict]:
+        return self.entries.get(self.key(image_path))
+
+    def is_complete(self, image_path: Path) -> bool:
+        entry = self.get(image_path)
+        if entry is None or not entry['annotated']:
+            return False
+
+        # a size mismatch means the file was truncated or replaced after it was recorded
+        try:
+            return os.stat(image_path).st_size == entry['size']
+        except FileNotFoundError:
+            return False
+
+    def record(self, uuid: str, url: str, image_path: Path, size: int, checksum: Optional[str], annotated=True):
+        # checksum is None for linked files that were never read, fill_checksums hashes them later
+        entry = dict(uuid=uuid, url=url, path=self.key(image_path), size=size, sha256=checksum, annotated=annotated)
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.entries[entry['path']] = entry
+            self._pending += 1
+            if self._pending >= self.sync_every or time.time() - self._last_sync > self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def fill_checksums(self) -> int:
+        filled = 0
+        for entry in list(self.entries.values()):
+            if entry['sha256'] is not None:
+                continue
+            path = self.root / entry['path']
+            if not path.exists():
+                continue
+            self.record(entry['uuid'], entry['url'], path, path.stat().st_size, file_sha256(path), entry['annotated'])
+            filled += 1
+        return filled
+
+    def progress(self) -> dict:
+        entries = self.entries.values()
+        return dict(
+            recorded=len(self.entries),
+            annotated=sum(1 for e in entries if e['annotated']),
+            images=len({e['uuid'] for e in entries}),
+            bytes=sum(e['size'] for e in entries),
+        )
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Syntax: {sys.argv[0]} <output_dir> [--checksums]")
+        sys.exit(1)
+
+    with DownloadManifest(Path(sys.argv[1])) as manifest:
+        if "--checksums" in sys.argv[2:]:
+            print(f"{manifest.fill_checksums()} checksums filled in")
+        progress = manifest.progress()
+    print(f"{manifest.path}: {progress['annotated']}/{progress['recorded']} annotated, "
+          f"{progress['images']} unique images, {progress['bytes'] / 1e6:.1f} MB")
@@ -1,19 +1,29 @@
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures._base import TimeoutError as cfTimeoutEror
 from dataclasses import dataclass
-from fathomnet.api import boundingboxes, images, taxa
+from fathomnet.api import boundingboxes, taxa
 from fathomnet.models import Taxa
 from fathomnet.models import *
-from pascal_voc_writer import Writer
+from voc_writer import write_voc
+from fathomnet_cache import CacheMiss, find_by_concept, phylogeny_down
+from compact_tree import CompactTree
+from tree_metadata import save_tree
+from download_manifest import DownloadManifest
+from cache_index import CacheIndex, link_or_copy
+from streaming import BYTE_BUDGET, CHUNK_SIZE, content_length, stream_to_file
+from rate_control import AIMDController, RETRIES, backoff_delay, retry_after_seconds, retry_call
+from blob_store import BlobStore
+from concept_counts import fetch_counts, node_concept, MAX_WORKERS
+from taxa_explorer import explore_taxa
+from image_prefetch import ImageTable, prefetch
+from metrics import METRICS, cli, stage
 import requests
 import shutil
 
-from tqdm import tqdm
 from pathlib import Path
 import treelib
 from treelib import Tree
 from typing import *
-import json, pickle, sys, urllib3
+import json, sys, threading, time
 
 
 def buildTree(concept: Taxa, provider='fathomnet', trimEmpty = True):
@@ -51,40 +61,16 @@ def buildTree(concept: Taxa, provider='fathomnet', trimEmpty = True):
     return tree
 
 
-def buildTreeBetter(_taxa: Taxa, provider='fathomnet'):
-    searchSpace = []
-    leaves = set()
-    
-    def exploreSearchSpace(t: Taxa, parent):
-        searchSpace.append((t, parent))
-        new_parent = f"{parent}__{t.name.replace(' ', '_')}"
-        children = taxa.find_children(provider, t.name)
-
-        if len(children) == 0:
-            leaves.add(f"{t.rank}-{t.name}")
-
-
-        for c in children:
-            exploreSearchSpace(c, new_parent)
-
-   
-    exploreSearchSpace(_taxa, "0")
-    print(f"Search space size: {len(searchSpace)} / {len(leaves)} leaves")
+def buildTreeBetter(_taxa: Taxa, provider='fathomnet', max_workers=MAX_WORKERS):
+    nodes, leaves, counts = explore_taxa(_taxa, provider, max_workers)
 
     tree = Tree()
-    tree.create_node("ROOT", "0", data = 0) 
-
-    for t, parent in tqdm(searchSpace):
-        children_image_count = boundingboxes.count_by_concept(t.name).count
-
-        if children_image_count == 0 and (f"{t.rank}-{t.name}" in leaves):
+    tree.create_node("ROOT", "0", data = Count(0, 0))
+    for t, parent, nid in nodes:
+        if counts[t.name] == 0 and nid in leaves:
             continue
+        tree.create_node(f"{t.rank} - {t.name}", nid, parent, Count(counts[t.name], 0))
 
-        try:
-            tree.create_node(f"{t.rank} - {t.name}", f"{parent}__{t.name.replace(' ', '_')}", parent, children_image_count)
-        except treelib.exceptions.DuplicatedNodeIdError:
-            print(f"skip duplicate: {parent}__{t.name}")
-    
     cleanupTree(tree, "0")
 
     return tree
@@ -108,32 +94,36 @@ class Count:
 
 
 def cleanupTree(tree: Tree, nid):
-    total = tree.get_node(nid).data.count
-    for cid in [c.identifier for c in tree.children(nid)]:
-        total += cleanupTree(tree, cid)
-    
-    children = [c.identifier for c in tree.children(nid)]
-    if len(children) == 0 and not total:
+    compact, ids = CompactTree.from_tree(tree, nid)
+    total = compact.accumulate()
+    if not total:
         tree.remove_node(nid)
         return 0
-    else:
-        tree.get_node(nid).data.accumulated_count = total
-        return total
+
+    for i, identifier in enumerate(ids):
+        if compact.accumulated[i]:
+            tree.get_node(identifier).data.accumulated_count = compact.accumulated[i]
+        elif compact.accumulated[compact.parent[i]]:
+            tree.remove_node(identifier)
+    return total
 
 
 def build_phylogeny(conceptName: str, tree: Tree = None, rootID = 0, rootTag = 'ROOT'):
-    http = urllib3.PoolManager()
-    req = http.request('GET', f"https://fathomnet.org/dsg/phylogeny/down/{conceptName}")
-    if req.status >= 300:
+    dsg_data = phylogeny_down(conceptName)
+    if dsg_data is None:
         print("Failed to connect to fathomnet phylogeny")
         return None
-    
-    dsg_data = json.loads(req.data)
 
     if not tree:
         tree = MyTree()
         tree.create_node(rootTag, rootID, data=Count(0, 0))
-    
+
+    add_phylogeny(dsg_data, tree, rootID)
+
+    return tree
+
+
+def add_phylogeny(dsg_data: dict, tree: Tree, parent):
     def _buildTree(json_data, parent, tree: Tree):
         rank = json_data.get('rank') or 'unknown'
         
@@ -145,25 +135,14 @@ def build_phylogeny(conceptName: str, tree: Tree = None, rootID = 0, rootTag = '
             for c in json_data["children"]:
                 _buildTree(c, id, tree)
 
-    _buildTree(dsg_data, rootID, tree)
+    _buildTree(dsg_data, parent, tree)
 
-    return tree
-
-
-def add_counts_to_tree(phylenogy: Tree):
-    progress = tqdm(enumerate(list(phylenogy.all_nodes())))
-    for _, n in progress:
-        if n.identifier == 0:
-            continue
-
-        concept = n.tag.split(')')[-1].strip()
-        if len(concept) == 0:
-            continue
-    
-        progress.set_postfix_str(concept)
 
-        count = boundingboxes.count_by_concept(concept).count
-        phylenogy.get_node(n.identifier).data.count = count
+def add_counts_to_tree(phylenogy: Tree, max_workers=MAX_WORKERS):
+    nodes = [n for n in phylenogy.all_nodes() if n.identifier != 0 and len(node_concept(n)) > 0]
+    counts = fetch_counts([node_concept(n) for n in nodes], max_workers=max_workers)
+    for n in nodes:
+        n.data.count = counts[node_concept(n)]
 
 
 def build_concepts_tree(concepts: List[str], rootID: str, rootTag: Any, includeImgCount=False):
@@ -183,29 +162,97 @@ def build_concepts_tree(concepts: List[str], rootID: str, rootTag: Any, includeI
     return tree
 
 
+def index_phylogeny(dsg_data: dict, index: Dict[str, dict]):
+    stack = [dsg_data]
+    while stack:
+        json_data = stack.pop()
+        index.setdefault(json_data['name'], json_data)
+        stack.extend(json_data.get("children", []))
+
+
+def plan_concepts_trees(class_concept_lkup: Dict[str, List[str]], rootID = 0, includeImgCount=False):
+    # fetch each distinct phylogeny once, concepts already inside a fetched subtree are carved out of it
+    index = {}
+    requested = 0
+    fetched = 0
+    for concepts in class_concept_lkup.values():
+        for c in concepts:
+            requested += 1
+            if c in index:
+                continue
+
+            dsg_data = phylogeny_down(c)
+            fetched += 1
+            if dsg_data is None:
+                print(f"Failed to fetch phylogeny of {c}")
+                continue
+            index_phylogeny(dsg_data, index)
+
+    trees = {}
+    for clsname, concepts in class_concept_lkup.items():
+        tree = MyTree()
+        tree.create_node(clsname, rootID, data=Count(0, 0))
+        for c in concepts:
+            if c in index:
+                add_phylogeny(index[c], tree, rootID)
+        trees[clsname] = tree
+
+    stats = dict(phylogeny_requested=requested, phylogeny_fetched=fetched, count_requested=0, count_fetched=0)
+    if includeImgCount:
+        nodes = [(t, n) for t in trees.values() for n in t.all_nodes() if n.identifier != rootID and len(node_concept(n)) > 0]
+        counts = fetch_counts([node_concept(n) for _, n in nodes])
+        for _, n in nodes:
+            n.data.count = counts[node_concept(n)]
+        for t in trees.values():
+            cleanupTree(t, rootID)
+        stats.update(count_requested=len(nodes), count_fetched=len(counts))
+
+    saved = stats['phylogeny_requested'] - stats['phylogeny_fetched'] + stats['count_requested'] - stats['count_fetched']
+    print(f"Phylogeny: {fetched}/{requested} fetched, counts: {stats['count_fetched']}/{stats['count_requested']} fetched, {saved} remote calls saved")
+    stats['saved'] = saved
+    return trees, stats
+
+
 def download_images_data(concept):
-    return images.find_by_concept(concept)
+    return retry_call(find_by_concept, concept, giveup=(CacheMiss,))
 
 
 def write_annotation(image_data: AImageDTO, image_path: Path, output_dir: Path):
-    writer = Writer(image_path, 
-                    image_data.width,
-                    image_data.height,
-                    database='FathomNet')
-    
-    for box in image_data.boundingBoxes:
-        concept = box.concept
-        writer.addObject(concept,
-                         box.x,
-                         box.y,
-                         box.x + box.width,
-                         box.y + box.height)
-        
     xml_path = output_dir / f"{image_data.uuid}.xml"
-    writer.save(xml_path)
+    write_voc(image_data, image_path, xml_path)
 
 
-def download_and_annotate(image_data: AImageDTO, output_dir: Path, cached_dir: Path = None):
+CONTROLLER = AIMDController(initial=8, maximum=64)
+
+
+def _controller_gauges(metrics):
+    metrics.set("rate_limit", CONTROLLER.limit, downloader="threaded")
+    metrics.set("rate_inflight", CONTROLLER.inflight, downloader="threaded")
+
+
+METRICS.add_collector(_controller_gauges)
+
+
+def _nonempty(path: Path) -> bool:
+    try:
+        return path.stat().st_size > 0
+    except FileNotFoundError:
+        return False
+
+
+def copy_cached_xml(cached_xml: Path, metadata_path: Path) -> bool:
+    # annotations get rewritten in place by fix_xmls, so never share them with the cache
+    try:
+        shutil.copy(str(cached_xml), str(metadata_path))
+        return True
+    except FileNotFoundError:
+        # the cache index only notices removals when a directory's mtime changes
+        print(f"{cached_xml}: missing from the cache, writing the annotation instead")
+        return False
+
+
+def download_and_annotate(image_data: AImageDTO, output_dir: Path, cache_index: CacheIndex = None, manifest: DownloadManifest = None,
+                          timeout: float = None, blob_store: BlobStore = None):
     url = image_data.url
     ext = Path(url).suffix
     uuid = image_data.uuid
@@ -214,71 +261,195 @@ def download_and_annotate(image_data: AImageDTO, output_dir: Path, cached_dir: P
     image_path = output_dir / image_filename
     metadata_path = output_dir / metadata_filename
     
-    if image_path.exists():
+    if manifest is not None:
+        if manifest.is_complete(image_path):
+            METRICS.inc("downloads_total", downloader="threaded", result="skipped")
+            return 0
+        if _nonempty(image_path) and _nonempty(metadata_path):
+            # left by a run without a manifest, adopt it instead of downloading it again
+            manifest.record(uuid, url, image_path, image_path.stat().st_size, None)
+            METRICS.inc("downloads_total", downloader="threaded", result="skipped")
+            return 0
+    elif image_path.exists():
+        METRICS.inc("downloads_total", downloader="threaded", result="skipped")
         return 0
 
-    if cached_dir:
-        cached_images = cached_dir.glob(f"**/{image_filename}")
-        for f in cached_images:
-            metadata_path_cached = f.parent / metadata_filename
-            if metadata_path_cached.exists():
-                shutil.copy(str(f), str(image_path))
-                shutil.copy(str(metadata_path_cached), str(metadata_path))
-                return 0
-        
-    resp = requests.get(url)
-    
-    if resp.status_code == 200:
-        with open(image_path, "wb") as f:
-            f.write(resp.content)
-        write_annotation(image_data, image_path, output_dir)
+    cached_image = cache_index.lookup(uuid) if cache_index else None
+    if cached_image and not cached_image.exists():
+        cached_image = None
+
+    def _fetch(path: Path):
+        if cached_image:
+            # seeding only links, hashing every cached image would cost a full read of the cache
+            link_or_copy(cached_image, path)
+            return path.stat().st_size, None
+        return fetch_image(url, path, deadline=time.monotonic() + timeout if timeout else None)
+
+    if blob_store is not None:
+        # every uuid is fetched once into the store and linked into each concept directory
+        fetched = blob_store.get_or_fetch(uuid, ext, _fetch)
+        if fetched:
+            blob, *fetched = fetched
+            blob_store.materialise(blob, image_path)
     else:
-        print(f"Error fetching {url}.")
+        fetched = _fetch(image_path)
+
+    if not fetched:
+        METRICS.inc("downloads_total", downloader="threaded", result="failed")
+        return 0
+
+    size, checksum = fetched
+    METRICS.inc("downloads_total", downloader="threaded", result="cached" if cached_image else "downloaded")
+    if not (cached_image and copy_cached_xml(cached_image.parent / metadata_filename, metadata_path)):
+        write_annotation(image_data, image_path, output_dir)
+    if manifest is not None:
+        manifest.record(uuid, url, image_path, size, checksum)
     
     return 0;
-    
 
-def write_tree_metadata(tree: MyTree, name: str, output: Path):
-    tree_file = output / f"{name}.tree"
-    pickle_file = output / f"{name}.pickle"
-    tree.showToFile(tree_file, lambda n: f"{n.tag} ({n.data.count})")
-    with open(pickle_file, "wb") as f:
-        pickle.dump(tree, f)
 
+def download_placements(image_data: AImageDTO, output_dirs: List[Path], cache_index: CacheIndex = None,
+                        manifest: DownloadManifest = None, timeout: float = None, blob_store: BlobStore = None):
+    # one job per uuid, the blob is fetched once and linked into every directory while it stays pinned
+    if blob_store is None:
+        for output_dir in output_dirs:
+            download_and_annotate(image_data, output_dir, cache_index, manifest, timeout)
+        return 0
+    with blob_store.pinned(image_data.uuid):
+        for output_dir in output_dirs:
+            download_and_annotate(image_data, output_dir, cache_index, manifest, timeout, blob_store)
+    return 0
 
-def repeat(x):
-    while True:
-        yield x
 
+def fetch_image(url: str, image_path: Path, controller: AIMDController = CONTROLLER, retries=RETRIES, deadline: float = None):
+    for attempt in range(retries + 1):
+        if deadline is not None and time.monotonic() > deadline:
+            break
 
-def download_tree(tree: MyTree, rootID, root_dir: Path, cached_dir: Path=None):
-    def _download_node(node, download_dir):
+        with controller.slot() as slot:
+            try:
+                with requests.get(url, stream=True, timeout=(10, 60)) as resp:
+                    METRICS.observe("http_request_seconds", resp.elapsed.total_seconds(), endpoint="image", status=resp.status_code)
+                    if resp.status_code == 200:
+                        with METRICS.timer("image_transfer_seconds", downloader="threaded"):
+                            fetched = stream_to_file(resp.iter_content(CHUNK_SIZE), image_path, BYTE_BUDGET, deadline=deadline,
+                                                     expected=content_length(resp.headers.get("Content-Length")))
+                        slot.observe(resp.status_code, resp.elapsed.total_seconds())
+                        METRICS.inc("download_bytes_total", fetched[0], downloader="threaded")
+                        return fetched
+
+                    slot.observe(resp.status_code, resp.elapsed.total_seconds(), retry_after_seconds(resp.headers.get("Retry-After")))
+                    if resp.status_code != 429 and resp.status_code < 500:
+                        break
+            except (requests.RequestException, TimeoutError) as e:
+                METRICS.inc("http_errors_total", endpoint="image", error=type(e).__name__)
+                print(f"Error fetching {url}: {e}")
+        if attempt < retries:
+            time.sleep(backoff_delay(attempt))
+
+    print(f"Error fetching {url}.")
+    return None
+    
+
+def write_tree_metadata(tree: MyTree, name: str, output: Path):
+    tree_file = output / f"{name}.tree"
+    tree.showToFile(tree_file, lambda n: f"{n.tag} ({n.data.count})")
+    save_tree(tree, name, output)
+
+
+MAX_DOWNLOAD_WORKERS = 40
+JOB_TIMEOUT = 300
+
+
+class DownloadQueue:
+    # one long-lived pool for the whole run, the producer blocks once max_pending jobs are queued
+    def __init__(self, max_workers=MAX_DOWNLOAD_WORKERS, max_pending=None, job_timeout=JOB_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.job_timeout = job_timeout
+        self._slots = threading.BoundedSemaphore(max_pending or 4 * max_workers)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        METRICS.add_collector(self._gauges)
+
+    def _gauges(self, metrics):
+        metrics.set("download_queue_depth", self.submitted - self.done, downloader="threaded")
+
+    def _submit(self, func: Callable, *args):
+        self._slots.acquire()
+        with self._lock:
+            self.submitted += 1
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def submit(self, image_data: AImageDTO, output_dir: Path, cache_index: CacheIndex = None, manifest: DownloadManifest = None,
+               blob_store: BlobStore = None):
+        return self._submit(download_and_annotate, image_data, output_dir, cache_index, manifest, self.job_timeout, blob_store)
+
+    def submit_placements(self, image_data: AImageDTO, output_dirs: List[Path], cache_index: CacheIndex = None,
+                          manifest: DownloadManifest = None, blob_store: BlobStore = None):
+        return self._submit(download_placements, image_data, output_dirs, cache_index, manifest, self.job_timeout, blob_store)
+
+    def _done(self, future):
+        self._slots.release()
+        with self._lock:
+            self.done += 1
+            if future.exception() is not None:
+                self.failed += 1
+                print(f"Download failed: {future.exception()}")
+
+    def join(self):
+        self.executor.shutdown(wait=True)
+        print(f"Downloads: {self.done}/{self.submitted} done, {self.failed} failed")
+
+
+def download_tree(tree: MyTree, rootID, root_dir: Path, cache_index: CacheIndex=None, manifest: DownloadManifest=None,
+                  queue: DownloadQueue=None, blob_store: BlobStore=None):
+    own_queue = queue is None
+    if own_queue:
+        queue = DownloadQueue()
+
+    stack = [(c, root_dir) for c in reversed(tree.children(rootID))]
+    while stack:
+        node, download_dir = stack.pop()
         concept = node.tag.split(')')[-1]
         if len(concept)==0:
-            return
+            continue
         
         new_path = download_dir / concept.replace(' ', '_')        
         new_path.mkdir(parents=True, exist_ok=True)
         images_data = download_images_data(concept)
         
         print(f"{concept}: {new_path} ({len(images_data)})")
+        for image_data in images_data:
+            queue.submit(image_data, new_path, cache_index, manifest, blob_store)
         
-        executor = ThreadPoolExecutor(max_workers=40)
-        try:
-            [x for x in executor.map(download_and_annotate, images_data, repeat(new_path), repeat(cached_dir), timeout=30+len(images_data))]
-        except cfTimeoutEror as e:
-            print(f"Timeout: {e}")
-        
-        for c in tree.children(node.identifier):
-            _download_node(c, new_path)
+        stack.extend((c, new_path) for c in reversed(tree.children(node.identifier)))
+
+    if own_queue:
+        queue.join()
+
 
-    for c in tree.children(rootID):
-        _download_node(c, root_dir)
+def download_table(table: ImageTable, queue: DownloadQueue, cache_index: CacheIndex=None, manifest: DownloadManifest=None,
+                   blob_store: BlobStore=None):
+    # the whole run is known up front, every concept directory and every (image, directory) pair
+    for d in table.dirs:
+        (table.root / d).mkdir(parents=True, exist_ok=True)
+
+    total = len(table)
+    for n, (image_data, download_dirs) in enumerate(table.work_list(), 1):
+        queue.submit_placements(image_data, download_dirs, cache_index, manifest, blob_store)
+        if n % 1000 == 0 or n == total:
+            print(f"scheduled {n}/{total} images")
 
 
 if __name__ == "__main__":
+    sys.argv = cli(sys.argv)
     input_file = sys.argv[1]
     output_dir = sys.argv[2]
+    cached_dir = None
     if len(sys.argv) > 3:
         cached_dir = Path(sys.argv[3])
     output_dir = Path(output_dir)
@@ -290,12 +461,32 @@ if __name__ == "__main__":
         class_concept_lkup = json.load(f)
 
     print(class_concept_lkup)
+    with stage("tree"):
+        trees, _ = plan_concepts_trees(class_concept_lkup, 0, True)
+    for clsname in [c for c, t in trees.items() if not t]:
+        print(f"{clsname}: no images")
+        del trees[clsname]
+
+    cache_index = None
+    if cached_dir:
+        cache_index = CacheIndex(cached_dir)
+        cache_index.refresh()
+        cache_index.save()
     
-    for clsname, concepts in class_concept_lkup.items():
-        print(clsname)
-        class_dir = output_dir / clsname.replace(' ', '_')
-        tree = build_concepts_tree(concepts, 0, clsname, True)
-        tree.show(lambda n: f"{n.tag} ({n.data.count})", print)
-        write_tree_metadata(tree, clsname.replace(' ', '_'), metadata_dir)
-        download_tree(tree, 0, class_dir, cached_dir=cached_dir)
+    with DownloadManifest(output_dir) as manifest:
+        print(f"Resuming from manifest: {manifest.progress()}")
+        queue = DownloadQueue()
+        blob_store = BlobStore(output_dir)
+        for clsname, tree in trees.items():
+            print(clsname)
+            tree.show(lambda n: f"{n.tag} ({n.data.count})", print)
+            write_tree_metadata(tree, clsname.replace(' ', '_'), metadata_dir)
+
+        with stage("prefetch"):
+            table = prefetch(trees, output_dir)
+        print(f"Work list: {table.summary()}")
+        with stage("download"):
+            download_table(table, queue, cache_index=cache_index, manifest=manifest, blob_store=blob_store)
+            queue.join()
+        print(f"Done: {manifest.progress()}, blobs: {blob_store.stats()}")
 
@@ -0,0 +1,221 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import *
+from urllib.parse import unquote, urlparse
+import hashlib, json, random, struct, sys, threading, time, zlib
+
+
+RANKS = ["class", "order", "family", "genus", "species", "subspecies"]
+
+
+def make_png(width: int, height: int, seed: int = 0) -> bytes:
+    # a small gradient, filtered rows compress well so large images stay cheap to serve
+    def _chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    row = bytes(b for x in range(width) for v in [(x * 255 // max(1, width - 1) + seed) % 256]
+                for b in (v, (v + 85) % 256, (v + 170) % 256))
+    raw = (b"\x00" + row) * height
+    return (b"\x89PNG\r\n\x1a\n"
+            + _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + _chunk(b"IDAT", zlib.compress(raw, 6))
+            + _chunk(b"IEND", b""))
+
+
+class Taxonomy:
+    # classes C0..Cn, every node has `fanout` children down to `depth`, names are "C0-1-2"
+    def __init__(self, classes=2, depth=3, fanout=3, images_per_node=4, boxes_per_image=2, image_size=(640, 480),
+                 overlap=0.25, seed=0):
+        self.image_size = image_size
+        self.nodes: Dict[str, dict] = {}
+        self.images: Dict[str, dict] = {}
+        self.by_concept: Dict[str, List[str]] = {}
+        rng = random.Random(seed)
+
+        def _add(name, parent, level):
+            self.nodes[name] = dict(name=name, rank=RANKS[min(level, len(RANKS) - 1)], parent=parent, children=[])
+            if parent:
+                self.nodes[parent]["children"].append(name)
+            if level < depth:
+                for i in range(fanout):
+                    _add(f"{name}-{i}", name, level + 1)
+
+        self.roots = [f"C{c}" for c in range(classes)]
+        for r in self.roots:
+            _add(r, None, 0)
+
+        w, h = image_size
+        for name in self.nodes:
+            self.by_concept.setdefault(name, [])
+            for i in range(images_per_node):
+                uuid = hashlib.md5(f"{name}/{i}".encode()).hexdigest()
+                uuid = f"{uuid[:8]}-{uuid[8:12]}-{uuid[12:16]}-{uuid[16:20]}-{uuid[20:]}"
+                concepts = [name] * boxes_per_image
+                parent = self.nodes[name]["parent"]
+                if parent and rng.random() < overlap:
+                    # the image also shows the parent concept, so both queries return it
+                    concepts[-1] = parent
+                    self.by_concept.setdefault(parent, []).append(uuid)
+                boxes = []
+                for concept in concepts:
+                    bw, bh = rng.randint(w // 16, w // 2), rng.randint(h // 16, h // 2)
+                    boxes.append(dict(concept=concept, x=rng.randint(0, w - bw), y=rng.randint(0, h - bh), width=bw, height=bh))
+                self.images[uuid] = dict(uuid=uuid, width=w, height=h, boundingBoxes=boxes)
+                self.by_concept[name].append(uuid)
+
+    def down(self, name: str) -> Optional[dict]:
+        if name not in self.nodes:
+            return None
+        node = self.nodes[name]
+        data = dict(name=name, rank=node["rank"])
+        if node["children"]:
+            data["children"] = [self.down(c) for c in node["children"]]
+        return data
+
+    def up(self, name: str) -> Optional[dict]:
+        if name not in self.nodes:
+            return None
+        data = None
+        while name:
+            node = self.nodes[name]
+            data = dict(name=name, rank=node["rank"], **(dict(children=[data]) if data else {}))
+            name = node["parent"]
+        return data
+
+    def count(self, name: str) -> int:
+        return sum(1 for u in self.by_concept.get(name, []) for b in self.images[u]["boundingBoxes"] if b["concept"] == name)
+
+    def class_concepts(self) -> Dict[str, List[str]]:
+        # the input file format of the downloaders, one class per root with its direct children as concepts
+        return {f"Class {r}": self.nodes[r]["children"] or [r] for r in self.roots}
+
+
+class FakeFathomNet:
+    def __init__(self, taxonomy: Taxonomy = None, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 host="127.0.0.1", port=0, seed=0):
+        self.taxonomy = taxonomy or Taxonomy()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.png = make_png(*self.taxonomy.image_size)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.log: List[Tuple[str, int, float]] = []
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out in separate writes, without this keep-alive clients hit the delayed ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self.server = Server((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_port}"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # shutdown waits for serve_forever, which never runs on a server that wasn't started
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread = None
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def env(self, cache_path: Path = None) -> Dict[str, str]:
+        env = dict(FATHOMNET_API_URL=self.url, FATHOMNET_DSG_URL=f"{self.url}/dsg")
+        if cache_path:
+            env["FATHOMNET_CACHE"] = str(cache_path)
+        return env
+
+    def reset_log(self):
+        with self._lock:
+            log, self.log = self.log, []
+        return log
+
+    def _route(self, path: str):
+        t = self.taxonomy
+        parts = [unquote(p) for p in urlparse(path).path.strip('/').split('/')]
+        name = parts[-1]
+        if parts[:3] == ["dsg", "phylogeny", "down"]:
+            return "phylogeny", t.down(name)
+        if parts[:3] == ["dsg", "phylogeny", "up"]:
+            return "phylogeny", t.up(name)
+        if parts[:3] == ["boundingboxes", "query", "count"]:
+            return "count", dict(concept=name, count=t.count(name)) if name in t.nodes else None
+        if parts[:3] == ["images", "query", "concept"]:
+            if name not in t.nodes:
+                return "images", []
+            return "images", [dict(t.images[u], url=f"{self.url}/img/{u}.png") for u in t.by_concept[name]]
+        if parts[:3] == ["taxa", "query", "children"]:
+            return "children", [dict(name=c, rank=t.nodes[c]["rank"]) for c in t.nodes[name]["children"]] if name in t.nodes else []
+        if parts[0] == "img" and Path(name).stem in t.images:
+            return "image", self.png
+        return "unknown", None
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        start = time.perf_counter()
+        kind, body = self._route(request.path)
+        with self._lock:
+            roll = self._rng.random()
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if roll < self.throttle_rate:
+            status, data, headers = 429, b"", {"Retry-After": "1"}
+        elif roll < self.throttle_rate + self.error_rate:
+            status, data, headers = 500, b"", {}
+        elif body is None:
+            status, data, headers = 404, b"", {}
+        elif isinstance(body, bytes):
+            status, data, headers = 200, body, {"Content-Type": "image/png"}
+        else:
+            status, data, headers = 200, json.dumps(body).encode(), {"Content-Type": "application/json"}
+
+        # logged before the response goes out, a client that got its answer always finds the request in the log
+        with self._lock:
+            self.log.append((kind, status, time.perf_counter() - start))
+
+        request.send_response(status)
+        for k, v in headers.items():
+            request.send_header(k, v)
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+        return kind, status
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:4]]
+    port, depth, fanout = args + [8765, 3, 3][len(args):]
+    fake = FakeFathomNet(Taxonomy(depth=depth, fanout=fanout), port=port).start()
+    print(f"{len(fake.taxonomy.nodes)} concepts, {len(fake.taxonomy.images)} images")
+    for k, v in fake.env().items():
+        print(f"export {k}={v}")
+    print(json.dumps(fake.taxonomy.class_concepts()))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,180 @@
+from fathomnet.api import boundingboxes, images, taxa
+import fathomnet.api
+from fathomnet.models import AImageDTO, Taxa
+from metrics import METRICS
+
+from pathlib import Path
+from typing import *
+import itertools, json, os, sqlite3, sys, threading, time, urllib3
+
+
+CACHE_PATH = Path(os.environ.get("FATHOMNET_CACHE", Path.home() / ".cache" / "fathomnet" / "cache.sqlite"))
+DSG_URL = os.environ.get("FATHOMNET_DSG_URL", "https://fathomnet.org/dsg")
+TTL = float(os.environ.get("FATHOMNET_CACHE_TTL", 7 * 24 * 3600))
+MAX_ENTRIES = int(os.environ.get("FATHOMNET_CACHE_SIZE", 500_000))
+OFFLINE = os.environ.get("FATHOMNET_OFFLINE", "0") not in ("", "0")
+
+if "FATHOMNET_API_URL" in os.environ:
+    fathomnet.api.EndpointManager.ROOT = os.environ["FATHOMNET_API_URL"]
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+class Cache:
+    def __init__(self, path: Path = CACHE_PATH, ttl=TTL, max_entries=MAX_ENTRIES, offline=OFFLINE):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.offline = offline
+        self._local = threading.local()
+        # next() on a count is atomic, puts come from many worker threads
+        self._puts = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._conn() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                endpoint TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                value TEXT NOT NULL,
+                                created REAL NOT NULL,
+                                accessed REAL NOT NULL,
+                                PRIMARY KEY (endpoint, key))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between the worker threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, endpoint: str, key: str):
+        conn = self._conn()
+        row = conn.execute("SELECT value, created FROM entries WHERE endpoint=? AND key=?", (endpoint, key)).fetchone()
+        if row is None:
+            return None
+
+        value, created = row
+        now = time.time()
+        # stale entries are still better than nothing when offline
+        if now - created > self.ttl and not self.offline:
+            return None
+
+        with conn:
+            conn.execute("UPDATE entries SET accessed=? WHERE endpoint=? AND key=?", (now, endpoint, key))
+        return json.loads(value)
+
+    def put(self, endpoint: str, key: str, value):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                         (endpoint, key, json.dumps(value), now, now))
+        if next(self._puts) % 1000 == 0:
+            self.evict()
+
+    def evict(self, stale=False):
+        # only the size cap is enforced by default, expired entries are what offline mode serves
+        with self._conn() as conn:
+            if stale:
+                conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+            (size,) = conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+            if size > self.max_entries:
+                conn.execute("""DELETE FROM entries WHERE rowid IN (
+                                    SELECT rowid FROM entries ORDER BY accessed LIMIT ?)""",
+                             (size - self.max_entries,))
+
+    def clear(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM entries")
+
+    def fetch(self, endpoint: str, key: str, fetchFunc: Callable[[], Any]):
+        value = self.get(endpoint, key)
+        if value is not None:
+            self.hits += 1
+            METRICS.inc("api_requests_total", endpoint=endpoint, result="hit")
+            return value
+
+        self.misses += 1
+        if self.offline:
+            METRICS.inc("api_requests_total", endpoint=endpoint, result="offline")
+            raise CacheMiss(f"{endpoint}/{key}")
+
+        try:
+            with METRICS.timer("api_request_seconds", endpoint=endpoint):
+                value = fetchFunc()
+        except Exception:
+            METRICS.inc("api_requests_total", endpoint=endpoint, result="error")
+            raise
+        METRICS.inc("api_requests_total", endpoint=endpoint, result="miss")
+        if value is not None:
+            self.put(endpoint, key, value)
+        return value
+
+    def stats(self):
+        (size,) = self._conn().execute("SELECT COUNT(*) FROM entries").fetchone()
+        rows = self._conn().execute("SELECT endpoint, COUNT(*) FROM entries GROUP BY endpoint").fetchall()
+        return dict(entries=size, endpoints=dict(rows), hits=self.hits, misses=self.misses)
+
+
+_cache = None
+_http = urllib3.PoolManager(maxsize=32)
+
+
+def get_cache() -> Cache:
+    global _cache
+    if _cache is None:
+        _cache = Cache()
+    return _cache
+
+
+def set_cache(cache: Cache):
+    global _cache
+    _cache = cache
+
+
+def _get_json(url):
+    req = _http.request('GET', url)
+    if req.status >= 300:
+        return None
+    return json.loads(req.data)
+
+
+def phylogeny_down(concept: str) -> Optional[dict]:
+    return get_cache().fetch("phylogeny/down", concept, lambda: _get_json(f"{DSG_URL}/phylogeny/down/{concept}"))
+
+
+def phylogeny_up(concept: str) -> Optional[dict]:
+    return get_cache().fetch("phylogeny/up", concept, lambda: _get_json(f"{DSG_URL}/phylogeny/up/{concept}"))
+
+
+def count_by_concept(concept: str) -> int:
+    return get_cache().fetch("boundingboxes/count", concept, lambda: boundingboxes.count_by_concept(concept).count)
+
+
+def find_children(concept: str, provider: str = 'fathomnet') -> List[Taxa]:
+    data = get_cache().fetch("taxa/children", f"{provider}|{concept}",
+                             lambda: [t.to_dict() for t in taxa.find_children(provider, concept)])
+    return [Taxa.from_dict(d) for d in data]
+
+
+def find_by_concept(concept: str, taxa: Optional[str] = None) -> List[AImageDTO]:
+    data = get_cache().fetch("images/concept", f"{concept}|{taxa or ''}",
+                             lambda: [d.to_dict() for d in images.find_by_concept(concept, taxa)])
+    return [AImageDTO.from_dict(d) for d in data]
+
+
+if __name__ == "__main__":
+    cache = get_cache()
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "clear":
+        cache.clear()
+    elif command == "evict":
+        cache.evict(stale="--stale" in sys.argv[2:])
+    print(f"{cache.path}: {cache.stats()}")
@@ -1,43 +1,90 @@
-from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 from pascal import PascalVOC
-import xmltodict
 from PIL import Image
-import sys
+from image_header import image_size
+from metrics import METRICS, cli, profile_worker, stage
+import os, re, sys
 
-def check_fix_xml(xml_path: Path, try_pascalvoc = True):
-    with open(xml_path) as f:
+SIZE_RE = re.compile(rb"<size>.*?</size>", re.S)
+PATH_RE = re.compile(rb"<path>(.*?)</path>", re.S)
+SIZE_TEMPLATE = """<size>
+        <width>{}</width>
+        <height>{}</height>
+        <depth>{}</depth>
+    </size>"""
+
+
+def find_image(xml_path: Path, raw_xml: bytes):
+    match = PATH_RE.search(raw_xml)
+    if match:
+        img_path = xml_path.parent / Path(match.group(1).decode()).name
+        if img_path.exists():
+            return img_path
+
+    for ext in (".jpg", ".png", ".jpeg"):
+        img_path = xml_path.with_suffix(ext)
+        if img_path.exists():
+            return img_path
+    return None
+
+
+def read_size(img_path: Path):
+    size = image_size(img_path)
+    if size is None:
+        # unusual formats, PIL still only reads the header here
+        with Image.open(img_path) as img:
+            size = (*img.size, len(img.getbands()))
+    return size
+
+
+def check_fix_xml(xml_path: Path, try_pascalvoc = False):
+    with open(xml_path, "rb") as f:
         raw_xml = f.read()
-        if len(raw_xml.strip()) == 0:
-            print(f"emoty xml file {xml_path}")
-            return True
-
-        dict_xml = xmltodict.parse(raw_xml)
-        if dict_xml['annotation']['size']['width'] == "None" or dict_xml['annotation']['size']['height'] == "None":
-            stored_path = Path(dict_xml['annotation']['path'])
-            img_fname = stored_path.name
-            img_path = xml_path.parent / img_fname
-            img = Image.open(img_path)
-            width, height = img.size
-            depth = len(img.getbands())
-            dict_xml['annotation']['size']['width'] = width
-            dict_xml['annotation']['size']['height'] = height
-            dict_xml['annotation']['size']['depth'] = depth
-            print(f"Fixing {xml_path.name} {width} {height} {depth}")
-            xmltodict.unparse(dict_xml, open(xml_path, "w"))
-
-            if try_pascalvoc:
-                _ = PascalVOC.from_xml(xml_path)
-
-        else:
-            return False
+
+    if len(raw_xml.strip()) == 0:
+        print(f"empty xml file {xml_path}")
+        return "empty"
+
+    # valid files are never parsed
+    if b"<width>None" not in raw_xml and b"<height>None" not in raw_xml:
+        return "ok"
+
+    img_path = find_image(xml_path, raw_xml)
+    if img_path is None:
+        print(f"{xml_path}: image not found")
+        return "error"
+
+    try:
+        width, height, depth = read_size(img_path)
+    except Exception as e:
+        # a corrupt or truncated image must not abort the whole repair in the pool
+        print(f"{xml_path}: cannot read {img_path.name} ({e})")
+        return "error"
+    fixed_xml, n = SIZE_RE.subn(SIZE_TEMPLATE.format(width, height, depth).encode(), raw_xml, count=1)
+    if n == 0:
+        print(f"{xml_path}: no size element")
+        return "error"
+
+    tmp = xml_path.with_suffix(".xml.tmp")
+    with open(tmp, "wb") as f:
+        f.write(fixed_xml)
+    os.replace(tmp, xml_path)
+    print(f"Fixing {xml_path.name} {width} {height} {depth}")
+
+    if try_pascalvoc:
+        _ = PascalVOC.from_xml(xml_path)
+    return "fixed"
+
 
 if __name__ == "__main__":
+    sys.argv = cli(sys.argv)
     dir = Path(sys.argv[-1])
-    executor = ThreadPoolExecutor(max_workers=64)
-    count = 0
-    total = 0
-    for b in executor.map(check_fix_xml, dir.glob("**/*.xml")):
-        if b:
-            count += 1
-    print(f"total {count} corrected")
\ No newline at end of file
+    counts = Counter()
+    with stage("fix_xmls"), ProcessPoolExecutor(initializer=partial(profile_worker, "fix_xmls")) as executor:
+        for status in executor.map(check_fix_xml, dir.glob("**/*.xml"), chunksize=256):
+            counts[status] += 1
+            METRICS.inc("xml_checks_total", status=status)
+    print(f"total {counts['fixed']} corrected, {counts['ok']} already valid, {counts['empty']} empty, {counts['error']} errors")
@@ -0,0 +1,61 @@
+from pathlib import Path
+from typing import *
+import struct
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# channels per png colour type, palette images decode to rgb
+PNG_DEPTH = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+# every SOFn marker except DHT (c4), JPG (c8) and DAC (cc)
+JPEG_SOF = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+
+
+def _png_size(f) -> Optional[Tuple[int, int, int]]:
+    f.seek(8)
+    # chunk length, IHDR, width, height, bit depth, colour type
+    header = f.read(18)
+    if len(header) < 18 or header[4:8] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", header[8:16])
+    return width, height, PNG_DEPTH.get(header[17], 3)
+
+
+def _jpeg_size(f) -> Optional[Tuple[int, int, int]]:
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        while byte == b"\xff":
+            byte = f.read(1)
+        if not byte:
+            return None
+
+        marker = byte[0]
+        if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:
+            continue
+        if marker == 0xd9:
+            return None
+
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        (length,) = struct.unpack(">H", length)
+        if marker in JPEG_SOF:
+            segment = f.read(6)
+            if len(segment) < 6:
+                return None
+            _, height, width, components = struct.unpack(">BHHB", segment)
+            return width, height, components
+        f.seek(length - 2, 1)
+
+
+def image_size(path: Path) -> Optional[Tuple[int, int, int]]:
+    # width, height, depth from the file header only, without decoding the image
+    with open(path, "rb") as f:
+        signature = f.read(8)
+        if signature.startswith(PNG_SIGNATURE):
+            return _png_size(f)
+        if signature.startswith(b"\xff\xd8"):
+            return _jpeg_size(f)
+    return None
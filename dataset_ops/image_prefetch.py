@@ -0,0 +1,178 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fathomnet.models import AImageDTO, ABoundingBoxDTO
+from fathomnet_cache import CacheMiss, find_by_concept
+from rate_control import retry_call
+from concept_counts import MAX_WORKERS
+
+from pathlib import Path
+from tqdm import tqdm
+from treelib import Tree
+from typing import *
+import numpy as np
+import os, sys, time
+
+
+IMAGE_COLUMNS = ("uuid", "url", "width", "height")
+BOX_COLUMNS = ("image", "concept", "x", "y", "width", "height")
+PLACEMENT_COLUMNS = ("image", "dir")
+
+
+def tree_dirs(tree: Tree, rootID, root_dir: Path) -> List[Tuple[str, Path]]:
+    # same walk and directory layout as download_tree
+    dirs = []
+    stack = [(c, root_dir) for c in reversed(tree.children(rootID))]
+    while stack:
+        node, download_dir = stack.pop()
+        concept = node.tag.split(')')[-1]
+        if len(concept) == 0:
+            continue
+        new_path = download_dir / concept.replace(' ', '_')
+        dirs.append((concept, new_path))
+        stack.extend((c, new_path) for c in reversed(tree.children(node.identifier)))
+    return dirs
+
+
+def _none(v):
+    return -1 if v is None else v
+
+
+class ImageTable:
+    FILENAME = "images.npz"
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.names: List[str] = []
+        self.dirs: List[str] = []
+        self.images = {c: np.array([]) for c in IMAGE_COLUMNS}
+        self.boxes = {c: np.array([], dtype=np.int64) for c in BOX_COLUMNS}
+        self.box_start = np.zeros(1, dtype=np.int64)
+        self.placements = {c: np.array([], dtype=np.int64) for c in PLACEMENT_COLUMNS}
+
+    def __len__(self):
+        return len(self.images["uuid"])
+
+    @property
+    def num_placements(self):
+        return len(self.placements["image"])
+
+    @classmethod
+    def from_results(cls, root: Path, dirs: List[Tuple[str, Path]], results: Dict[str, List[AImageDTO]]) -> 'ImageTable':
+        table = cls(root)
+        image_ids: Dict[str, int] = {}
+        name_ids: Dict[str, int] = {}
+        images = {c: [] for c in IMAGE_COLUMNS}
+        boxes = []
+        placements = set()
+
+        for d, (concept, path) in enumerate(dirs):
+            table.dirs.append(os.path.relpath(path, root))
+            for image in results.get(concept, []):
+                i = image_ids.get(image.uuid)
+                if i is None:
+                    # the first copy of a uuid wins, every query returns the same image record
+                    i = image_ids[image.uuid] = len(images["uuid"])
+                    for c, v in zip(IMAGE_COLUMNS, (image.uuid, image.url, _none(image.width), _none(image.height))):
+                        images[c].append(v)
+                    for box in image.boundingBoxes or []:
+                        if box.concept not in name_ids:
+                            name_ids[box.concept] = len(table.names)
+                            table.names.append(box.concept)
+                        boxes.append((i, name_ids[box.concept], _none(box.x), _none(box.y), _none(box.width), _none(box.height)))
+                placements.add((i, d))
+
+        table.images = dict(uuid=np.array(images["uuid"], dtype=str),
+                            url=np.array(images["url"], dtype=str),
+                            width=np.array(images["width"], dtype=np.int32),
+                            height=np.array(images["height"], dtype=np.int32))
+        boxes = np.array(boxes, dtype=np.int64).reshape(-1, len(BOX_COLUMNS))
+        table.boxes = {c: boxes[:, j] for j, c in enumerate(BOX_COLUMNS)}
+        table.box_start = np.searchsorted(table.boxes["image"], np.arange(len(table) + 1))
+        placements = np.array(sorted(placements), dtype=np.int64).reshape(-1, 2)
+        table.placements = {c: placements[:, j] for j, c in enumerate(PLACEMENT_COLUMNS)}
+        return table
+
+    @classmethod
+    def load(cls, root: Path, path: Path = None) -> 'ImageTable':
+        table = cls(root)
+        with np.load(path or table.root / ".metadata" / cls.FILENAME, allow_pickle=False) as data:
+            table.names = data["names"].tolist()
+            table.dirs = data["dirs"].tolist()
+            table.images = {c: data[f"image_{c}"] for c in IMAGE_COLUMNS}
+            table.boxes = {c: data[f"box_{c}"] for c in BOX_COLUMNS}
+            table.box_start = data["box_start"]
+            table.placements = {c: data[f"placement_{c}"] for c in PLACEMENT_COLUMNS}
+        return table
+
+    def save(self, path: Path = None):
+        path = Path(path or self.root / ".metadata" / self.FILENAME)
+        tmp = path.with_name(path.name + ".tmp.npz")
+        np.savez(tmp,
+                 names=np.array(self.names, dtype=str),
+                 dirs=np.array(self.dirs, dtype=str),
+                 box_start=self.box_start,
+                 **{f"image_{c}": v for c, v in self.images.items()},
+                 **{f"box_{c}": v for c, v in self.boxes.items()},
+                 **{f"placement_{c}": v for c, v in self.placements.items()})
+        os.replace(tmp, path)
+
+    def image_data(self, i: int) -> AImageDTO:
+        s = slice(self.box_start[i], self.box_start[i + 1])
+
+        def _value(v):
+            return None if v < 0 else int(v)
+
+        boxes = [ABoundingBoxDTO(concept=self.names[n], x=_value(x), y=_value(y), width=_value(w), height=_value(h))
+                 for n, x, y, w, h in zip(self.boxes["concept"][s], self.boxes["x"][s], self.boxes["y"][s],
+                                          self.boxes["width"][s], self.boxes["height"][s])]
+        return AImageDTO(uuid=str(self.images["uuid"][i]), url=str(self.images["url"][i]),
+                         width=_value(self.images["width"][i]), height=_value(self.images["height"][i]), boundingBoxes=boxes)
+
+    def work_list(self) -> Iterator[Tuple[AImageDTO, List[Path]]]:
+        # placements are sorted by image, all directories of one uuid go into a single job
+        images = self.placements["image"]
+        starts = np.flatnonzero(np.r_[True, images[1:] != images[:-1]]) if len(images) else []
+        for s, e in zip(starts, [*starts[1:], len(images)]):
+            yield self.image_data(images[s]), [self.root / self.dirs[d] for d in self.placements["dir"][s:e]]
+
+    def summary(self):
+        return dict(concepts=len(self.dirs), images=len(self), placements=self.num_placements, boxes=len(self.boxes["image"]))
+
+
+def fetch_image_data(concepts: Iterable[str], max_workers=MAX_WORKERS) -> Dict[str, List[AImageDTO]]:
+    concepts = list(dict.fromkeys(concepts))
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(retry_call, find_by_concept, c, giveup=(CacheMiss,)): c for c in concepts}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="image metadata"):
+            concept = futures[future]
+            try:
+                results[concept] = future.result()
+            except Exception as e:
+                print(f"{concept}: image metadata failed {e}")
+    return results
+
+
+def prefetch(trees: Dict[str, Tree], output_dir: Path, rootID=0, max_workers=MAX_WORKERS, save=True) -> ImageTable:
+    start = time.time()
+    output_dir = Path(output_dir)
+    dirs = []
+    for clsname, tree in trees.items():
+        dirs.extend(tree_dirs(tree, rootID, output_dir / clsname.replace(' ', '_')))
+
+    results = fetch_image_data((c for c, _ in dirs), max_workers)
+    table = ImageTable.from_results(output_dir, dirs, results)
+    if save:
+        table.save()
+
+    returned = sum(len(results.get(c, [])) for c, _ in dirs)
+    print(f"prefetched {len(results)} concepts in {time.time() - start:.1f}s: {returned} results, "
+          f"{table.num_placements} placements of {len(table)} unique images")
+    return table
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Syntax: {sys.argv[0]} <output_dir>")
+        sys.exit(1)
+
+    print(ImageTable.load(Path(sys.argv[1])).summary())
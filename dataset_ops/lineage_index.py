@@ -0,0 +1,112 @@
+from pathlib import Path
+from typing import *
+import json, os, sys
+
+from compact_tree import CompactTree
+from tree_metadata import load_tree, tree_files
+
+
+def tree_lineage(compact: CompactTree, superclass: str) -> Dict[str, dict]:
+    # pre-order, the ancestors of a node are complete by the time it is reached
+    lineage = {}
+    ancestors = [[] for _ in range(len(compact))]
+    for i in range(1, len(compact)):
+        p = compact.parent[i]
+        ancestors[i] = ancestors[p] + [compact.node_name(p)] if p > 0 else []
+        lineage.setdefault(compact.node_name(i), dict(ancestors=ancestors[i], superclass=superclass, rank=compact.node_rank(i)))
+    return lineage
+
+
+class LineageIndex:
+    FILENAME = "lineage_index.json"
+    VERSION = 1
+
+    def __init__(self, metadata_dir: Path, index_path: Path = None):
+        self.metadata_dir = Path(metadata_dir)
+        self.index_path = Path(index_path) if index_path else self.metadata_dir / self.FILENAME
+        self.sources: Dict[str, float] = {}
+        self.concepts: Dict[str, dict] = {}
+
+    def __len__(self):
+        return len(self.concepts)
+
+    def __contains__(self, label: str):
+        return self.get(label) is not None
+
+    def tree_files(self) -> Dict[str, float]:
+        if not self.metadata_dir.is_dir():
+            return {}
+        return {p.name: p.stat().st_mtime for p in tree_files(self.metadata_dir).values()}
+
+    @classmethod
+    def load(cls, metadata_dir: Path, index_path: Path = None) -> 'LineageIndex':
+        index = cls(metadata_dir, index_path)
+        if index.index_path.exists():
+            with open(index.index_path) as f:
+                data = json.load(f)
+            if data.get("version") == cls.VERSION:
+                index.sources = data["sources"]
+                index.concepts = data["concepts"]
+        return index
+
+    @classmethod
+    def build(cls, metadata_dir: Path, index_path: Path = None, save=True) -> 'LineageIndex':
+        # rebuilt only when a tree was added, removed or rewritten since the index was saved
+        index = cls.load(metadata_dir, index_path)
+        files = index.tree_files()
+        if files != index.sources:
+            index.rebuild(files)
+            if save:
+                index.save()
+        return index
+
+    def rebuild(self, files: Dict[str, float]):
+        self.concepts = {}
+        for superclass, path in tree_files(self.metadata_dir).items():
+            for concept, entry in tree_lineage(load_tree(path), superclass).items():
+                if concept in self.concepts and self.concepts[concept]["superclass"] != superclass:
+                    print(f"Conflict: {concept} found in both {self.concepts[concept]['superclass']} and {superclass}. => {superclass} ignored.")
+                    continue
+                self.concepts.setdefault(concept, entry)
+        self.sources = files
+        print(f"{self.metadata_dir}: {len(self)} concepts from {len(files)} trees")
+
+    def save(self):
+        tmp = self.index_path.with_name(self.index_path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(dict(version=self.VERSION, sources=self.sources, concepts=self.concepts), f)
+        os.replace(tmp, self.index_path)
+
+    def get(self, label: str) -> Optional[dict]:
+        # labels as written in the annotations, or as directory names
+        return self.concepts.get(label) or self.concepts.get(label.replace('_', " "))
+
+    def superclass(self, label: str) -> Optional[str]:
+        entry = self.get(label)
+        return entry["superclass"] if entry else None
+
+    def rank(self, label: str) -> Optional[str]:
+        entry = self.get(label)
+        return entry["rank"] if entry else None
+
+    def ancestors(self, label: str) -> List[str]:
+        entry = self.get(label)
+        return entry["ancestors"] if entry else []
+
+
+def load_lineage(image_dir: Path) -> Optional[LineageIndex]:
+    metadata_dir = Path(image_dir) / ".metadata"
+    if not metadata_dir.is_dir():
+        return None
+    index = LineageIndex.build(metadata_dir)
+    return index if len(index) else None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Syntax: {sys.argv[0]} <metadata_dir> [label ...]")
+        sys.exit(1)
+
+    index = LineageIndex.build(Path(sys.argv[1]))
+    for label in sys.argv[2:]:
+        print(f"{label}: {index.get(label)}")
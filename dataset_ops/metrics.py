@@ -0,0 +1,317 @@
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import *
+import atexit, bisect, cProfile, io, json, os, pstats, sys, threading, time
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = "fathomnet_"
+
+# the settings live in the environment so process pool workers see them too
+METRICS_ENV = "FATHOMNET_METRICS"
+INTERVAL_ENV = "FATHOMNET_METRICS_INTERVAL"
+PROFILE_ENV = "FATHOMNET_PROFILE"
+PROFILE_MODE_ENV = "FATHOMNET_PROFILE_MODE"
+PROFILE_MODES = ("cprofile", "sample")
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def quantile(buckets: Sequence[float], counts: Sequence[int], q: float) -> Optional[float]:
+    # upper bound of the bucket holding the q-th observation, None past the last bucket
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bound, n in zip(buckets, counts):
+        seen += n
+        if seen >= rank:
+            return bound
+    return None
+
+
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self.counters: Dict[tuple, float] = {}
+        self.gauges: Dict[tuple, float] = {}
+        # counts per bucket plus one overflow slot, then sum
+        self.histograms: Dict[tuple, list] = {}
+        self._collectors: List[Callable[['Metrics'], None]] = []
+
+    def inc(self, name: str, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collect: Callable[['Metrics'], None]):
+        # called before every snapshot, for gauges like queue depths that are cheaper to read than to track
+        self._collectors.append(collect)
+
+    def collect(self):
+        for collect in self._collectors:
+            try:
+                collect(self)
+            except Exception as e:
+                print(f"metrics collector failed: {e}")
+
+    def drain(self) -> dict:
+        # counters and histograms recorded in a pool worker since the last drain, for the parent to merge
+        with self._lock:
+            data = dict(counters=list(self.counters.items()), histograms=list(self.histograms.items()))
+            self.counters = {}
+            self.histograms = {}
+        return data
+
+    def merge(self, data: dict):
+        with self._lock:
+            for key, value in data["counters"]:
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (counts, total) in data["histograms"]:
+                h = self.histograms.get(key)
+                if h is None:
+                    h = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                h[0] = [a + b for a, b in zip(h[0], counts)]
+                h[1] += total
+
+    def snapshot(self) -> dict:
+        self.collect()
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {k: (list(c), s) for k, (c, s) in self.histograms.items()}
+
+        def _entries(items):
+            return [dict(name=name, labels=dict(labels), **value) for (name, labels), value in sorted(items)]
+
+        return dict(time=time.time(), uptime=time.time() - self.start, pid=os.getpid(),
+                    counters=_entries((k, dict(value=v)) for k, v in counters.items()),
+                    gauges=_entries((k, dict(value=v)) for k, v in gauges.items()),
+                    histograms=_entries((k, dict(count=sum(c), sum=s,
+                                                 buckets=dict(zip([*map(str, self.buckets), "+Inf"], c)),
+                                                 p50=quantile(self.buckets, c, 0.5),
+                                                 p90=quantile(self.buckets, c, 0.9),
+                                                 p99=quantile(self.buckets, c, 0.99)))
+                                        for k, (c, s) in histograms.items()))
+
+    def prometheus(self) -> str:
+        snapshot = self.snapshot()
+
+        def _labels(labels, **extra):
+            labels = {**labels, **extra}
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+        lines = []
+        typed = set()
+
+        def _type(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for c in snapshot["counters"]:
+            _type(c["name"], "counter")
+            lines.append(f"{PREFIX}{c['name']}{_labels(c['labels'])} {c['value']}")
+        for g in snapshot["gauges"]:
+            _type(g["name"], "gauge")
+            lines.append(f"{PREFIX}{g['name']}{_labels(g['labels'])} {g['value']}")
+        for h in snapshot["histograms"]:
+            _type(h["name"], "histogram")
+            cumulative = 0
+            for bound, n in h["buckets"].items():
+                cumulative += n
+                lines.append(f"{PREFIX}{h['name']}_bucket{_labels(h['labels'], le=bound)} {cumulative}")
+            lines.append(f"{PREFIX}{h['name']}_sum{_labels(h['labels'])} {h['sum']}")
+            lines.append(f"{PREFIX}{h['name']}_count{_labels(h['labels'])} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path):
+        # .prom files are for the node exporter textfile collector, anything else gets json
+        path = Path(path)
+        data = self.prometheus() if path.suffix == ".prom" else json.dumps(self.snapshot(), indent=1)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+METRICS = Metrics()
+
+
+class Snapshotter:
+    def __init__(self, path: Path, interval=10.0, metrics: Metrics = METRICS):
+        self.path = Path(path)
+        self.interval = interval
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.metrics.write(self.path)
+
+    def start(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.metrics.write(self.path)
+
+
+class Sampler:
+    # stack samples of every thread, cProfile only sees the thread that enabled it
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{Path(frame.f_code.co_filename).name}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: Path):
+        # folded stacks, the input format of flamegraph.pl and speedscope
+        with open(path, "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
+
+
+def profile_dir() -> Optional[Path]:
+    path = os.environ.get(PROFILE_ENV)
+    return Path(path) if path else None
+
+
+def profile_mode() -> str:
+    return os.environ.get(PROFILE_MODE_ENV, PROFILE_MODES[0])
+
+
+def start_profile():
+    if profile_dir() is None:
+        return None
+    if profile_mode() == "sample":
+        return Sampler().start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, name: str, top=15):
+    path = profile_dir() / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(profiler, Sampler):
+        profiler.stop()
+        profiler.write(path.with_suffix(".folded"))
+        print(f"profile {name}: {sum(profiler.stacks.values())} samples in {path.with_suffix('.folded')}")
+        return
+
+    profiler.disable()
+    profiler.dump_stats(path.with_suffix(".prof"))
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(top)
+    with open(path.with_suffix(".txt"), "w") as f:
+        f.write(out.getvalue())
+    print(f"profile {name}: {path.with_suffix('.prof')}")
+
+
+@contextmanager
+def stage(name: str, metrics: Metrics = METRICS):
+    profiler = start_profile()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.inc("stage_seconds_total", time.perf_counter() - start, stage=name)
+        metrics.inc("stage_runs_total", stage=name)
+        if profiler is not None:
+            stop_profile(profiler, name)
+
+
+def profile_worker(name: str):
+    # for process pool initializers, each worker writes its own profile when the pool shuts it down
+    profiler = start_profile()
+    if profiler is not None:
+        from multiprocessing.util import Finalize
+        Finalize(profiler, stop_profile, args=(profiler, f"{name}-{os.getpid()}"), exitpriority=10)
+
+
+def cli(argv: List[str]) -> List[str]:
+    # strips --metrics=<path>, --metrics-interval=<s> and --profile[=cprofile|sample] off argv,
+    # profiles go to --profile-dir=<dir> or ./profiles
+    args = []
+    options = {}
+    for a in argv:
+        name, _, value = a.partition("=")
+        if name in ("--metrics", "--metrics-interval", "--profile", "--profile-dir"):
+            options[name] = value
+        else:
+            args.append(a)
+
+    if "--profile" in options or "--profile-dir" in options:
+        mode = options.get("--profile") or PROFILE_MODES[0]
+        if mode not in PROFILE_MODES:
+            print(f"unknown profile mode {mode}, expected one of {PROFILE_MODES}")
+            sys.exit(1)
+        os.environ[PROFILE_ENV] = str(Path(options.get("--profile-dir") or "profiles").absolute())
+        os.environ[PROFILE_MODE_ENV] = mode
+
+    path = options.get("--metrics") or os.environ.get(METRICS_ENV)
+    if path:
+        interval = float(options.get("--metrics-interval") or os.environ.get(INTERVAL_ENV, 10))
+        snapshotter = Snapshotter(path, interval).start()
+        atexit.register(snapshotter.stop)
+        print(f"metrics: {path} every {interval:.0f}s")
+    return args
@@ -0,0 +1,166 @@
+from metrics import METRICS
+
+from typing import *
+import asyncio, random, threading, time
+
+
+RETRIES = 4
+
+
+def backoff_delay(attempt: int, base=0.5, cap=30.0) -> float:
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def retry_call(func: Callable, *args, retries=RETRIES, base=0.5, giveup: Tuple[type, ...] = (), **kwargs):
+    # for metadata calls, transient server errors are retried with backoff instead of failing the whole run
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except giveup:
+            raise
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = backoff_delay(attempt, base)
+            METRICS.inc("retries_total", call=getattr(func, '__name__', func))
+            print(f"{getattr(func, '__name__', func)}{args} failed ({e}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+
+class _AIMD:
+    # additive increase of one slot per window of successes, multiplicative decrease at most once per latency period
+    def __init__(self, initial=8, minimum=1, maximum=128, target_latency=2.0, decrease=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.completed = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def _ready(self):
+        return self.inflight < int(self.limit) and time.monotonic() >= self.paused_until
+
+    def _observe(self, latency: Optional[float], status: Optional[int], retry_after: Optional[float] = None):
+        now = time.monotonic()
+        congested = False
+        if status == 429 or status == 503:
+            self.throttled += 1
+            congested = True
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+        elif status is None or status >= 500:
+            self.errors += 1
+            congested = True
+        else:
+            self.completed += 1
+            congested = latency is not None and latency > self.target_latency
+
+        if congested:
+            if now - self.last_decrease > (latency or self.target_latency):
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.last_decrease = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def stats(self):
+        return dict(limit=round(self.limit, 1), inflight=self.inflight, completed=self.completed,
+                    errors=self.errors, throttled=self.throttled)
+
+
+class Slot:
+    def __init__(self, controller):
+        self.controller = controller
+        self.start = time.monotonic()
+        self.observed = False
+
+    def observe(self, status: Optional[int], latency: Optional[float] = None, retry_after: Optional[float] = None):
+        self.observed = True
+        self.controller._release(latency if latency is not None else time.monotonic() - self.start, status, retry_after)
+
+
+class AIMDController(_AIMD):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while not self._ready():
+                self._cond.wait(timeout=max(0.05, self.paused_until - time.monotonic()))
+            self.inflight += 1
+
+    def _release(self, latency, status, retry_after=None):
+        with self._cond:
+            self.inflight -= 1
+            self._observe(latency, status, retry_after)
+            self._cond.notify_all()
+
+    def slot(self):
+        controller = self
+
+        class _Context:
+            def __enter__(self):
+                controller.acquire()
+                self.slot = Slot(controller)
+                return self.slot
+
+            def __exit__(self, exc_type, exc, tb):
+                # leaving without a status counts as a failed request
+                if not self.slot.observed:
+                    self.slot.observe(None)
+        return _Context()
+
+
+class AsyncAIMDController(_AIMD):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = asyncio.Condition()
+        # the loop only keeps weak references to tasks, a notify could be collected before it runs
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def acquire(self):
+        async with self._cond:
+            while not self._ready():
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout=max(0.05, self.paused_until - time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
+            self.inflight += 1
+
+    def _release(self, latency, status, retry_after=None):
+        self.inflight -= 1
+        self._observe(latency, status, retry_after)
+        task = asyncio.get_running_loop().create_task(self._notify())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def slot(self):
+        controller = self
+
+        class _Context:
+            async def __aenter__(self):
+                await controller.acquire()
+                self.slot = Slot(controller)
+                return self.slot
+
+            async def __aexit__(self, exc_type, exc, tb):
+                if not self.slot.observed:
+                    self.slot.observe(None)
+        return _Context()
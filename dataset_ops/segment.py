@@ -0,0 +1,316 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import *
+import math, os, sys, time
+
+import cv2
+import numpy as np
+from annotation_index import AnnotationIndex
+from crop_shards import ShardWriter, iter_samples
+from cutout import bounded_map, shard_key
+from metrics import METRICS, cli, profile_worker, stage
+
+ITERATIONS = 5
+REFINE_ITERATIONS = 1
+WORK_SIZE = 256
+# the refine pass runs at up to this size, full resolution grabcut costs seconds per megapixel even for one iteration
+REFINE_SIZE = 1024
+# background strip left around a crop, bgdMargin in grabcut.ipynb
+MARGIN = 4
+# share of the box added on every side in source mode, so grabcut has background to model
+CONTEXT = 0.1
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+
+def rle_encode(mask: np.ndarray) -> dict:
+    # coco compressed rle, column major runs starting with background
+    h, w = mask.shape
+    flat = mask.ravel(order="F").astype(bool)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.r_[0, changes, flat.size]).tolist()
+    if flat.size and flat[0]:
+        counts.insert(0, 0)
+
+    s = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            s.append(chr(c + 48))
+    return dict(size=[h, w], counts="".join(s))
+
+
+def rle_decode(rle: dict) -> np.ndarray:
+    h, w = rle["size"]
+    counts = []
+    p = 0
+    s = rle["counts"]
+    while p < len(s):
+        x = k = 0
+        more = True
+        while more:
+            c = ord(s[p]) - 48
+            x |= (c & 0x1f) << 5 * k
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << 5 * k
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+
+    values = np.arange(len(counts)) % 2
+    return np.repeat(values.astype(np.uint8), counts).reshape(w, h).T
+
+
+def _grabcut(img: np.ndarray, mask: np.ndarray, rect, iterations: int, mode: int) -> np.ndarray:
+    bgd_model = np.zeros((1, 65), np.float64)
+    fgd_model = np.zeros((1, 65), np.float64)
+    mask, _, _ = cv2.grabCut(img, mask, rect, bgd_model, fgd_model, iterations, mode)
+    return mask
+
+
+def foreground(gc_mask: np.ndarray) -> np.ndarray:
+    return ((gc_mask == cv2.GC_FGD) | (gc_mask == cv2.GC_PR_FGD)).astype(np.uint8)
+
+
+def refine(img: np.ndarray, mask: np.ndarray, rect, radius: int, iterations=REFINE_ITERATIONS) -> np.ndarray:
+    # pixels further than radius from the upscaled edge keep their label, only the band in between is re-estimated
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+    sure_fg = cv2.erode(mask, kernel)
+    sure_bg = cv2.dilate(mask, kernel) == 0
+    gc = np.where(mask, cv2.GC_PR_FGD, cv2.GC_PR_BGD).astype(np.uint8)
+    gc[sure_fg == 1] = cv2.GC_FGD
+    gc[sure_bg] = cv2.GC_BGD
+    x, y, w, h = rect
+    outside = np.ones(mask.shape, bool)
+    outside[y: y + h, x: x + w] = False
+    gc[outside] = cv2.GC_BGD
+    if not (gc == cv2.GC_BGD).any() or not (gc == cv2.GC_FGD).any():
+        return mask
+    return foreground(_grabcut(img, gc, None, iterations, cv2.GC_INIT_WITH_MASK))
+
+
+def _scaled(img: np.ndarray, rect, size):
+    h, w = img.shape[:2]
+    scale = size / max(h, w) if size and max(h, w) > size else 1.0
+    if scale == 1.0:
+        return img, rect, scale
+    small = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    sh, sw = small.shape[:2]
+    x, y, rw, rh = rect
+    x0, y0 = min(sw - 2, int(x * scale)), min(sh - 2, int(y * scale))
+    return small, (x0, y0, max(1, min(sw - x0, math.ceil(rw * scale))), max(1, min(sh - y0, math.ceil(rh * scale)))), scale
+
+
+def segment(img: np.ndarray, rect, iterations=ITERATIONS, work_size=WORK_SIZE, refine_iterations=REFINE_ITERATIONS,
+            refine_size=REFINE_SIZE) -> np.ndarray:
+    # rect is (x, y, w, h) in img, returns a 0/1 mask of the whole img
+    h, w = img.shape[:2]
+    small, small_rect, scale = _scaled(img, rect, work_size)
+    mask = foreground(_grabcut(small, np.zeros(small.shape[:2], np.uint8), small_rect, iterations, cv2.GC_INIT_WITH_RECT))
+    if scale == 1.0:
+        return mask
+
+    # downscale, segment, upscale, then refine the edge band at up to refine_size
+    if refine_iterations:
+        fine, fine_rect, fine_scale = _scaled(img, rect, refine_size)
+        if fine_scale > scale:
+            mask = cv2.resize(mask, fine.shape[1::-1], interpolation=cv2.INTER_NEAREST)
+            mask = refine(fine, mask, fine_rect, max(1, math.ceil(fine_scale / scale)), refine_iterations)
+    return cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
+
+
+def crop_rect(shape, margin=MARGIN):
+    h, w = shape[:2]
+    if w <= 2 * margin + 1 or h <= 2 * margin + 1:
+        return None
+    return margin, margin, w - 2 * margin, h - 2 * margin
+
+
+def segment_crop(img: np.ndarray, iterations=ITERATIONS, work_size=WORK_SIZE):
+    rect = crop_rect(img.shape)
+    if rect is None:
+        return None
+    return segment(img, rect, iterations, work_size)
+
+
+def segment_box(img: np.ndarray, box, iterations=ITERATIONS, work_size=WORK_SIZE, context=CONTEXT):
+    # the mask covers the box only, the same pixels cutout crops
+    h, w = img.shape[:2]
+    xmin, ymin, xmax, ymax = max(0, box[0]), max(0, box[1]), min(w, box[2]), min(h, box[3])
+    if xmax - xmin < 2 or ymax - ymin < 2:
+        return None
+    pad_x, pad_y = math.ceil((xmax - xmin) * context), math.ceil((ymax - ymin) * context)
+    x0, y0, x1, y1 = max(0, xmin - pad_x), max(0, ymin - pad_y), min(w, xmax + pad_x), min(h, ymax + pad_y)
+    roi = img[y0: y1, x0: x1]
+    rect = (xmin - x0, ymin - y0, xmax - xmin, ymax - ymin)
+    if rect[2] >= roi.shape[1] and rect[3] >= roi.shape[0]:
+        # the box is the whole image, nothing outside it to learn the background from
+        rect = crop_rect(roi)
+        if rect is None:
+            return None
+    mask = segment(roi, rect, iterations, work_size)
+    return mask[ymin - y0: ymax - y0, xmin - x0: xmax - x0]
+
+
+def _mask_meta(mask, start, **meta):
+    return dict(rle_encode(mask), area=int(mask.sum()), seconds=round(time.perf_counter() - start, 4), **meta)
+
+
+def _segmented(func, *args):
+    try:
+        return func(*args)
+    except cv2.error as e:
+        print(f"grabcut failed on {args[0].shape}: {e}")
+        return False
+
+
+def _result(key, mask, start, **meta):
+    if mask is None or mask is False:
+        METRICS.inc("masks_total", result="skipped" if mask is None else "error")
+        return key, None
+    METRICS.inc("masks_total", result="segmented")
+    METRICS.observe("segment_seconds", time.perf_counter() - start)
+    return key, _mask_meta(mask, start, **meta)
+
+
+def _crop_job(job):
+    key, source, data, iterations, work_size = job
+    start = time.perf_counter()
+    img = cv2.imread(source) if data is None else cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        METRICS.inc("masks_total", result="decode_error")
+        return [(key, None)], METRICS.drain()
+    mask = _segmented(segment_crop, img, iterations, work_size)
+    return [_result(key, mask, start, source=source)], METRICS.drain()
+
+
+def _source_job(job):
+    image_path, boxes, keys, iterations, work_size = job
+    img = cv2.imread(image_path)
+    if img is None:
+        METRICS.inc("masks_total", len(keys), result="decode_error")
+        return [(key, None) for key in keys], METRICS.drain()
+    results = []
+    for key, box in zip(keys, boxes):
+        start = time.perf_counter()
+        results.append(_result(key, _segmented(segment_box, img, box, iterations, work_size), start, source=image_path, bbox=list(box)))
+    return results, METRICS.drain()
+
+
+def _init_worker():
+    # grabcut itself is single threaded, keep the resize from spawning threads on every worker
+    cv2.setNumThreads(1)
+    profile_worker("segment")
+
+
+def crop_jobs(input_dir: Path, writer: ShardWriter, iterations, work_size):
+    # a crop directory from cutout, or its --shards output
+    if (input_dir / ShardWriter.INDEX).exists():
+        for sample in iter_samples(input_dir):
+            if sample["key"] in writer:
+                continue
+            ext = next((e for e in sample if e not in ("key", "json")), None)
+            yield sample["key"], sample["json"].get("source", sample["key"]), sample[ext], iterations, work_size
+        return
+
+    for path in sorted(input_dir.rglob("*")):
+        if path.suffix.lower() not in IMAGE_EXTS:
+            continue
+        key = path.relative_to(input_dir).with_suffix("").as_posix()
+        if key not in writer:
+            yield key, path.as_posix(), None, iterations, work_size
+
+
+def source_jobs(input_dir: Path, writer: ShardWriter, iterations, work_size):
+    # source images with their voc boxes, keys match the crops cutout writes for the same boxes
+    index = AnnotationIndex.build(input_dir)
+    for i in range(len(index)):
+        rel_dir = Path(index.files["path"][i]).parent
+        todo = [(shard_key(rel_dir, index.uuid(i), j), b) for j, b in enumerate(index.concept_boxes(i))]
+        todo = [(k, b) for k, b in todo if k not in writer]
+        if todo:
+            yield index.image_path(i).as_posix(), [b for _, b in todo], [k for k, _ in todo], iterations, work_size
+
+
+def segmentTree(input_dir, output_dir, source=False, iterations=ITERATIONS, work_size=WORK_SIZE, max_workers=None):
+    input_dir = Path(input_dir)
+    written = 0
+    skipped = 0
+    start = time.time()
+    with ShardWriter(output_dir, prefix="masks") as writer:
+        existing = len(writer.keys)
+        jobs = (source_jobs if source else crop_jobs)(input_dir, writer, iterations, work_size)
+        job_func = _source_job if source else _crop_job
+        with stage("segment"), ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_worker) as executor:
+            for results, worker_metrics in bounded_map(executor, job_func, jobs):
+                METRICS.merge(worker_metrics)
+                for key, meta in results:
+                    if meta is None:
+                        skipped += 1
+                        continue
+                    rle = meta.pop("counts").encode()
+                    writer.write(key, rle, ".rle", meta)
+                    written += 1
+                    if written % 500 == 0:
+                        print(f"{input_dir}: {written} masks, {written / (time.time() - start):.1f}/s")
+    print(f"{input_dir}: {written} masks in {time.time() - start:.1f}s, {skipped} skipped, {existing} already existed")
+    return written
+
+
+def iter_masks(mask_dir: Path) -> Iterator[Tuple[str, np.ndarray, dict]]:
+    for sample in iter_samples(mask_dir):
+        meta = sample["json"]
+        yield sample["key"], rle_decode(dict(size=meta["size"], counts=sample["rle"].decode())), meta
+
+
+def benchmark(width=1920, height=1080, iterations=ITERATIONS):
+    # an ellipse on a noisy background, full resolution grabcut against downscale, segment, upscale, refine
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 80, (height, width, 3), dtype=np.uint8)
+    truth = np.zeros((height, width), np.uint8)
+    cv2.ellipse(truth, (width // 2, height // 2), (width // 4, height // 3), 20, 0, 360, 1, -1)
+    img[truth == 1] = rng.integers(120, 220, (int(truth.sum()), 3), dtype=np.uint8)
+    rect = (width // 8, height // 16, width * 3 // 4, height * 7 // 8)
+
+    def _iou(mask):
+        return (mask & truth).sum() / max(1, (mask | truth).sum())
+
+    results = {}
+    for name, work_size, refine_iterations, refine_size in (("full", None, 0, None),
+                                                            ("downscaled", WORK_SIZE, 0, None),
+                                                            ("refined", WORK_SIZE, REFINE_ITERATIONS, REFINE_SIZE),
+                                                            ("refined_full", WORK_SIZE, REFINE_ITERATIONS, None)):
+        start = time.perf_counter()
+        mask = segment(img, rect, iterations, work_size, refine_iterations, refine_size)
+        results[name] = (time.perf_counter() - start, _iou(mask))
+        print(f"{name:<13} {results[name][0]:.2f}s iou {results[name][1]:.4f}")
+
+    rle = rle_encode(mask)
+    assert (rle_decode(rle) == mask).all()
+    print(f"rle {len(rle['counts'])} bytes, packed bits {width * height // 8} bytes, raw {width * height} bytes")
+    return results
+
+
+if __name__ == "__main__":
+    sys.argv = cli(sys.argv)
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(*(int(a) for a in sys.argv[2:4]))
+        sys.exit(0)
+
+    args = [a for a in sys.argv[1:] if a != "--source"]
+    if len(args) < 2:
+        print(f"Syntax: {sys.argv[0]} [--source] <crop or image dir> <mask dir> [work_size] [iterations] | bench [width height]")
+        sys.exit(1)
+
+    work_size = int(args[2]) if len(args) > 2 else WORK_SIZE
+    iterations = int(args[3]) if len(args) > 3 else ITERATIONS
+    segmentTree(args[0], args[1], "--source" in sys.argv, iterations, work_size or None)
@@ -0,0 +1,122 @@
+from pathlib import Path
+from typing import *
+import asyncio, hashlib, os, threading, time
+
+
+CHUNK_SIZE = 256 * 1024
+# bytes of all transfers in progress, each reserves its Content-Length before the first byte is read
+MAX_INFLIGHT_BYTES = 64 * 1024 * 1024
+
+
+class ByteBudget:
+    def __init__(self, limit=MAX_INFLIGHT_BYTES):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int, wait=True):
+        with self._cond:
+            # a single oversized request is let through on its own rather than deadlocking
+            while wait and self.used > 0 and self.used + n > self.limit:
+                self._cond.wait()
+            self.used += n
+
+    def release(self, n: int):
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+class AsyncByteBudget:
+    def __init__(self, limit=MAX_INFLIGHT_BYTES):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, n: int, wait=True):
+        async with self._cond:
+            if wait:
+                await self._cond.wait_for(lambda: self.used == 0 or self.used + n <= self.limit)
+            self.used += n
+
+    async def release(self, n: int):
+        async with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+def content_length(value: Optional[str]) -> Optional[int]:
+    return int(value) if value and value.isdigit() else None
+
+
+def part_path(path: Path) -> Path:
+    return path.with_name(path.name + ".part")
+
+
+def stream_to_file(chunks: Iterator[bytes], path: Path, budget: ByteBudget = None, chunk_size=CHUNK_SIZE,
+                   deadline: float = None, expected: int = None) -> Tuple[int, str]:
+    # chunks land in a .part file which only replaces the target once complete
+    tmp = part_path(path)
+    h = hashlib.sha256()
+    size = 0
+    # the whole transfer is reserved up front, only waiting before the first byte so transfers never wait on each other
+    reserved = expected or chunk_size
+    if budget is not None:
+        budget.acquire(reserved)
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if budget is not None and size > reserved:
+                    # no or a wrong Content-Length, the reservation grows with the transfer
+                    budget.acquire(size - reserved, wait=False)
+                    reserved = size
+                f.write(chunk)
+                h.update(chunk)
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"{path.name} not complete after {size} bytes")
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        if budget is not None:
+            budget.release(reserved)
+    return size, h.hexdigest()
+
+
+async def astream_to_file(content, path: Path, budget: AsyncByteBudget = None, chunk_size=CHUNK_SIZE,
+                          expected: int = None) -> Tuple[int, str]:
+    # content is an aiohttp StreamReader, file io happens off the event loop
+    tmp = part_path(path)
+    h = hashlib.sha256()
+    size = 0
+    reserved = expected or chunk_size
+    if budget is not None:
+        await budget.acquire(reserved)
+    try:
+        f = await asyncio.to_thread(open, tmp, "wb")
+        try:
+            while True:
+                chunk = await content.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if budget is not None and size > reserved:
+                    await budget.acquire(size - reserved, wait=False)
+                    reserved = size
+                await asyncio.to_thread(f.write, chunk)
+                h.update(chunk)
+            await asyncio.to_thread(f.close)
+            await asyncio.to_thread(os.replace, tmp, path)
+        except BaseException:
+            f.close()
+            tmp.unlink(missing_ok=True)
+            raise
+    finally:
+        if budget is not None:
+            await budget.release(reserved)
+    return size, h.hexdigest()
+
+
+BYTE_BUDGET = ByteBudget()
@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+from fathomnet.api import boundingboxes, taxa
+from fathomnet.models import Taxa
+from fathomnet_cache import find_children
+from concept_counts import fetch_count, MAX_WORKERS
+from metrics import METRICS
+
+from typing import *
+import sys, time
+
+
+def node_id(parent: str, t: Taxa) -> str:
+    return f"{parent}__{t.name.replace(' ', '_')}"
+
+
+def explore_taxa(root: Taxa, provider='fathomnet', max_workers=MAX_WORKERS, with_counts=True):
+    # level-synchronous bfs, every find_children of a level runs at once and the counts of
+    # discovered nodes are fetched on a second pool while the next level is explored
+    nodes: List[Tuple[Taxa, str, str]] = []
+    leaves: Set[str] = set()
+    seen: Set[str] = set()
+    duplicates = 0
+    count_futures = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as explore_pool, \
+         ThreadPoolExecutor(max_workers=max_workers) as count_pool:
+
+        def _discover(t: Taxa, parent: str):
+            nonlocal duplicates
+            nid = node_id(parent, t)
+            if nid in seen:
+                duplicates += 1
+                return None
+            seen.add(nid)
+            nodes.append((t, parent, nid))
+            if with_counts and t.name not in count_futures:
+                count_futures[t.name] = count_pool.submit(fetch_count, t.name)
+            return nid
+
+        level = [(root, _discover(root, "0"))]
+        depth = 0
+        while level:
+            futures = [explore_pool.submit(find_children, t.name, provider) for t, _ in level]
+            next_level = []
+            for (t, nid), future in zip(level, futures):
+                children = future.result()
+                if not children:
+                    leaves.add(nid)
+                for c in children:
+                    cid = _discover(c, nid)
+                    if cid is not None:
+                        next_level.append((c, cid))
+            depth += 1
+            level = next_level
+
+        counts = {name: f.result() for name, f in count_futures.items()}
+
+    METRICS.inc("taxa_explored_total", len(nodes))
+    METRICS.inc("taxa_duplicates_total", duplicates)
+    print(f"Search space size: {len(nodes)} / {len(leaves)} leaves, depth {depth}, {duplicates} duplicates skipped")
+    return nodes, leaves, counts
+
+
+def legacy_explore(_taxa: Taxa, provider='fathomnet'):
+    # the recursive, serial search of buildTreeBetter before explore_taxa, kept for the benchmark
+    searchSpace = []
+
+    def exploreSearchSpace(t: Taxa, parent):
+        searchSpace.append((t, parent))
+        for c in taxa.find_children(provider, t.name):
+            exploreSearchSpace(c, node_id(parent, t))
+
+    exploreSearchSpace(_taxa, "0")
+    return {t.name: boundingboxes.count_by_concept(t.name).count for t, _ in searchSpace}
+
+
+def benchmark(depth=4, fanout=5, latency=0.02):
+    import fathomnet.api, tempfile
+    from pathlib import Path
+    from fathomnet_cache import Cache, set_cache
+    from fake_fathomnet import FakeFathomNet, Taxonomy
+
+    with FakeFathomNet(Taxonomy(classes=1, depth=depth, fanout=fanout, images_per_node=1), latency=latency) as fake:
+        fathomnet.api.EndpointManager.ROOT = fake.url
+        root = Taxa(name="C0", rank="class")
+
+        start = time.perf_counter()
+        legacy = legacy_explore(root)
+        legacy_time = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # an empty cache, so every call still goes to the server
+            set_cache(Cache(Path(tmp) / "cache.sqlite"))
+            start = time.perf_counter()
+            _, _, counts = explore_taxa(root)
+            bfs_time = time.perf_counter() - start
+
+    assert counts == legacy, "explore_taxa disagrees with the recursive search"
+    print(f"{len(legacy)} taxa, {2 * len(legacy)} requests at {latency * 1000:.0f}ms latency")
+    print(f"recursive + serial counts: {legacy_time:.2f}s")
+    print(f"bfs + streamed counts:     {bfs_time:.2f}s ({legacy_time / bfs_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    benchmark(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,203 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import *
+import hashlib, json, os, sys
+
+import numpy as np
+from annotation_index import AnnotationIndex
+from fathomnet_cache import phylogeny_up
+from lineage_index import load_lineage
+
+RESOLVE_WORKERS = 16
+# matplotlib tab20, as used by to_coco.ipynb
+TAB20 = [(31, 119, 180), (174, 199, 232), (255, 127, 14), (255, 187, 120), (44, 160, 44), (152, 223, 138), (214, 39, 40),
+         (255, 152, 150), (148, 103, 189), (197, 176, 213), (140, 86, 75), (196, 156, 148), (227, 119, 194), (247, 182, 210),
+         (127, 127, 127), (199, 199, 199), (188, 189, 34), (219, 219, 141), (23, 190, 207), (158, 218, 229)]
+OTHER_ID = -1
+
+
+def get_concept_lookup(root: Path) -> Dict[str, str]:
+    lineage = load_lineage(root)
+    if lineage is not None:
+        # every concept of the downloaded trees, no directory walk
+        lkup = {}
+        for concept, entry in lineage.concepts.items():
+            lkup[concept] = entry["superclass"].lower()
+            lkup.setdefault(entry["superclass"].lower(), entry["superclass"].lower())
+        return lkup
+
+    lkup = {}
+    for p in sorted(root.iterdir()):
+        if not p.is_dir() or p.name.startswith('.'):
+            continue
+        superconcept = p.name.lower()
+        for dirpath, dirnames, _ in os.walk(p):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            concept = os.path.basename(dirpath).replace('_', " ")
+            if concept in lkup and lkup[concept] != superconcept:
+                print(f"Conflict: {concept} found in both {lkup[concept]} and {superconcept}. => {lkup[concept]} overwritten.")
+            lkup[concept] = superconcept
+        lkup[superconcept] = superconcept
+    return lkup
+
+
+def read_lineage(json_data: Optional[dict]) -> List[str]:
+    names = []
+    while json_data and "name" in json_data:
+        names.append(json_data["name"])
+        json_data = json_data["children"][0] if json_data.get("children") else None
+    return names
+
+
+def resolve_labels(labels: Iterable[str], known: Dict[str, int], max_workers=RESOLVE_WORKERS) -> Dict[str, int]:
+    # labels outside the downloaded tree map to their closest known ancestor, or "other"
+    unknown = sorted(set(labels) - set(known))
+
+    def _resolve(label):
+        try:
+            lineage = read_lineage(phylogeny_up(label))
+        except Exception as e:
+            print(f"{label}: phylogeny lookup failed {e}")
+            return OTHER_ID
+        for name in reversed(lineage):
+            if name in known:
+                return known[name]
+        return OTHER_ID
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        resolved = dict(zip(unknown, executor.map(_resolve, unknown)))
+    print(f"resolved {sum(v != OTHER_ID for v in resolved.values())}/{len(unknown)} unknown labels")
+    return resolved
+
+
+def split_of(uuid: str, val_fraction: float) -> str:
+    # stable across runs and machines, an image never moves between splits
+    h = int.from_bytes(hashlib.sha1(uuid.encode()).digest()[:8], "big")
+    return "val" if h / 2**64 < val_fraction else "train"
+
+
+class CocoWriter:
+    # writes the json incrementally, images first then annotations, nothing is held in memory
+    def __init__(self, path: Path, header: dict):
+        self.path = Path(path)
+        self.tmp = self.path.with_name(self.path.name + ".tmp")
+        self.f = open(self.tmp, "w")
+        self.f.write("{")
+        for key, value in header.items():
+            self.f.write(f"{json.dumps(key)}: {json.dumps(value)}, ")
+        self.section = None
+        self.first = True
+        self.counts = {}
+
+    def _begin(self, section):
+        if self.section == section:
+            return
+        if self.section is not None:
+            self.f.write("], ")
+        self.f.write(f'"{section}": [')
+        self.section = section
+        self.first = True
+        self.counts[section] = 0
+
+    def write(self, section: str, item: dict):
+        self._begin(section)
+        self.f.write(("" if self.first else ", ") + json.dumps(item))
+        self.first = False
+        self.counts[section] += 1
+
+    def close(self):
+        for section in ("images", "annotations"):
+            if section not in self.counts:
+                self._begin(section)
+        self.f.write("]}")
+        self.f.close()
+        os.replace(self.tmp, self.path)
+
+
+def export_coco(image_dir: Path, output: Path, val_fraction: float = 0.0):
+    image_dir = Path(image_dir)
+    output = Path(output)
+    index = AnnotationIndex.build(image_dir)
+
+    cpt_lkup = get_concept_lookup(image_dir)
+    categories = [dict(id=i, name=cpt, supercategory=supercpt, isthing=1, color=[0, 0, 0])
+                  for i, (cpt, supercpt) in enumerate(cpt_lkup.items())]
+    categories.append(dict(id=OTHER_ID, name="other", supercategory="other", isthing=1, color=[0, 0, 0]))
+    supercategories = [dict(id=i, name=supercpt, colors=list(TAB20[i % len(TAB20)]))
+                       for i, supercpt in enumerate(dict.fromkeys(cpt_lkup.values()))]
+
+    concept_ids = {c["name"]: c["id"] for c in categories[:-1]}
+    concept_ids.update(resolve_labels(index.names, concept_ids))
+    label_ids = np.array([concept_ids[n] for n in index.names], dtype=np.int64)
+
+    header = dict(info=dict(year=datetime.now().year,
+                            version=1,
+                            description="A dataset of images of sessile benthos, derived from Fathomnet",
+                            contributor="Fathomnet, compiled by Linus Leong",
+                            url="",
+                            data_created=datetime.now().isoformat()),
+                  licenses=[dict(id=0, name="FathomNet", url="https://fathomnet.org/")],
+                  categories=categories,
+                  supercategories=supercategories)
+
+    if val_fraction > 0:
+        writers = {s: CocoWriter(output.with_name(f"{output.stem}_{s}{output.suffix}"), header) for s in ("train", "val")}
+    else:
+        writers = {"train": CocoWriter(output, header)}
+
+    # the same image is downloaded under every concept it contains, it is exported once
+    image_split = {}
+    image_ids = np.full(len(index), -1, dtype=np.int64)
+    for i in range(len(index)):
+        uuid = index.uuid(i)
+        if uuid in image_split:
+            continue
+        split = split_of(uuid, val_fraction) if val_fraction > 0 else "train"
+        image_split[uuid] = split
+        image_ids[i] = i
+        image_path = index.image_path(i)
+        writers[split].write("images", dict(id=i,
+                                            width=int(index.files["width"][i]),
+                                            height=int(index.files["height"][i]),
+                                            file_name=image_path.relative_to(image_dir).as_posix()))
+
+    boxes = index.boxes
+    keep = image_ids[boxes["file"]] >= 0
+    bad = keep & ((boxes["xmax"] <= boxes["xmin"]) | (boxes["ymax"] <= boxes["ymin"]))
+    for b in np.flatnonzero(bad):
+        print(f"bad bound box: {index.files['path'][boxes['file'][b]]}")
+    keep &= ~bad
+
+    for b in np.flatnonzero(keep):
+        f = int(boxes["file"][b])
+        xmin, ymin, xmax, ymax = (int(boxes[c][b]) for c in ("xmin", "ymin", "xmax", "ymax"))
+        aw, ah = xmax - xmin, ymax - ymin
+        writers[image_split[index.uuid(f)]].write("annotations", dict(
+            id=int(b),
+            image_id=f,
+            category_id=int(label_ids[boxes["name"][b]]),
+            area=ah * aw,
+            segmentation=[[xmin, ymin, xmax, ymin, xmax, ymax, xmin, ymax]],
+            bbox=[xmin, ymin, aw, ah],
+            iscrowd=0))
+
+    for split, writer in writers.items():
+        writer.close()
+        print(f"{writer.path}: {writer.counts.get('images', 0)} images, {writer.counts.get('annotations', 0)} annotations")
+    return {split: writer.counts for split, writer in writers.items()}
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    val_fraction = 0.0
+    if "--val" in args:
+        i = args.index("--val")
+        val_fraction = float(args[i + 1])
+        del args[i: i + 2]
+
+    if len(args) < 2:
+        print(f"Syntax: {sys.argv[0]} <image_dir> <coco json> [--val fraction]")
+        sys.exit(1)
+
+    export_coco(Path(args[0]), Path(args[1]), val_fraction)
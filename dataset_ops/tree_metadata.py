@@ -0,0 +1,211 @@
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import *
+import json, os, pickle, sys, time
+
+from treelib import Tree
+from compact_tree import CompactTree
+
+FORMAT = "fathomnet-tree"
+VERSION = 1
+SUFFIX = ".tree.json"
+TREE_MODULES = ("__main__", "download_threaded", "download_edit", "download_async")
+
+
+class MyTree(Tree):
+    pass
+
+
+@dataclass
+class Count:
+    count: int
+    accumulated_count: int = 0
+
+
+class TreeUnpickler(pickle.Unpickler):
+    # the downloaders pickled their trees as __main__.MyTree, load them without importing the downloaders
+    def find_class(self, module, name):
+        if module in TREE_MODULES and name == "MyTree":
+            return MyTree
+        if module in TREE_MODULES and name == "Count":
+            return Count
+        return super().find_class(module, name)
+
+
+def load_tree_pickle(path: Path) -> Tree:
+    with open(path, "rb") as f:
+        return TreeUnpickler(f).load()
+
+
+def dump_compact(compact: CompactTree, path: Path, name: str):
+    data = dict(format=FORMAT,
+                version=VERSION,
+                name=name,
+                names=compact.names,
+                ranks=compact.ranks,
+                parent=compact.parent.tolist(),
+                name_id=compact.name.tolist(),
+                rank_id=compact.rank.tolist(),
+                count=compact.count.tolist(),
+                accumulated=compact.accumulated.tolist())
+    tmp = Path(path).with_name(Path(path).name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def load_compact(path: Path) -> CompactTree:
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("format") != FORMAT or data.get("version") != VERSION:
+        raise ValueError(f"{path}: unsupported tree metadata {data.get('format')} v{data.get('version')}")
+
+    compact = CompactTree()
+    compact.names = data["names"]
+    compact.ranks = data["ranks"]
+    compact._name_ids = {n: i for i, n in enumerate(compact.names)}
+    compact._rank_ids = {r: i for i, r in enumerate(compact.ranks)}
+    compact.parent = array('l', data["parent"])
+    compact.name = array('l', data["name_id"])
+    compact.rank = array('l', data["rank_id"])
+    compact.count = array('q', data["count"])
+    compact.accumulated = array('q', data["accumulated"])
+    return compact
+
+
+def compact_from_tree(tree: Tree, rootID=0, accumulated=False) -> CompactTree:
+    compact, _ = CompactTree.from_tree(tree, rootID)
+    if not accumulated:
+        compact.accumulate()
+        return compact
+
+    # the counts already hold subtree totals, a node's own count is what its children leave over
+    compact.accumulated = array('q', compact.count)
+    for i in range(1, len(compact)):
+        compact.count[compact.parent[i]] -= compact.accumulated[i]
+    return compact
+
+
+def tree_name(path: Path) -> str:
+    path = Path(path)
+    return path.name[:-len(SUFFIX)] if path.name.endswith(SUFFIX) else path.stem
+
+
+def has_subtree_totals(tree: Tree) -> bool:
+    # the old async downloader replaced Count with Count(total) and never set accumulated_count
+    root = tree.get_node(tree.root) if tree.root is not None else None
+    return root is not None and "accumulated_count" not in vars(root.data)
+
+
+def load_tree(path: Path) -> CompactTree:
+    # new metadata or a legacy pickle, both come back as a CompactTree
+    path = Path(path)
+    if path.name.endswith(SUFFIX):
+        return load_compact(path)
+    tree = load_tree_pickle(path)
+    return compact_from_tree(tree, accumulated=has_subtree_totals(tree))
+
+
+class LazyTree:
+    # the arrays are all most readers need, the treelib tree is only built on first use
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.name = tree_name(path)
+        self._compact = None
+        self._tree = None
+
+    @property
+    def compact(self) -> CompactTree:
+        if self._compact is None:
+            self._compact = load_tree(self.path)
+        return self._compact
+
+    @property
+    def tree(self) -> Tree:
+        if self._tree is None:
+            self._tree = self.compact.to_tree(MyTree(), 0, data=Count)
+        return self._tree
+
+
+def save_tree(tree: Tree, name: str, output: Path, rootID=0, accumulated=False):
+    # cleanupTree removes the root of a class without any images
+    if rootID not in tree:
+        print(f"{name}: empty tree, no metadata written")
+        return
+    compact = compact_from_tree(tree, rootID, accumulated)
+    dump_compact(compact, Path(output) / f"{name}{SUFFIX}", name)
+
+
+def tree_files(metadata_dir: Path) -> Dict[str, Path]:
+    # one file per class, the new format wins over a pickle of the same class
+    files = {}
+    for p in sorted(Path(metadata_dir).glob("*.pickle")):
+        files[tree_name(p)] = p
+    for p in sorted(Path(metadata_dir).glob(f"*{SUFFIX}")):
+        files[tree_name(p)] = p
+    return files
+
+
+def migrate(metadata_dir: Path):
+    for name, path in tree_files(metadata_dir).items():
+        if path.suffix == ".pickle":
+            dump_compact(load_tree(path), path.with_name(f"{name}{SUFFIX}"), name)
+            print(f"{path.name} -> {name}{SUFFIX}")
+
+
+def synthetic_tree(n: int, fanout=8) -> MyTree:
+    tree = MyTree()
+    tree.create_node("Synthetic", 0, data=Count(0, 0))
+    ids = [0]
+    for i in range(1, n):
+        parent = ids[(i - 1) // fanout]
+        nid = f"{parent}_c{i}"
+        tree.create_node(f"(species.)c{i}", nid, parent, Count(i % 7, 0))
+        ids.append(nid)
+    return tree
+
+
+def benchmark(metadata_dir: Path = None, n=50_000, repeat=3):
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        if metadata_dir:
+            pickles = sorted(Path(metadata_dir).glob("*.pickle"), key=lambda p: p.stat().st_size, reverse=True)[:3]
+        else:
+            pickles = [tmp / "Synthetic.pickle"]
+            with open(pickles[0], "wb") as f:
+                pickle.dump(synthetic_tree(n), f)
+
+        for p in pickles:
+            compact_path = tmp / f"{tree_name(p)}{SUFFIX}"
+            dump_compact(load_tree(p), compact_path, tree_name(p))
+
+            def _best(func):
+                times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    func()
+                    times.append(time.perf_counter() - start)
+                return min(times)
+
+            pickle_time = _best(lambda: load_tree_pickle(p))
+            compact_time = _best(lambda: load_compact(compact_path))
+            tree_time = _best(lambda: LazyTree(compact_path).tree)
+            print(f"{p.name}: {len(load_compact(compact_path))} nodes, "
+                  f"pickle {p.stat().st_size / 2**10:.0f}KiB, compact {compact_path.stat().st_size / 2**10:.0f}KiB")
+            print(f"  pickle load:          {pickle_time * 1000:.1f}ms")
+            print(f"  compact load:         {compact_time * 1000:.1f}ms")
+            print(f"  compact + treelib:    {tree_time * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    if command == "migrate":
+        migrate(Path(sys.argv[2]))
+    elif command == "bench":
+        benchmark(Path(sys.argv[2]) if len(sys.argv) > 2 else None)
+    else:
+        print(f"Syntax: {sys.argv[0]} migrate <metadata_dir> | bench [metadata_dir]")
+        sys.exit(1)
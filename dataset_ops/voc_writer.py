@@ -0,0 +1,148 @@
+from fathomnet.models import AImageDTO, ABoundingBoxDTO
+from image_header import image_size
+
+from pathlib import Path
+from queue import Queue
+from typing import *
+from xml.sax.saxutils import escape
+import os, sys, tempfile, threading, time
+
+
+OBJECT_TEMPLATE = """    <object>
+        <name>{name}</name>
+        <pose>Unspecified</pose>
+        <truncated>0</truncated>
+        <difficult>0</difficult>
+        <bndbox>
+            <xmin>{xmin}</xmin>
+            <ymin>{ymin}</ymin>
+            <xmax>{xmax}</xmax>
+            <ymax>{ymax}</ymax>
+        </bndbox>
+    </object>"""
+
+# same layout pascal_voc_writer renders, so existing readers keep working
+ANNOTATION_TEMPLATE = """<annotation>
+    <folder>{folder}</folder>
+    <filename>{filename}</filename>
+    <path>{path}</path>
+    <source>
+        <database>{database}</database>
+    </source>
+    <size>
+        <width>{width}</width>
+        <height>{height}</height>
+        <depth>{depth}</depth>
+    </size>
+    <segmented>0</segmented>
+{objects}
+</annotation>
+"""
+
+
+def voc_xml(image_data: AImageDTO, image_path: Path, width=None, height=None, depth=3, database='FathomNet') -> str:
+    abspath = os.path.abspath(image_path)
+    objects = "".join(OBJECT_TEMPLATE.format(name=escape(box.concept),
+                                             xmin=box.x,
+                                             ymin=box.y,
+                                             xmax=box.x + box.width,
+                                             ymax=box.y + box.height)
+                      for box in image_data.boundingBoxes or [])
+    return ANNOTATION_TEMPLATE.format(folder=escape(os.path.basename(os.path.dirname(abspath))),
+                                      filename=escape(os.path.basename(abspath)),
+                                      path=escape(abspath),
+                                      database=database,
+                                      width=width,
+                                      height=height,
+                                      depth=depth,
+                                      objects=objects)
+
+
+def write_voc(image_data: AImageDTO, image_path: Path, xml_path: Path, database='FathomNet'):
+    width, height, depth = image_data.width, image_data.height, 3
+    if width is None or height is None:
+        # fathomnet sometimes has no size, read it from the image header instead of leaving "None"
+        size = image_size(image_path)
+        if size:
+            width, height, depth = size
+
+    # a crash must not leave a truncated xml that resume takes as written
+    xml_path = Path(xml_path)
+    tmp = xml_path.with_suffix(".xml.tmp")
+    with open(tmp, "w") as f:
+        f.write(voc_xml(image_data, image_path, width, height, depth, database))
+    os.replace(tmp, xml_path)
+
+
+class AnnotationWriter(threading.Thread):
+    # a single thread drains the queue so callers never block on annotation io
+    def __init__(self, max_queue=10_000):
+        super().__init__(daemon=True)
+        self.queue = Queue(maxsize=max_queue)
+        self.written = 0
+        self.failed = 0
+        self.start()
+
+    def submit(self, image_data: AImageDTO, image_path: Path, xml_path: Path, callback: Callable = None, block=True):
+        # raises queue.Full when not blocking and the writer is behind
+        self.queue.put((image_data, image_path, xml_path, callback), block)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            image_data, image_path, xml_path, callback = item
+            try:
+                write_voc(image_data, image_path, xml_path)
+                self.written += 1
+                if callback:
+                    callback()
+            except Exception as e:
+                self.failed += 1
+                print(f"{xml_path}: failed to write annotation {e}")
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+
+def benchmark(n=2000, boxes=4):
+    from pascal_voc_writer import Writer
+
+    samples = [AImageDTO(uuid=f"{i:08d}", url=f"https://example.org/{i:08d}.png", width=1920, height=1080,
+                         boundingBoxes=[ABoundingBoxDTO(concept="Elpidiidae", x=10 * b, y=20 * b, width=100, height=50)
+                                        for b in range(boxes)])
+               for i in range(n)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        start = time.perf_counter()
+        for s in samples:
+            writer = Writer(tmp / f"{s.uuid}.png", s.width, s.height, database='FathomNet')
+            for box in s.boundingBoxes:
+                writer.addObject(box.concept, box.x, box.y, box.x + box.width, box.y + box.height)
+            writer.save(tmp / f"{s.uuid}.xml")
+        writer_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for s in samples:
+            write_voc(s, tmp / f"{s.uuid}.png", tmp / f"{s.uuid}.xml")
+        direct_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        writer = AnnotationWriter()
+        for s in samples:
+            writer.submit(s, tmp / f"{s.uuid}.png", tmp / f"{s.uuid}.xml")
+        writer.close()
+        threaded_time = time.perf_counter() - start
+
+    print(f"{n} annotations with {boxes} boxes each")
+    print(f"pascal_voc_writer: {writer_time:.2f}s ({n / writer_time:.0f}/s)")
+    print(f"write_voc:         {direct_time:.2f}s ({n / direct_time:.0f}/s)")
+    print(f"AnnotationWriter:  {threaded_time:.2f}s ({n / threaded_time:.0f}/s)")
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,5 @@
+from pathlib import Path
+import sys
+
+# the scripts in dataset_ops import each other as top level modules
+sys.path.insert(0, str(Path(__file__).parent.parent / "dataset_ops"))
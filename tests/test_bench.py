@@ -0,0 +1,17 @@
+from bench import benchmark
+from fake_fathomnet import Taxonomy
+import pytest
+
+
+def test_refuses_foreign_directory(tmp_path):
+    (tmp_path / "dataset.jpg").write_bytes(b"keep me")
+    with pytest.raises(FileExistsError):
+        benchmark(tmp_path, Taxonomy(depth=1, fanout=1), stages=[])
+    assert (tmp_path / "dataset.jpg").read_bytes() == b"keep me"
+
+
+def test_reuses_previous_run(tmp_path):
+    (tmp_path / "bench.json").write_text("{}")
+    (tmp_path / "stale").mkdir()
+    benchmark(tmp_path, Taxonomy(depth=1, fanout=1), stages=[])
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["bench.json"]
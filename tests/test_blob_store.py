@@ -0,0 +1,36 @@
+from blob_store import BlobStore
+from image_prefetch import ImageTable
+from types import SimpleNamespace
+
+
+def _fetch(path):
+    path.write_bytes(b"blob")
+    return 4, "sum"
+
+
+def test_locks_and_checksums_are_dropped(tmp_path):
+    store = BlobStore(tmp_path)
+    path, size, checksum = store.get_or_fetch("u1", ".png", _fetch)
+    assert (size, checksum) == (4, "sum")
+    assert not store._locks and not store._checksums
+
+
+def test_pinned_uuid_keeps_its_checksum(tmp_path):
+    store = BlobStore(tmp_path)
+    with store.pinned("u1"):
+        store.get_or_fetch("u1", ".png", _fetch)
+        # a second directory of the same job reuses the blob and its checksum
+        assert store.get_or_fetch("u1", ".png", _fetch)[1:] == (4, "sum")
+        assert store.stats() == dict(fetched=1, reused=1)
+    assert not store._locks and not store._checksums
+
+
+def test_work_list_groups_placements(tmp_path):
+    def _image(uuid):
+        return SimpleNamespace(uuid=uuid, url=f"http://unused/{uuid}.png", width=1, height=1, boundingBoxes=[])
+    dirs = [("a", tmp_path / "a"), ("b", tmp_path / "b"), ("c", tmp_path / "c")]
+    results = dict(a=[_image("u1"), _image("u2")], b=[_image("u1")], c=[_image("u1"), _image("u3")])
+
+    table = ImageTable.from_results(tmp_path, dirs, results)
+    jobs = [(image.uuid, [d.name for d in image_dirs]) for image, image_dirs in table.work_list()]
+    assert jobs == [("u1", ["a", "b", "c"]), ("u2", ["a"]), ("u3", ["c"])]
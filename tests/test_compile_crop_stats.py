@@ -0,0 +1,23 @@
+from compile_crop_stats import compile_stats
+from types import SimpleNamespace
+from voc_writer import voc_xml
+
+
+def _write(xml_dir, concept, uuid, box_size):
+    concept_dir = xml_dir / concept
+    concept_dir.mkdir(parents=True, exist_ok=True)
+    box = SimpleNamespace(concept=concept, x=0, y=0, width=box_size, height=box_size)
+    image = SimpleNamespace(boundingBoxes=[box])
+    (concept_dir / f"{uuid}.xml").write_text(voc_xml(image, concept_dir / f"{uuid}.png", 1000, 1000))
+
+
+def test_concept_without_mode_ratio(tmp_path, capsys):
+    xml_dir = tmp_path / "xmls"
+    _write(xml_dir, "large", "u1", 500)
+    # 1/1000 of the image is below the smallest log bin, the concept has no mode ratio
+    _write(xml_dir, "tiny", "u2", 1)
+
+    summary = compile_stats(xml_dir, tmp_path / "stats.csv", tmp_path / "summary.json")
+    assert summary["super_concepts"]["tiny"]["mode_ratio"] is None
+    assert summary["super_concepts"]["large"]["mode_ratio"] is not None
+    assert "tiny: 1 boxes, [1, 0, 0, 0], mode ratio n/a" in capsys.readouterr().out
@@ -0,0 +1,60 @@
+from crop_shards import ShardWriter, iter_samples, read_index, shard_paths
+import json
+
+
+def _write(output_dir, keys, max_count=2):
+    with ShardWriter(output_dir, max_count=max_count) as writer:
+        for key in keys:
+            writer.write(key, key.encode(), ".jpg", dict(key=key))
+    return writer
+
+
+def test_roundtrip(tmp_path):
+    _write(tmp_path, [f"a/{i}" for i in range(5)])
+    assert [p.name for p in shard_paths(tmp_path)] == ["crops-000000.tar", "crops-000001.tar", "crops-000002.tar"]
+    samples = list(iter_samples(tmp_path))
+    assert [s["key"] for s in samples] == [f"a/{i}" for i in range(5)]
+    assert samples[3]["jpg"] == b"a/3" and samples[3]["json"] == dict(key="a/3")
+
+
+def test_index_is_append_only(tmp_path):
+    _write(tmp_path, [f"a/{i}" for i in range(5)])
+    lines = (tmp_path / ShardWriter.INDEX).read_text().splitlines()
+    # one line per shard, each holding only its own keys
+    assert [json.loads(l)["keys"] for l in lines] == [["a/0", "a/1"], ["a/2", "a/3"], ["a/4"]]
+
+
+def test_resume_skips_written_keys(tmp_path):
+    _write(tmp_path, [f"a/{i}" for i in range(4)])
+    writer = _write(tmp_path, [f"a/{i}" for i in range(6)])
+    assert [s["name"] for s in writer.shards] == ["crops-000000.tar", "crops-000001.tar", "crops-000002.tar"]
+    assert [s["key"] for s in iter_samples(tmp_path)] == [f"a/{i}" for i in range(6)]
+
+
+def test_missing_shard_is_rewritten_under_a_new_name(tmp_path):
+    _write(tmp_path, [f"a/{i}" for i in range(6)])
+    (tmp_path / "crops-000001.tar").unlink()
+    writer = _write(tmp_path, [f"a/{i}" for i in range(6)])
+    # the lost keys go to a new shard, the surviving crops-000002.tar is not overwritten
+    assert [s["name"] for s in writer.shards] == ["crops-000000.tar", "crops-000002.tar", "crops-000003.tar"]
+    assert sorted(s["key"] for s in iter_samples(tmp_path)) == [f"a/{i}" for i in range(6)]
+
+
+def test_unindexed_tar_is_not_overwritten(tmp_path):
+    _write(tmp_path, ["a/0", "a/1"])
+    (tmp_path / "crops-000001.tar").write_bytes(b"not indexed")
+    writer = _write(tmp_path, ["a/2"])
+    assert writer.shards[-1]["name"] == "crops-000002.tar"
+    assert (tmp_path / "crops-000001.tar").read_bytes() == b"not indexed"
+
+
+def test_truncated_index_line(tmp_path):
+    _write(tmp_path, [f"a/{i}" for i in range(4)])
+    with open(tmp_path / ShardWriter.INDEX, "a") as f:
+        f.write('{"name": "crops-0000')
+    assert len(read_index(tmp_path)) == 2
+    writer = _write(tmp_path, [f"a/{i}" for i in range(5)])
+    assert "a/4" in writer and len(writer.shards) == 3
+    # the entry written after the truncated one survives the next resume
+    assert len(read_index(tmp_path)) == 3
+    assert len(ShardWriter(tmp_path).shards) == 3
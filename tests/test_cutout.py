@@ -0,0 +1,35 @@
+from cutout import crop_image, crop_path
+from PIL import Image
+import cutout
+import pytest
+
+
+def _image(tmp_path):
+    image_path = tmp_path / "u1.jpg"
+    Image.new("RGB", (64, 48), (200, 10, 10)).save(image_path)
+    return image_path
+
+
+def test_crops_are_complete_files(tmp_path):
+    image_path = _image(tmp_path)
+    out = tmp_path / "crops"
+    # a .part left by a killed worker does not count as a finished crop
+    out.mkdir()
+    (out / "u1-0.jpg.part").write_bytes(b"\xff\xd8truncated")
+
+    assert crop_image(image_path, [(0, 0, 32, 32), (10, 10, 40, 40)], out) == (2, 0)
+    assert sorted(p.name for p in out.iterdir()) == ["u1-0.jpg", "u1-1.jpg"]
+    assert Image.open(crop_path(out, image_path, 1)).size == (30, 30)
+    assert crop_image(image_path, [(0, 0, 32, 32), (10, 10, 40, 40)], out) == (0, 2)
+
+
+def test_interrupted_write_leaves_nothing(tmp_path, monkeypatch):
+    image_path = _image(tmp_path)
+    out = tmp_path / "crops"
+
+    def _killed(src, dst):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(cutout.os, "replace", _killed)
+    with pytest.raises(KeyboardInterrupt):
+        crop_image(image_path, [(0, 0, 32, 32)], out)
+    assert list(out.iterdir()) == []
@@ -0,0 +1,95 @@
+from fake_fathomnet import FakeFathomNet, Taxonomy
+from rate_control import AsyncAIMDController
+import download_async
+from queue import Full
+from types import SimpleNamespace
+import asyncio, threading
+
+
+def _tree():
+    tree = download_async.MyTree()
+    tree.create_node("ROOT", 0)
+    tree.create_node("broken", 1, parent=0)
+    tree.create_node("fine", 2, parent=0)
+    return tree
+
+
+def test_node_failure_does_not_cancel_siblings(tmp_path, monkeypatch):
+    def _images_data(concept):
+        if concept == "broken":
+            raise RuntimeError("metadata unavailable")
+        return []
+    monkeypatch.setattr(download_async, "download_images_data", _images_data)
+
+    asyncio.run(download_async.download_tree(None, _tree(), 0, tmp_path))
+    assert (tmp_path / "fine").is_dir()
+
+
+def test_image_failure_is_counted(tmp_path, monkeypatch):
+    monkeypatch.setattr(download_async, "download_images_data", lambda concept: [SimpleNamespace(url=u) for u in "ab"])
+
+    async def _download_and_annotate(session, data, *args):
+        if data.url == "a":
+            raise RuntimeError("disk full")
+    monkeypatch.setattr(download_async, "download_and_annotate", _download_and_annotate)
+
+    stats = asyncio.run(download_async.download_tree(None, _tree(), 0, tmp_path))
+    # one failed image in each of the two nodes, the other images still ran
+    assert stats.errors == 2
+
+
+def test_notify_tasks_are_kept_until_done():
+    async def _run():
+        controller = AsyncAIMDController(initial=2)
+        async with controller.slot() as slot:
+            slot.observe(200, 0.01)
+        assert len(controller._tasks) == 1
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return controller
+    assert not asyncio.run(_run())._tasks
+
+
+def test_bounded_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(download_async, "download_images_data", lambda concept: [SimpleNamespace(url=f"{concept}{i}") for i in range(10)])
+    running = 0
+    peak = 0
+    done = []
+
+    async def _download_and_annotate(session, data, *args):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.001)
+        running -= 1
+        done.append(data.url)
+    monkeypatch.setattr(download_async, "download_and_annotate", _download_and_annotate)
+
+    asyncio.run(download_async.download_tree(None, _tree(), 0, tmp_path, workers=3))
+    assert len(done) == 20
+    assert peak == 3
+
+
+def test_full_writer_does_not_block_the_loop(tmp_path):
+    class _Writer:
+        # stands in for an AnnotationWriter whose queue is full
+        def __init__(self):
+            self.submitted = []
+
+        def submit(self, image_data, image_path, xml_path, callback=None, block=True):
+            if not block:
+                raise Full
+            self.submitted.append((threading.get_ident(), xml_path))
+
+    writer = _Writer()
+    with FakeFathomNet(Taxonomy(classes=1, depth=1, fanout=1)) as fake:
+        uuid = next(iter(fake.taxonomy.images))
+        image = SimpleNamespace(uuid=uuid, url=f"{fake.url}/img/{uuid}.png")
+
+        async def _run():
+            async with download_async.make_session() as session:
+                await download_async.download_and_annotate(session, image, tmp_path, writer=writer)
+        asyncio.run(_run())
+    # the blocking submit ran on a worker thread, not on the event loop
+    assert [xml for _, xml in writer.submitted] == [tmp_path / f"{uuid}.xml"]
+    assert writer.submitted[0][0] != threading.get_ident()
@@ -0,0 +1,66 @@
+from cache_index import CacheIndex
+from download_manifest import DownloadManifest, file_sha256
+from types import SimpleNamespace
+import download_threaded
+
+
+def _seed(tmp_path):
+    cached = tmp_path / "cached" / "C0"
+    cached.mkdir(parents=True)
+    (cached / "u1.png").write_bytes(b"image bytes")
+    (cached / "u1.xml").write_text("<annotation/>")
+    index = CacheIndex(tmp_path / "cached")
+    index.refresh()
+    return index
+
+
+def test_cached_images_are_not_hashed(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    image = SimpleNamespace(uuid="u1", url="http://unused/u1.png")
+    with DownloadManifest(out) as manifest:
+        download_threaded.download_and_annotate(image, out, _seed(tmp_path), manifest)
+        entry = manifest.get(out / "u1.png")
+        assert entry['size'] == len(b"image bytes")
+        assert entry['sha256'] is None
+        assert manifest.is_complete(out / "u1.png")
+    assert (out / "u1.xml").exists()
+
+
+def test_fill_checksums(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    (out / "u1.png").write_bytes(b"image bytes")
+    with DownloadManifest(out) as manifest:
+        manifest.record("u1", "http://unused/u1.png", out / "u1.png", 11, None)
+        assert manifest.fill_checksums() == 1
+        assert manifest.fill_checksums() == 0
+    # the filled in entry was appended to the journal and wins on reload
+    with DownloadManifest(out) as manifest:
+        assert manifest.get(out / "u1.png")['sha256'] == file_sha256(out / "u1.png")
+
+
+def test_files_from_earlier_runs_are_adopted(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    (out / "u1.png").write_bytes(b"earlier run")
+    (out / "u1.xml").write_text("<annotation/>")
+    # the url is never fetched, an attempt would fail to connect
+    image = SimpleNamespace(uuid="u1", url="http://127.0.0.1:9/u1.png")
+    with DownloadManifest(out) as manifest:
+        download_threaded.download_and_annotate(image, out, manifest=manifest)
+        assert manifest.is_complete(out / "u1.png")
+    assert (out / "u1.png").read_bytes() == b"earlier run"
+    assert (out / "u1.xml").read_text() == "<annotation/>"
+
+
+def test_cached_xml_removed_after_indexing(tmp_path):
+    index = _seed(tmp_path)
+    (tmp_path / "cached" / "C0" / "u1.xml").unlink()
+    out = tmp_path / "out"
+    out.mkdir()
+    image = SimpleNamespace(uuid="u1", url="http://unused/u1.png", width=4, height=3, boundingBoxes=[])
+    with DownloadManifest(out) as manifest:
+        download_threaded.download_and_annotate(image, out, index, manifest)
+        assert manifest.is_complete(out / "u1.png")
+    assert "<width>4</width>" in (out / "u1.xml").read_text()
@@ -0,0 +1,112 @@
+from fake_fathomnet import FakeFathomNet, Taxonomy
+from fathomnet_cache import Cache, CacheMiss, count_by_concept, find_children, phylogeny_down, set_cache
+import fathomnet.api
+import fathomnet_cache
+import time
+import pytest
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    with FakeFathomNet(Taxonomy(classes=1, depth=2, fanout=2)) as fake:
+        # the same seams FATHOMNET_API_URL and FATHOMNET_DSG_URL set at import
+        monkeypatch.setattr(fathomnet.api.EndpointManager, "ROOT", fake.url)
+        monkeypatch.setattr(fathomnet_cache, "DSG_URL", f"{fake.url}/dsg")
+        monkeypatch.setattr(fathomnet_cache, "_cache", None)
+        yield fake
+
+
+def _requests(fake):
+    return [kind for kind, _, _ in fake.reset_log()]
+
+
+def test_hit_avoids_remote_call(fake, tmp_path):
+    cache = Cache(tmp_path / "cache.sqlite")
+    set_cache(cache)
+    assert count_by_concept("C0-0") == fake.taxonomy.count("C0-0")
+    assert phylogeny_down("C0")["name"] == "C0"
+    assert [t.name for t in find_children("C0")] == ["C0-0", "C0-1"]
+    assert _requests(fake) == ["count", "phylogeny", "children"]
+
+    assert count_by_concept("C0-0") == fake.taxonomy.count("C0-0")
+    assert phylogeny_down("C0")["name"] == "C0"
+    assert [t.name for t in find_children("C0")] == ["C0-0", "C0-1"]
+    assert _requests(fake) == []
+    assert cache.hits == 3 and cache.misses == 3
+
+
+def test_persists_across_instances(fake, tmp_path):
+    set_cache(Cache(tmp_path / "cache.sqlite"))
+    phylogeny_down("C0")
+    set_cache(Cache(tmp_path / "cache.sqlite"))
+    phylogeny_down("C0")
+    assert _requests(fake) == ["phylogeny"]
+
+
+def test_ttl_expiry_refetches(fake, tmp_path):
+    set_cache(Cache(tmp_path / "cache.sqlite", ttl=0.2))
+    count_by_concept("C0")
+    count_by_concept("C0")
+    assert _requests(fake) == ["count"]
+    time.sleep(0.3)
+    count_by_concept("C0")
+    assert _requests(fake) == ["count"]
+
+
+def test_eviction_at_size_cap(tmp_path):
+    cache = Cache(tmp_path / "cache.sqlite", max_entries=5)
+    for i in range(10):
+        cache.put("test", str(i), i)
+    time.sleep(0.01)
+    # recently read entries survive, the least recently accessed go first
+    for i in (0, 1):
+        assert cache.get("test", str(i)) == i
+    cache.evict()
+    assert cache.stats()["entries"] == 5
+    assert cache.get("test", "0") == 0 and cache.get("test", "1") == 1
+    assert sum(cache.get("test", str(i)) is not None for i in range(10)) == 5
+
+
+def test_eviction_runs_on_put(tmp_path, monkeypatch):
+    cache = Cache(tmp_path / "cache.sqlite", max_entries=10)
+    for i in range(1000):
+        cache.put("test", str(i), i)
+    assert cache.stats()["entries"] == 10
+
+
+def test_offline_miss_raises(fake, tmp_path):
+    set_cache(Cache(tmp_path / "cache.sqlite", offline=True))
+    with pytest.raises(CacheMiss):
+        count_by_concept("C0")
+    with pytest.raises(CacheMiss):
+        phylogeny_down("C0")
+    assert _requests(fake) == []
+
+
+def test_offline_serves_stale_entries(fake, tmp_path):
+    set_cache(Cache(tmp_path / "cache.sqlite", ttl=0.1))
+    count_by_concept("C0")
+    time.sleep(0.2)
+    set_cache(Cache(tmp_path / "cache.sqlite", ttl=0.1, offline=True))
+    assert count_by_concept("C0") == fake.taxonomy.count("C0")
+    assert _requests(fake) == ["count"]
+
+
+def test_eviction_keeps_stale_entries(tmp_path):
+    cache = Cache(tmp_path / "cache.sqlite", ttl=0.1)
+    for i in range(1000):
+        cache.put("test", str(i), i)
+    time.sleep(0.2)
+    # an online run evicting on put must leave the expired entries for offline mode
+    cache.put("test", "new", 0)
+    cache.evict()
+    assert cache.stats()["entries"] == 1001
+    cache.evict(stale=True)
+    assert cache.stats()["entries"] == 1
+
+
+def test_failed_fetch_is_not_cached(fake, tmp_path):
+    set_cache(Cache(tmp_path / "cache.sqlite"))
+    assert phylogeny_down("missing") is None
+    assert phylogeny_down("missing") is None
+    assert _requests(fake) == ["phylogeny", "phylogeny"]
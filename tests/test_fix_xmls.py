@@ -0,0 +1,36 @@
+from fix_xmls import check_fix_xml
+from PIL import Image
+import pytest
+import re
+
+XML = """<annotation>
+    <filename>{name}</filename>
+    <path>{name}</path>
+    <size>
+        <width>None</width>
+        <height>None</height>
+        <depth>3</depth>
+    </size>
+</annotation>
+"""
+
+
+@pytest.mark.parametrize("mode, depth", [("RGB", 3), ("RGBA", 4), ("L", 1)])
+def test_fixed_size_and_depth(tmp_path, mode, depth):
+    Image.new(mode, (40, 30)).save(tmp_path / "a.png")
+    xml_path = tmp_path / "a.xml"
+    xml_path.write_text(XML.format(name="a.png"))
+
+    assert check_fix_xml(xml_path) == "fixed"
+    xml = xml_path.read_text()
+    assert re.search(r"<width>40</width>\s*<height>30</height>\s*<depth>(\d+)</depth>", xml).group(1) == str(depth)
+    assert check_fix_xml(xml_path) == "ok"
+
+
+def test_corrupt_image(tmp_path):
+    (tmp_path / "a.png").write_bytes(b"not an image")
+    xml_path = tmp_path / "a.xml"
+    xml_path.write_text(XML.format(name="a.png"))
+
+    assert check_fix_xml(xml_path) == "error"
+    assert "<width>None</width>" in xml_path.read_text()
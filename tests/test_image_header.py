@@ -0,0 +1,19 @@
+from image_header import image_size
+from PIL import Image
+import pytest
+
+
+@pytest.mark.parametrize("mode, ext", [("RGB", ".png"), ("RGBA", ".png"), ("L", ".png"), ("LA", ".png"), ("P", ".png"),
+                                       ("RGB", ".jpg"), ("L", ".jpg")])
+def test_image_size_matches_pil(tmp_path, mode, ext):
+    path = tmp_path / f"img{ext}"
+    Image.new(mode, (37, 21)).save(path)
+    with Image.open(path) as img:
+        expected = (*img.size, len(img.getbands()) if img.mode != "P" else 3)
+    assert image_size(path) == expected
+
+
+def test_image_size_unknown_format(tmp_path):
+    path = tmp_path / "img.bmp"
+    Image.new("RGB", (5, 5)).save(path)
+    assert image_size(path) is None
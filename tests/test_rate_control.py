@@ -0,0 +1,163 @@
+from fake_fathomnet import FakeFathomNet, Taxonomy
+from rate_control import AIMDController, AsyncAIMDController, RETRIES
+import download_threaded
+import asyncio, time
+import pytest
+
+
+def _complete(controller, status, latency=0.01, retry_after=None):
+    with controller.slot() as slot:
+        if status is not None:
+            slot.observe(status, latency, retry_after)
+
+
+def test_additive_growth():
+    controller = AIMDController(initial=2, maximum=4)
+    for _ in range(2):
+        _complete(controller, 200)
+    # each success adds 1/limit, about one slot per window of `limit` successes
+    assert controller.limit == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+    for _ in range(100):
+        _complete(controller, 200)
+    assert controller.limit == 4
+    assert controller.completed == 102
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_multiplicative_decrease(status):
+    controller = AIMDController(initial=16)
+    _complete(controller, status)
+    assert controller.limit == 8
+    # at most one decrease per latency period, a burst of failures only halves once
+    _complete(controller, status)
+    assert controller.limit == 8
+
+
+def test_timeout_decreases():
+    controller = AIMDController(initial=16)
+    # leaving the slot without a status is a timeout or connection error, its latency is the time spent in the slot
+    with controller.slot():
+        time.sleep(0.05)
+    assert controller.limit == 8
+    assert controller.errors == 1 and controller.inflight == 0
+
+
+def test_slow_success_decreases():
+    controller = AIMDController(initial=16, target_latency=0.5)
+    _complete(controller, 200, latency=1.0)
+    assert controller.limit == 8
+
+
+def test_decrease_stops_at_minimum():
+    controller = AIMDController(initial=2, minimum=1)
+    for _ in range(3):
+        controller.last_decrease = 0.0
+        _complete(controller, 500)
+    assert controller.limit == 1
+
+
+def test_retry_after_pauses():
+    controller = AIMDController(initial=4)
+    _complete(controller, 429, retry_after=0.3)
+    assert controller.throttled == 1
+    assert not controller._ready()
+    start = time.monotonic()
+    controller.acquire()
+    assert time.monotonic() - start >= 0.2
+    controller._release(0.01, 200)
+
+
+def test_async_controller():
+    async def _run():
+        controller = AsyncAIMDController(initial=4)
+        async with controller.slot() as slot:
+            slot.observe(503, 0.01, 0.2)
+        assert controller.limit == 2
+        async with controller.slot():
+            pass
+        assert controller.errors == 1
+        return controller
+
+    controller = asyncio.run(_run())
+    assert controller.inflight == 0
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download_threaded, "backoff_delay", lambda attempt: 0)
+
+
+def _image_url(fake):
+    return f"{fake.url}/img/{next(iter(fake.taxonomy.images))}.png"
+
+
+def _taxonomy():
+    return Taxonomy(classes=1, depth=0, fanout=1, images_per_node=1, image_size=(8, 8))
+
+
+def test_fetch_image(tmp_path, no_backoff):
+    with FakeFathomNet(_taxonomy(), latency=0.01) as fake:
+        controller = AIMDController(initial=2)
+        size, _ = download_threaded.fetch_image(_image_url(fake), tmp_path / "a.png", controller)
+    assert (tmp_path / "a.png").read_bytes() == fake.png
+    assert size == len(fake.png)
+    assert controller.completed == 1 and controller.inflight == 0
+
+
+def test_fetch_image_retries_errors(tmp_path, no_backoff):
+    with FakeFathomNet(_taxonomy(), error_rate=1.0) as fake:
+        controller = AIMDController(initial=8)
+        assert download_threaded.fetch_image(_image_url(fake), tmp_path / "a.png", controller) is None
+        log = fake.reset_log()
+    assert len(log) == RETRIES + 1
+    assert all(status == 500 for _, status, _ in log)
+    assert controller.errors == RETRIES + 1
+    assert controller.limit < 8
+    assert not (tmp_path / "a.png").exists()
+
+
+def test_no_backoff_after_last_attempt(tmp_path, monkeypatch):
+    waits = []
+    monkeypatch.setattr(download_threaded, "backoff_delay", lambda attempt: waits.append(attempt) or 0)
+    with FakeFathomNet(_taxonomy(), error_rate=1.0) as fake:
+        assert download_threaded.fetch_image(_image_url(fake), tmp_path / "a.png", AIMDController()) is None
+    assert waits == list(range(RETRIES))
+
+
+def test_fetch_image_recovers(tmp_path, no_backoff):
+    # with seed 9 the first three attempts fail and the fourth gets through
+    with FakeFathomNet(_taxonomy(), error_rate=0.6, seed=9) as fake:
+        controller = AIMDController(initial=8)
+        fetched = download_threaded.fetch_image(_image_url(fake), tmp_path / "a.png", controller)
+        statuses = [status for _, status, _ in fake.reset_log()]
+    assert fetched is not None
+    assert statuses == [500, 500, 500, 200]
+    assert controller.errors == 3 and controller.completed == 1
+
+
+def test_fetch_image_honours_retry_after(tmp_path, no_backoff):
+    with FakeFathomNet(_taxonomy(), throttle_rate=1.0) as fake:
+        controller = AIMDController(initial=8)
+        start = time.monotonic()
+        assert download_threaded.fetch_image(_image_url(fake), tmp_path / "a.png", controller, retries=1) is None
+    # the fake asks for Retry-After: 1, the second attempt waits for it
+    assert time.monotonic() - start >= 0.9
+    assert controller.throttled == 2
+
+
+def test_fetch_image_connection_error(tmp_path, no_backoff):
+    with FakeFathomNet(_taxonomy()) as fake:
+        url = _image_url(fake)
+    controller = AIMDController(initial=8)
+    assert download_threaded.fetch_image(url, tmp_path / "a.png", controller, retries=2) is None
+    # a request that never gets a status counts as a failure
+    assert controller.errors == 3
+    assert controller.limit < 8
+
+
+def test_fetch_image_deadline(tmp_path, no_backoff):
+    with FakeFathomNet(_taxonomy(), error_rate=1.0, latency=0.2) as fake:
+        controller = AIMDController(initial=8)
+        start = time.monotonic()
+        assert download_threaded.fetch_image(_image_url(fake), tmp_path / "a.png", controller, deadline=time.monotonic() + 0.3) is None
+    assert time.monotonic() - start < 0.2 * (RETRIES + 1)
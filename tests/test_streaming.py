@@ -0,0 +1,49 @@
+from streaming import ByteBudget, stream_to_file
+import threading
+import pytest
+
+
+def _chunks(budget, seen, n=4, size=100):
+    for _ in range(n):
+        seen.append(budget.used)
+        yield b"x" * size
+
+
+def test_whole_transfer_is_reserved(tmp_path):
+    budget = ByteBudget(limit=1000)
+    seen = []
+    assert stream_to_file(_chunks(budget, seen), tmp_path / "a", budget, expected=400)[0] == 400
+    assert seen == [400] * 4
+    assert budget.used == 0
+
+
+def test_reservation_grows_without_content_length(tmp_path):
+    budget = ByteBudget(limit=1000)
+    seen = []
+    stream_to_file(_chunks(budget, seen), tmp_path / "a", budget, chunk_size=100)
+    assert seen == [100, 100, 200, 300]
+    assert budget.used == 0
+
+
+def test_transfers_wait_for_budget(tmp_path):
+    budget = ByteBudget(limit=1000)
+    budget.acquire(800)
+    done = threading.Event()
+    thread = threading.Thread(target=lambda: (stream_to_file(iter([b"x" * 400]), tmp_path / "a", budget, expected=400), done.set()))
+    thread.start()
+    assert not done.wait(0.1)
+    budget.release(800)
+    assert done.wait(5)
+    thread.join()
+
+
+def test_failed_transfer_releases(tmp_path):
+    budget = ByteBudget(limit=1000)
+
+    def _broken():
+        yield b"x" * 100
+        raise ConnectionError
+    with pytest.raises(ConnectionError):
+        stream_to_file(_broken(), tmp_path / "a", budget, expected=400)
+    assert budget.used == 0
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,51 @@
+from tree_metadata import load_tree, save_tree, SUFFIX
+import download_async
+import download_threaded
+import pickle
+
+
+def _tree(module):
+    # ROOT -> a (2) -> b (3), ROOT -> c (0)
+    def _count(n):
+        return module.Count(n) if module is download_async else module.Count(n, 0)
+    tree = module.MyTree()
+    tree.create_node("Cls", 0, data=_count(0))
+    tree.create_node("(genus.)a", "a", 0, _count(2))
+    tree.create_node("(species.)b", "b", "a", _count(3))
+    tree.create_node("(genus.)c", "c", 0, _count(0))
+    module.cleanupTree(tree, 0)
+    return tree
+
+
+def test_async_and_threaded_trees_agree(tmp_path):
+    for module in (download_async, download_threaded):
+        (tmp_path / module.__name__).mkdir()
+        module.write_tree_metadata(_tree(module), "Cls", tmp_path / module.__name__)
+
+    compact_async = load_tree(tmp_path / "download_async" / f"Cls{SUFFIX}")
+    compact_threaded = load_tree(tmp_path / "download_threaded" / f"Cls{SUFFIX}")
+    for compact in (compact_async, compact_threaded):
+        assert [compact.node_name(i) for i in range(len(compact))] == ["Cls", "a", "b"]
+        assert compact.count.tolist() == [0, 2, 3]
+        assert compact.accumulated.tolist() == [5, 5, 3]
+
+
+def test_empty_tree(tmp_path):
+    tree = download_async.MyTree()
+    tree.create_node("Cls", 0, data=download_async.Count(0))
+    tree.create_node("(genus.)a", "a", 0, download_async.Count(0))
+    download_async.cleanupTree(tree, 0)
+
+    save_tree(tree, "Cls", tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_legacy_pickles(tmp_path):
+    # the old async pickles hold subtree totals in Count.count, the threaded ones own counts plus accumulated_count
+    for module in (download_async, download_threaded):
+        with open(tmp_path / f"{module.__name__}.pickle", "wb") as f:
+            pickle.dump(_tree(module), f)
+
+        compact = load_tree(tmp_path / f"{module.__name__}.pickle")
+        assert compact.count.tolist() == [0, 2, 3]
+        assert compact.accumulated.tolist() == [5, 5, 3]
@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+from voc_writer import AnnotationWriter, write_voc
+import voc_writer
+import pytest
+
+
+def _image(uuid="u1"):
+    box = SimpleNamespace(concept="C0", x=1, y=2, width=3, height=4)
+    return SimpleNamespace(uuid=uuid, width=64, height=48, boundingBoxes=[box])
+
+
+def test_interrupted_write_keeps_previous_xml(tmp_path, monkeypatch):
+    xml_path = tmp_path / "u1.xml"
+    xml_path.write_text("<annotation>previous</annotation>")
+
+    def _killed(src, dst):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(voc_writer.os, "replace", _killed)
+    with pytest.raises(KeyboardInterrupt):
+        write_voc(_image(), tmp_path / "u1.png", xml_path)
+    assert xml_path.read_text() == "<annotation>previous</annotation>"
+
+
+def test_writer_calls_back_after_write(tmp_path):
+    written = []
+    writer = AnnotationWriter()
+    for uuid in ("u1", "u2"):
+        xml_path = tmp_path / f"{uuid}.xml"
+        writer.submit(_image(uuid), tmp_path / f"{uuid}.png", xml_path, lambda p=xml_path: written.append(p.exists()))
+    writer.close()
+    assert written == [True, True]
+    assert writer.written == 2 and writer.failed == 0
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["u1.xml", "u2.xml"]